@@ -1,35 +1,107 @@
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.urls import path
+from django.utils import timezone
+
+from . import exports
 from .models import (
     Product,
     UserTokenAccount,
     Purchase,
+    CartItem,
+    StockReservation,
+    VendorSalesRollup,
     TokenTopUp,
     VendorAPIKey,
     TokenTransfer,
     VendorWebhook,
+    WebhookDelivery,
+    LedgerEntry,
+    BalanceSnapshot,
+    BalanceReconciliation,
+    VendorCreditShard,
+    IdempotencyRecord,
 )
 
 
+class ExportMixin:
+    """
+    Adds a streaming ``export/`` view to a ModelAdmin. It honours the same
+    filters/search as the change list (``?format=csv|ndjson``).
+    """
+
+    export_kind = None
+    change_list_template = "admin/market/change_list_export.html"
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path(
+                "export/",
+                self.admin_site.admin_view(self.export_view),
+                name="%s_%s_export" % info,
+            ),
+        ] + super().get_urls()
+
+    def export_view(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        params = request.GET.copy()
+        fmt = params.pop("format", [exports.FORMAT_CSV])[-1]
+        if fmt not in exports.FORMATS:
+            fmt = exports.FORMAT_CSV
+        # The change list rejects unknown query params, so hide ours from it
+        request.GET = params
+        queryset = self.get_changelist_instance(request).get_queryset(request)
+        return exports.streaming_export(
+            queryset, self.export_kind, fmt, self.export_kind
+        )
+
+
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ("name", "price_tokens", "active")
+    list_display = ("name", "price_tokens", "active", "stock", "stock_buckets")
     list_filter = ("active",)
     search_fields = ("name",)
 
 
 @admin.register(UserTokenAccount)
 class UserTokenAccountAdmin(admin.ModelAdmin):
-    list_display = ("user", "token_balance")
+    list_display = ("user", "token_balance", "credit_shards")
     search_fields = ("user__username",)
 
 
 @admin.register(Purchase)
-class PurchaseAdmin(admin.ModelAdmin):
+class PurchaseAdmin(ExportMixin, admin.ModelAdmin):
+    export_kind = "purchases"
     list_display = ("user", "product", "quantity", "total_tokens", "created_at")
     list_filter = ("created_at",)
 
+@admin.register(CartItem)
+class CartItemAdmin(admin.ModelAdmin):
+    list_display = ("user", "product", "quantity", "added_at")
+    search_fields = ("user__username", "product__name")
+    raw_id_fields = ("user", "product")
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ("user", "product", "quantity", "expires_at")
+    search_fields = ("user__username", "product__name")
+    raw_id_fields = ("user", "product")
+
+
+@admin.register(VendorSalesRollup)
+class VendorSalesRollupAdmin(admin.ModelAdmin):
+    list_display = ("vendor", "product", "period", "bucket_start", "units", "tokens", "buyers")
+    list_filter = ("period",)
+    search_fields = ("vendor__username", "product__name")
+    raw_id_fields = ("vendor", "product")
+
+
 @admin.register(TokenTopUp)
-class TokenTopUpAdmin(admin.ModelAdmin):
+class TokenTopUpAdmin(ExportMixin, admin.ModelAdmin):
+    export_kind = "topups"
     list_display = ("user", "amount_tokens", "created_at", "description")
     list_filter = ("created_at",)
     search_fields = ("user__username",)
@@ -37,13 +109,22 @@ class TokenTopUpAdmin(admin.ModelAdmin):
 
 @admin.register(VendorAPIKey)
 class VendorAPIKeyAdmin(admin.ModelAdmin):
-    list_display = ("vendor", "name", "is_active", "created_at")
+    list_display = (
+        "vendor",
+        "name",
+        "key_prefix",
+        "is_active",
+        "rate_limit_per_minute",
+        "daily_transfer_quota_tokens",
+        "created_at",
+    )
     list_filter = ("is_active", "created_at")
-    search_fields = ("vendor__username", "name")
+    search_fields = ("vendor__username", "name", "key_prefix")
 
 
 @admin.register(TokenTransfer)
-class TokenTransferAdmin(admin.ModelAdmin):
+class TokenTransferAdmin(ExportMixin, admin.ModelAdmin):
+    export_kind = "transfers"
     list_display = ("from_user", "to_user", "amount_tokens", "created_at", "api_key")
     list_filter = ("created_at",)
     search_fields = ("from_user__username", "to_user__username")
@@ -51,6 +132,111 @@ class TokenTransferAdmin(admin.ModelAdmin):
 
 @admin.register(VendorWebhook)
 class VendorWebhookAdmin(admin.ModelAdmin):
-    list_display = ("vendor", "url", "is_active", "created_at")
+    list_display = (
+        "vendor",
+        "url",
+        "is_active",
+        "circuit_open_until",
+        "consecutive_failures",
+        "deliveries_succeeded",
+        "deliveries_failed",
+        "last_status_code",
+        "last_latency_ms",
+    )
     list_filter = ("is_active", "created_at")
-    search_fields = ("vendor__username", "url")
\ No newline at end of file
+    search_fields = ("vendor__username", "url")
+    readonly_fields = (
+        "deliveries_succeeded",
+        "deliveries_failed",
+        "last_attempt_at",
+        "last_status_code",
+        "last_latency_ms",
+    )
+
+
+@admin.register(WebhookDelivery)
+class WebhookDeliveryAdmin(admin.ModelAdmin):
+    list_display = (
+        "webhook",
+        "event",
+        "sequence",
+        "status",
+        "attempts",
+        "response_status",
+        "latency_ms",
+        "next_attempt_at",
+        "created_at",
+    )
+    list_filter = ("status", "event", "created_at")
+    search_fields = ("webhook__url", "webhook__vendor__username")
+    raw_id_fields = ("batch",)
+    actions = ["requeue"]
+
+    @admin.action(description="Requeue selected deliveries")
+    def requeue(self, request, queryset):
+        # Events already sent inside a batch are requeued through their batch
+        updated = queryset.filter(
+            status__in=[WebhookDelivery.STATUS_PENDING, WebhookDelivery.STATUS_DEAD]
+        ).update(
+            status=WebhookDelivery.STATUS_PENDING,
+            attempts=0,
+            next_attempt_at=timezone.now(),
+        )
+        self.message_user(request, f"{updated} deliveries requeued.")
+
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ("user", "kind", "amount_tokens", "created_at", "description")
+    list_filter = ("kind", "created_at")
+    search_fields = ("user__username",)
+    raw_id_fields = ("user", "purchase", "topup", "transfer")
+
+    # The ledger is append-only and only written by the money-moving views
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(BalanceSnapshot)
+class BalanceSnapshotAdmin(admin.ModelAdmin):
+    list_display = ("user", "balance", "as_of", "last_entry_id", "created_at")
+    search_fields = ("user__username",)
+    raw_id_fields = ("user",)
+
+
+
+@admin.register(BalanceReconciliation)
+class BalanceReconciliationAdmin(admin.ModelAdmin):
+    list_display = ("user", "expected_balance", "drift", "checked_at")
+    search_fields = ("user__username",)
+    raw_id_fields = ("user",)
+    ordering = ("-checked_at",)
+
+    # Written by `manage.py reconcile_balances`
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(VendorCreditShard)
+class VendorCreditShardAdmin(admin.ModelAdmin):
+    list_display = ("user", "shard", "pending_tokens")
+    search_fields = ("user__username",)
+    raw_id_fields = ("user",)
+
+
+@admin.register(IdempotencyRecord)
+class IdempotencyRecordAdmin(admin.ModelAdmin):
+    list_display = ("scope", "key", "endpoint", "status_code", "created_at")
+    list_filter = ("endpoint", "status_code")
+    search_fields = ("scope", "key")
+    exclude = ("response_body",)
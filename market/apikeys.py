@@ -0,0 +1,137 @@
+"""
+Vendor API key resolution with a two-tier cache.
+
+Tier 1 is a per-process LRU with a TTL; tier 2 is an optional shared Django
+cache (``UPBT_API_KEY_CACHE_ALIAS``). Entries are keyed by the key's SHA-256
+digest and dropped by the ``VendorAPIKey`` save/delete signals. Other
+processes' tier-1 entries expire after ``UPBT_API_KEY_CACHE_TTL`` seconds.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import VendorAPIKey, hash_api_key
+
+# Marker for "we looked it up and there is no such active key"
+_MISSING = "missing"
+
+
+class LRUCache:
+    """Small thread-safe LRU cache with per-entry expiry."""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_local_cache = LRUCache(getattr(settings, "UPBT_API_KEY_CACHE_SIZE", 1024))
+
+
+def _ttl(negative=False):
+    if negative:
+        return getattr(settings, "UPBT_API_KEY_CACHE_NEGATIVE_TTL", 5)
+    return getattr(settings, "UPBT_API_KEY_CACHE_TTL", 60)
+
+
+def _shared_cache():
+    alias = getattr(settings, "UPBT_API_KEY_CACHE_ALIAS", None)
+    return caches[alias] if alias else None
+
+
+def _shared_key(key_hash):
+    return f"upbt:apikey:{key_hash}"
+
+
+def resolve_api_key(raw_key):
+    """
+    Return the active ``VendorAPIKey`` (with ``vendor`` loaded) for a raw key,
+    or None. Unknown keys are cached briefly too, so guessing doesn't hit
+    the database on every request.
+    """
+    if not raw_key:
+        return None
+    key_hash = hash_api_key(raw_key)
+
+    cached = _local_cache.get(key_hash)
+    if cached is not None:
+        return None if cached == _MISSING else cached
+
+    shared = _shared_cache()
+    if shared is not None:
+        cached = shared.get(_shared_key(key_hash))
+        if cached is not None:
+            _local_cache.set(key_hash, cached, _ttl(cached == _MISSING))
+            return None if cached == _MISSING else cached
+
+    try:
+        api_key = VendorAPIKey.objects.select_related("vendor").get(
+            key_hash=key_hash,
+            is_active=True,
+        )
+    except VendorAPIKey.DoesNotExist:
+        api_key = None
+
+    value = api_key if api_key is not None else _MISSING
+    ttl = _ttl(api_key is None)
+    _local_cache.set(key_hash, value, ttl)
+    if shared is not None:
+        shared.set(_shared_key(key_hash), value, ttl)
+    return api_key
+
+
+def get_api_key_from_request(request):
+    """
+    Try to read API key from:
+    - X-API-Key header
+    - ?api_key=
+    - POST body field 'api_key'
+
+    The result is remembered on the request, so the rate-limit middleware and
+    the view resolve it only once.
+    """
+    if not hasattr(request, "vendor_api_key"):
+        key = (
+            request.headers.get("X-API-Key")
+            or request.GET.get("api_key")
+            or request.POST.get("api_key")
+        )
+        request.vendor_api_key = resolve_api_key(key)
+    return request.vendor_api_key
+
+
+def invalidate_api_key(key_hash):
+    _local_cache.delete(key_hash)
+    shared = _shared_cache()
+    if shared is not None:
+        shared.delete(_shared_key(key_hash))
@@ -0,0 +1,171 @@
+"""
+Product catalogue: filtering, full-text search, pagination and page caching.
+
+Search uses the backend's own full-text index when there is one (an FTS5
+table on SQLite, a GIN expression index on PostgreSQL; both created by
+migration 0013) and falls back to ``icontains`` elsewhere. On SQLite, a
+migration that rebuilds market_product drops the FTS sync triggers; it must
+re-create them itself (copy ``restore_sqlite_triggers`` from migration 0024).
+
+Rendered result pages are cached per query string under a "catalogue
+version" that every Product save/delete bumps (see signals.py), so a change
+invalidates all cached pages at once without having to enumerate them.
+The version only reaches other processes through a shared cache; with the
+per-process LocMem backend, pages are kept for the much shorter
+``UPBT_CATALOGUE_LOCAL_CACHE_TTL`` instead, which bounds how stale another
+worker's copy can get.
+"""
+import hashlib
+import re
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+
+from .models import Product
+
+FTS_TABLE = "market_product_fts"
+
+# Must match the expression of the GIN index created in migration 0013
+PG_SEARCH_SQL = (
+    "to_tsvector('simple', coalesce(\"market_product\".\"name\", '') || ' ' || "
+    "coalesce(\"market_product\".\"description\", '')) "
+    "@@ websearch_to_tsquery('simple', %s)"
+)
+
+SORT_ORDERS = {
+    "name": ("name", "id"),
+    "price_asc": ("price_tokens", "id"),
+    "price_desc": ("-price_tokens", "-id"),
+    "newest": ("-id",),
+}
+
+_VERSION_KEY = "upbt:catalogue:version"
+_has_fts_table = None
+
+
+def _cache():
+    return caches[getattr(settings, "UPBT_CATALOGUE_CACHE_ALIAS", "default")]
+
+
+def _page_ttl(cache):
+    if isinstance(cache, LocMemCache):
+        return getattr(settings, "UPBT_CATALOGUE_LOCAL_CACHE_TTL", 5)
+    return getattr(settings, "UPBT_CATALOGUE_CACHE_TTL", 300)
+
+
+def _sqlite_fts_available():
+    global _has_fts_table
+    if _has_fts_table is None:
+        _has_fts_table = FTS_TABLE in connection.introspection.table_names()
+    return _has_fts_table
+
+
+def _fts5_query(text):
+    # Quote every word (so FTS syntax in user input is inert) and prefix-match it
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_products(queryset, text):
+    """Restrict ``queryset`` to products whose name/description match ``text``."""
+    text = text.strip()
+    if not text:
+        return queryset
+
+    if connection.vendor == "sqlite" and _sqlite_fts_available():
+        fts_query = _fts5_query(text)
+        if not fts_query:
+            return queryset.none()
+        return queryset.filter(
+            pk__in=RawSQL(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+                [fts_query],
+            )
+        )
+    if connection.vendor == "postgresql":
+        return queryset.filter(RawSQL(PG_SEARCH_SQL, [text], output_field=BooleanField()))
+    return queryset.filter(Q(name__icontains=text) | Q(description__icontains=text))
+
+
+def catalogue_version():
+    cache = _cache()
+    version = cache.get(_VERSION_KEY)
+    if version is None:
+        cache.add(_VERSION_KEY, 1, timeout=None)
+        version = cache.get(_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalogue_version():
+    """Invalidate every cached catalogue page."""
+    cache = _cache()
+    try:
+        cache.incr(_VERSION_KEY)
+    except ValueError:
+        cache.add(_VERSION_KEY, 2, timeout=None)
+
+
+def _parse_price(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value >= 0 else None
+
+
+def normalize_params(params):
+    """Pick and clean the query parameters the catalogue understands."""
+    sort = params.get("sort", "name")
+    try:
+        page = max(int(params.get("page", 1)), 1)
+    except (TypeError, ValueError):
+        page = 1
+    return {
+        "q": (params.get("q") or "").strip()[:100],
+        "min_price": _parse_price(params.get("min_price")),
+        "max_price": _parse_price(params.get("max_price")),
+        "sort": sort if sort in SORT_ORDERS else "name",
+        "page": page,
+    }
+
+
+def _build_page(params):
+    products = Product.objects.filter(active=True)
+    if params["min_price"] is not None:
+        products = products.filter(price_tokens__gte=params["min_price"])
+    if params["max_price"] is not None:
+        products = products.filter(price_tokens__lte=params["max_price"])
+    products = search_products(products, params["q"])
+    products = products.order_by(*SORT_ORDERS[params["sort"]]).only(
+        "id", "name", "description", "price_tokens"
+    )
+
+    paginator = Paginator(products, getattr(settings, "UPBT_CATALOGUE_PAGE_SIZE", 24))
+    page = paginator.get_page(params["page"])
+    return {
+        "products": list(page.object_list),
+        "number": page.number,
+        "num_pages": paginator.num_pages,
+        "count": paginator.count,
+        "has_previous": page.has_previous(),
+        "has_next": page.has_next(),
+    }
+
+
+def catalogue_page(params):
+    """Return one (possibly cached) page of active products for ``params``."""
+    key_source = repr(sorted(params.items())).encode("utf-8")
+    key = "upbt:catalogue:{}:{}".format(
+        catalogue_version(), hashlib.sha256(key_source).hexdigest()
+    )
+    cache = _cache()
+    page = cache.get(key)
+    if page is None:
+        page = _build_page(params)
+        cache.set(key, page, _page_ttl(cache))
+    return page
@@ -0,0 +1,161 @@
+"""
+Cart checkout.
+
+``checkout_cart`` buys every line of a user's cart in one transaction with a
+fixed number of statements, however many lines there are: one query for
+the cart, one for the products (with their vendors' accounts), one lock on
+the buyer plus every distinct vendor account (in user id order, like every
+other money movement), one UPDATE applying the buyer's debit and the
+aggregated per-vendor credits, and bulk INSERTs for the purchases, ledger
+entries, sales rollups and webhook events (one ``order.created`` event per
+vendor).
+
+Sharded vendors (``credit_shards > 0``) are credited through
+``credit_sale`` as in ``buy_product``, once per vendor rather than per line.
+Limited products are taken out of stock (or out of the buyer's
+reservations) first, see market/inventory.py.
+"""
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from . import ledger
+from .credits import credit_sale
+from .inventory import OutOfStock, claim_stock
+from .locking import InsufficientFunds, lock_accounts
+from .models import CartItem, Product, Purchase, UserTokenAccount
+from .rollups import record_sales
+from .usercontext import invalidate_user_context
+from .webhooks import enqueue_order_webhooks
+
+
+class CheckoutError(Exception):
+    """The cart can't be checked out as it is; the message says why."""
+
+
+def checkout_cart(user):
+    """
+    Buy everything in ``user``'s cart and empty it. Must run inside a
+    transaction (the views use ``atomic_with_retry``). Returns the created
+    purchases.
+
+    Raises ``CheckoutError`` for an empty cart, unavailable or sold out
+    products and ``InsufficientFunds`` if the buyer can't pay for the whole
+    cart; in both cases nothing is changed.
+    """
+    with transaction.atomic():
+        return _checkout(user)
+
+
+def _checkout(user):
+    items = list(CartItem.objects.filter(user=user).order_by("pk"))
+    if not items:
+        raise CheckoutError("Your cart is empty.")
+
+    # 1) Price every line with a single product query
+    products = Product.objects.select_related("owner__token_account").in_bulk(
+        [item.product_id for item in items]
+    )
+    unavailable = [
+        products[item.product_id].name
+        for item in items
+        if not products[item.product_id].active
+    ]
+    if unavailable:
+        raise CheckoutError(
+            "No longer available: " + ", ".join(unavailable) + ". Remove them from your cart."
+        )
+
+    lines = []
+    vendor_totals = {}
+    for item in items:
+        product = products[item.product_id]
+        total = product.price_tokens * item.quantity
+        lines.append((product, item.quantity, total))
+        if product.owner_id:
+            vendor_totals[product.owner_id] = vendor_totals.get(product.owner_id, 0) + total
+    grand_total = sum(total for _, _, total in lines)
+
+    # Stock rows before account rows
+    try:
+        claim_stock(user, {product: quantity for product, quantity, _ in lines})
+    except OutOfStock as exc:
+        raise CheckoutError(f"{exc}. Lower the quantity or remove it from your cart.")
+
+    vendors = {}
+    sharded = {}
+    for product, _, _ in lines:
+        vendor = product.owner
+        account = getattr(vendor, "token_account", None) if vendor else None
+        if account is None:
+            # Vendor without a token account: the buyer still pays
+            continue
+        vendors[vendor.pk] = vendor
+        if account.credit_shards:
+            sharded[vendor.pk] = account.credit_shards
+
+    # 2) Lock the buyer and the directly credited vendors once, in key order
+    direct = set(vendors) - set(sharded)
+    accounts = lock_accounts({user.pk} | direct)
+    buyer = accounts.get(user.pk)
+    if buyer is None or buyer.token_balance < grand_total:
+        raise InsufficientFunds()
+
+    # 3) Debit the buyer and credit every direct vendor with one UPDATE
+    deltas = {user.pk: -grand_total}
+    for vendor_id in direct:
+        if vendor_id not in accounts:
+            # Account removed since the product query: no credit
+            del vendors[vendor_id]
+            continue
+        deltas[vendor_id] = deltas.get(vendor_id, 0) + vendor_totals[vendor_id]
+    buyer_pk = buyer.pk
+    UserTokenAccount.objects.filter(
+        pk__in=[accounts[user_id].pk for user_id in deltas]
+    ).update(
+        token_balance=F("token_balance")
+        + Case(
+            *[
+                When(pk=accounts[user_id].pk, then=Value(delta))
+                for user_id, delta in deltas.items()
+            ],
+            default=Value(0),
+            output_field=IntegerField(),
+        ),
+        total_spent=F("total_spent")
+        + Case(
+            When(pk=buyer_pk, then=Value(grand_total)),
+            default=Value(0),
+            output_field=IntegerField(),
+        ),
+        purchase_count=F("purchase_count")
+        + Case(
+            When(pk=buyer_pk, then=Value(len(lines))),
+            default=Value(0),
+            output_field=IntegerField(),
+        ),
+    )
+    invalidate_user_context(*deltas)
+
+    # Hot vendors: one shard credit per vendor (account row before shard row)
+    for vendor_id, shards in sharded.items():
+        credit_sale(vendor_id, vendor_totals[vendor_id], shards)
+
+    # 4) Record everything in bulk
+    purchases = Purchase.objects.bulk_create(
+        [
+            Purchase(
+                user=user,
+                product=product,
+                vendor=product.owner,
+                quantity=quantity,
+                total_tokens=total,
+            )
+            for product, quantity, total in lines
+        ]
+    )
+    ledger.record_purchases(purchases, vendors)
+    record_sales(purchases, sharded)
+    enqueue_order_webhooks(purchases)
+
+    CartItem.objects.filter(pk__in=[item.pk for item in items]).delete()
+    return purchases
@@ -0,0 +1,35 @@
+"""
+Conditional GET helpers (ETag / Last-Modified / 304 Not Modified).
+
+Views compute their validators from data they already have and do::
+
+    response = not_modified(request, etag, last_modified) or render(...)
+    return set_validators(response, etag, last_modified, max_age=...)
+"""
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+
+def make_etag(*parts):
+    raw = "|".join(str(part) for part in parts).encode("utf-8")
+    return quote_etag(hashlib.sha256(raw).hexdigest()[:32])
+
+
+def not_modified(request, etag, last_modified=None):
+    """
+    Return a 304 (or 412) response if the client's cached copy is still
+    valid, otherwise None.
+    """
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    return get_conditional_response(request, etag=etag, last_modified=timestamp)
+
+
+def set_validators(response, etag, last_modified=None, **cache_control):
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified.timestamp())
+    if cache_control:
+        patch_cache_control(response, **cache_control)
+    return response
@@ -0,0 +1,15 @@
+from .usercontext import get_user_context, user_is_vendor
+
+
+def market(request):
+    """
+    Navbar data for authenticated users, resolved lazily and at most once
+    per request (see market.usercontext).
+    """
+    user = getattr(request, "user", None)
+    if user is None or not user.is_authenticated:
+        return {}
+    return {
+        "token_balance": lambda: get_user_context(user)["balance"],
+        "user_is_vendor": lambda: user_is_vendor(user),
+    }
@@ -0,0 +1,76 @@
+"""
+Sharded vendor credits.
+
+For vendors with ``UserTokenAccount.credit_shards > 0`` sale income is not
+added to their account row directly; each purchase bumps one of N
+``VendorCreditShard`` rows picked at random, so concurrent buyers of the same
+vendor rarely wait on each other. ``fold_credit_shards`` (run by the command
+of the same name) periodically moves the pending amounts into
+``token_balance``. Until then they show up in ``total_balance`` but can't be
+spent.
+
+Lock order: account rows before shard rows, everywhere.
+"""
+import random
+
+from django.db import transaction
+from django.db.models import F, Sum
+
+from .locking import lock_accounts
+from .models import UserTokenAccount, VendorCreditShard
+from .usercontext import invalidate_user_context
+
+
+def credit_sale(user_id, amount, shards):
+    """
+    Credit a vendor for a sale: directly when ``shards`` is 0, otherwise to
+    a random shard. Returns False if the vendor has no account.
+    """
+    if not shards:
+        return UserTokenAccount.objects.credit(user_id, amount) is not None
+
+    shard = random.randrange(shards)
+    updated = VendorCreditShard.objects.filter(user_id=user_id, shard=shard).update(
+        pending_tokens=F("pending_tokens") + amount
+    )
+    if not updated:
+        # First credit to this shard; a concurrent creator may win the race
+        with transaction.atomic():
+            VendorCreditShard.objects.get_or_create(user_id=user_id, shard=shard)
+        VendorCreditShard.objects.filter(user_id=user_id, shard=shard).update(
+            pending_tokens=F("pending_tokens") + amount
+        )
+    invalidate_user_context(user_id)
+    return True
+
+
+def fold_credit_shards(user_id):
+    """
+    Move every pending shard credit of one vendor into its token_balance.
+    Returns the number of tokens folded.
+    """
+    with transaction.atomic():
+        if user_id not in lock_accounts([user_id]):
+            return 0
+        shards = list(
+            VendorCreditShard.objects.select_for_update()
+            .filter(user_id=user_id, pending_tokens__gt=0)
+            .order_by("shard")
+        )
+        total = sum(shard.pending_tokens for shard in shards)
+        if not total:
+            return 0
+        VendorCreditShard.objects.filter(pk__in=[s.pk for s in shards]).update(
+            pending_tokens=0
+        )
+        UserTokenAccount.objects.credit(user_id, total)
+    return total
+
+
+def vendors_with_pending_credits():
+    return (
+        VendorCreditShard.objects.filter(pending_tokens__gt=0)
+        .values("user_id")
+        .annotate(pending=Sum("pending_tokens"))
+        .order_by("user_id")
+    )
@@ -0,0 +1,103 @@
+"""
+Streaming CSV / NDJSON exports.
+
+Rows are pulled from the database with ``QuerySet.iterator(chunk_size=...)``
+(a server-side cursor on PostgreSQL) over ``values_list`` tuples and written
+out one line at a time through ``StreamingHttpResponse``, so memory use is
+constant no matter how many rows are exported.
+"""
+import csv
+import json
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from .models import Purchase, TokenTopUp, TokenTransfer
+
+FORMAT_CSV = "csv"
+FORMAT_NDJSON = "ndjson"
+FORMATS = (FORMAT_CSV, FORMAT_NDJSON)
+
+# Column name -> ORM lookup, per exportable table
+EXPORT_COLUMNS = {
+    "purchases": {
+        "model": Purchase,
+        "columns": [
+            ("id", "id"),
+            ("created_at", "created_at"),
+            ("buyer", "user__username"),
+            ("vendor", "vendor__username"),
+            ("product_id", "product_id"),
+            ("product", "product__name"),
+            ("quantity", "quantity"),
+            ("total_tokens", "total_tokens"),
+        ],
+    },
+    "topups": {
+        "model": TokenTopUp,
+        "columns": [
+            ("id", "id"),
+            ("created_at", "created_at"),
+            ("user", "user__username"),
+            ("amount_tokens", "amount_tokens"),
+            ("description", "description"),
+        ],
+    },
+    "transfers": {
+        "model": TokenTransfer,
+        "columns": [
+            ("id", "id"),
+            ("created_at", "created_at"),
+            ("from_user", "from_user__username"),
+            ("to_user", "to_user__username"),
+            ("amount_tokens", "amount_tokens"),
+            ("description", "description"),
+            ("api_key_id", "api_key_id"),
+        ],
+    },
+}
+
+
+class _Echo:
+    """File-like object whose write() just returns the line, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def _json_default(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def iter_rows(queryset, kind, fmt):
+    columns = EXPORT_COLUMNS[kind]["columns"]
+    names = [name for name, _ in columns]
+    chunk_size = getattr(settings, "UPBT_EXPORT_CHUNK_SIZE", 2000)
+    rows = (
+        queryset.order_by("id")
+        .values_list(*[lookup for _, lookup in columns])
+        .iterator(chunk_size=chunk_size)
+    )
+
+    if fmt == FORMAT_CSV:
+        writer = csv.writer(_Echo())
+        yield writer.writerow(names)
+        for row in rows:
+            yield writer.writerow(
+                [value.isoformat() if hasattr(value, "isoformat") else value for value in row]
+            )
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(names, row)), default=_json_default) + "\n"
+
+
+def streaming_export(queryset, kind, fmt, filename):
+    content_type = "text/csv" if fmt == FORMAT_CSV else "application/x-ndjson"
+    response = StreamingHttpResponse(
+        iter_rows(queryset, kind, fmt),
+        content_type=content_type,
+    )
+    response["Content-Disposition"] = f'attachment; filename="{filename}.{fmt}"'
+    return response
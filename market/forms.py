@@ -15,7 +15,34 @@ class ProductForm(forms.ModelForm):
     class Meta:
         model = Product
         # owner is set in the view, not by the user
-        fields = ["name", "description", "price_tokens", "active"]
+        fields = ["sku", "name", "description", "price_tokens", "active", "stock", "stock_buckets"]
+
+    def __init__(self, *args, check_sku=True, **kwargs):
+        # Bulk imports match rows by SKU and skip the per-row lookup
+        self.check_sku = check_sku
+        super().__init__(*args, **kwargs)
+
+    def clean_sku(self):
+        sku = self.cleaned_data["sku"].strip()
+        owner_id = self.instance.owner_id
+        if (
+            self.check_sku
+            and sku
+            and owner_id
+            and Product.objects.filter(owner_id=owner_id, sku=sku)
+            .exclude(pk=self.instance.pk)
+            .exists()
+        ):
+            raise forms.ValidationError("You already have a product with this SKU.")
+        return sku
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get("stock_buckets") and cleaned_data.get("stock") is None:
+            self.add_error("stock_buckets", "Stock buckets need a limited stock.")
+        return cleaned_data
+
+
 class BuyTokensForm(forms.Form):
     amount_tokens = forms.IntegerField(min_value=1, label="Amount of UPBolis")
     # Payment gateway goes here (Para el futuro pues dog)
\ No newline at end of file
@@ -0,0 +1,147 @@
+"""
+Idempotency keys for money-moving endpoints.
+
+A client may send an ``Idempotency-Key`` header (web forms send a hidden
+``idempotency_key`` field) with a POST. The first request with a given key
+runs normally and its response is stored in ``IdempotencyRecord`` in the
+same transaction as the money movement; any retry with the same key gets
+that response back after a single indexed lookup, without touching the
+account rows.
+
+Keys are scoped per user / per API key, so two clients can't collide. The
+same key with a different request body is rejected with 422. Server errors
+(5xx) are not stored, so those requests can be retried for real. Old
+records are removed by ``purge_idempotency_keys``.
+"""
+import hashlib
+from functools import wraps
+
+from django.contrib import messages
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+
+from .models import IdempotencyRecord
+
+HEADER = "Idempotency-Key"
+FORM_FIELD = "idempotency_key"
+MAX_KEY_LENGTH = 255
+
+# Per-render form fields that must not change the request fingerprint
+_IGNORED_FIELDS = {"csrfmiddlewaretoken", FORM_FIELD}
+
+
+def get_idempotency_key(request):
+    return (request.headers.get(HEADER) or request.POST.get(FORM_FIELD) or "").strip()
+
+
+def request_fingerprint(request):
+    digest = hashlib.sha256()
+    digest.update(f"{request.method} {request.path}\n".encode("utf-8"))
+    if request.content_type in ("application/x-www-form-urlencoded", "multipart/form-data"):
+        for name in sorted(request.POST):
+            if name not in _IGNORED_FIELDS:
+                digest.update(f"{name}={request.POST.getlist(name)!r}\n".encode("utf-8"))
+    else:
+        digest.update(request.body)
+    return digest.hexdigest()
+
+
+def _conflict():
+    return JsonResponse(
+        {"error": f"{HEADER} was already used with a different request"},
+        status=422,
+    )
+
+
+def _replay(request, record, fingerprint, replay_message):
+    if record.request_hash != fingerprint:
+        return _conflict()
+    if record.status_code is None:
+        # Only visible if the original request's transaction is still open
+        return JsonResponse(
+            {"error": "A request with this Idempotency-Key is still in progress"},
+            status=409,
+        )
+    response = HttpResponse(
+        bytes(record.response_body),
+        status=record.status_code,
+        content_type=record.content_type or None,
+    )
+    if record.location:
+        response["Location"] = record.location
+    response["Idempotent-Replayed"] = "true"
+    if replay_message:
+        messages.info(request, replay_message)
+    return response
+
+
+def _store(record, response):
+    if transaction.get_rollback():
+        # The view rolled its transaction back; the record goes with it
+        return
+    if response.status_code >= 500 or getattr(response, "streaming", False):
+        record.delete()
+        return
+    record.status_code = response.status_code
+    record.content_type = response.get("Content-Type", "")
+    record.location = response.get("Location", "")[:500]
+    record.response_body = response.content
+    record.save(
+        update_fields=["status_code", "content_type", "location", "response_body"]
+    )
+
+
+def idempotent(scope, replay_message=None):
+    """
+    Make a POST view idempotent per ``Idempotency-Key``.
+
+    ``scope(request)`` returns the key's owner as a string (e.g. ``"user:12"``)
+    or None when the request isn't authenticated; the view then runs as usual
+    and rejects it itself. Must be applied *inside* the view's transaction
+    (below ``atomic_with_retry``) so the record commits or rolls back together
+    with the money movement. ``replay_message`` is flashed on replays of
+    browser requests.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = get_idempotency_key(request) if request.method == "POST" else ""
+            owner = scope(request) if key else None
+            if not owner:
+                return view(request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return JsonResponse(
+                    {"error": f"{HEADER} must be at most {MAX_KEY_LENGTH} characters"},
+                    status=400,
+                )
+
+            fingerprint = request_fingerprint(request)
+            record = IdempotencyRecord.objects.filter(scope=owner, key=key).first()
+            if record is not None:
+                return _replay(request, record, fingerprint, replay_message)
+
+            try:
+                with transaction.atomic():
+                    record = IdempotencyRecord.objects.create(
+                        scope=owner,
+                        key=key,
+                        endpoint=request.resolver_match.view_name if request.resolver_match else "",
+                        request_hash=fingerprint,
+                    )
+            except IntegrityError:
+                # A concurrent request with the same key committed first
+                record = IdempotencyRecord.objects.get(scope=owner, key=key)
+                return _replay(request, record, fingerprint, replay_message)
+
+            response = view(request, *args, **kwargs)
+            _store(record, response)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def user_scope(request):
+    return f"user:{request.user.pk}" if request.user.is_authenticated else None
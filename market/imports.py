@@ -0,0 +1,241 @@
+"""
+Bulk product import (CSV, JSON or NDJSON).
+
+Rows are read and validated one at a time with ``ProductForm`` (CSV and
+NDJSON are never held in memory as a whole) and written in chunks: one query
+finds and locks the chunk's existing products by ``(owner, sku)``, then one
+``bulk_create`` and one ``bulk_update`` (of the fields that changed) apply
+it. Invalid rows are reported with their errors and skipped; the rest of the
+file is still imported.
+
+Columns: ``sku`` (required), ``name``, ``description``, ``price_tokens``,
+``active``, ``stock``. For existing products, missing columns keep their
+current values; an empty ``stock`` means unlimited.
+
+Bulk writes send no model signals, so the catalogue version is bumped once
+at the end and ``updated_at`` is set by hand.
+"""
+import csv
+import json
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.forms.models import model_to_dict
+from django.utils import timezone
+
+from .catalogue import bump_catalogue_version
+from .forms import ProductForm
+from .inventory import set_stock
+from .models import Product
+
+FORMAT_CSV = "csv"
+FORMAT_JSON = "json"
+FORMAT_NDJSON = "ndjson"
+FORMATS = (FORMAT_CSV, FORMAT_JSON, FORMAT_NDJSON)
+CONTENT_TYPES = {
+    "text/csv": FORMAT_CSV,
+    "application/json": FORMAT_JSON,
+    "application/x-ndjson": FORMAT_NDJSON,
+}
+
+IMPORT_FIELDS = ["sku", "name", "description", "price_tokens", "active", "stock"]
+# Written by bulk_update; stock is handled separately
+UPDATE_FIELDS = ["name", "description", "price_tokens", "active"]
+_FALSE_VALUES = {"", "0", "false", "no", "n", "off"}
+# Writes of a chunk tried before its rows are reported as failed
+CHUNK_ATTEMPTS = 3
+
+
+class BadRow:
+    """A row that couldn't even be parsed."""
+
+    def __init__(self, message):
+        self.message = message
+
+
+def guess_format(name="", content_type=""):
+    if content_type in CONTENT_TYPES:
+        return CONTENT_TYPES[content_type]
+    extension = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+    return extension if extension in FORMATS else None
+
+
+def iter_rows(lines, fmt):
+    """Yield row dicts (or ``BadRow``) from an iterable of text lines."""
+    if fmt == FORMAT_CSV:
+        yield from csv.DictReader(lines)
+    elif fmt == FORMAT_NDJSON:
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as exc:
+                yield BadRow(f"Invalid JSON: {exc}")
+    else:
+        try:
+            data = json.loads("".join(lines))
+        except json.JSONDecodeError as exc:
+            yield BadRow(f"Invalid JSON: {exc}")
+            return
+        if isinstance(data, dict):
+            data = data.get("products")
+        if not isinstance(data, list):
+            yield BadRow('Expected a JSON list of products (or {"products": [...]})')
+            return
+        yield from data
+
+
+def _form_data(row, current):
+    data = dict(current) if current else {"active": True, "stock_buckets": 0}
+    for field in IMPORT_FIELDS:
+        value = row.get(field)
+        if value is None:
+            continue
+        if field == "active" and isinstance(value, str):
+            value = value.strip().lower() not in _FALSE_VALUES
+        if field == "stock" and value == "":
+            value = None
+        data[field] = value
+    return data
+
+
+def _write_chunk(vendor, chunk):
+    # Locked (in pk order, like every product lock) so edits made meanwhile
+    # aren't overwritten with the values read here
+    existing = {
+        product.sku: product
+        for product in Product.objects.select_for_update()
+        .filter(owner=vendor, sku__in=[sku for _, sku, _ in chunk])
+        .order_by("pk")
+    }
+    now = timezone.now()
+    result = {"created": 0, "updated": 0, "unchanged": 0, "errors": []}
+    created, changed, restocked, respread = [], [], [], []
+    changed_fields = set()
+
+    for number, sku, row in chunk:
+        product = existing.get(sku)
+        current = model_to_dict(product, fields=ProductForm._meta.fields) if product else None
+        form = ProductForm(
+            _form_data(row, current),
+            instance=product or Product(owner=vendor),
+            check_sku=False,
+        )
+        if not form.is_valid():
+            result["errors"].append(
+                {
+                    "row": number,
+                    "sku": sku,
+                    "errors": {field: list(errors) for field, errors in form.errors.items()},
+                }
+            )
+            continue
+
+        product = form.instance
+        if current is None:
+            created.append(product)
+            continue
+        stock_given = row.get("stock") is not None
+        differing = [field for field in UPDATE_FIELDS if getattr(product, field) != current[field]]
+        if differing:
+            product.updated_at = now
+            changed.append(product)
+            changed_fields.update(differing)
+        elif not (stock_given and product.stock != current["stock"]):
+            result["unchanged"] += 1
+            continue
+        result["updated"] += 1
+        if stock_given and product.stock_buckets:
+            respread.append(product)
+        elif stock_given and product.stock != current["stock"]:
+            restocked.append(product)
+
+    Product.objects.bulk_create(created)
+    result["created"] = len(created)
+    Product.objects.bulk_update(
+        changed, [field for field in UPDATE_FIELDS if field in changed_fields] + ["updated_at"]
+    )
+    Product.objects.bulk_update(restocked, ["stock"])
+    for product in respread:
+        set_stock(product, product.stock)
+    return result
+
+
+def _apply_chunk(vendor, chunk):
+    for attempt in range(CHUNK_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                return _write_chunk(vendor, chunk)
+        except IntegrityError:
+            # Another import created one of these SKUs meanwhile; look them up again
+            time.sleep(0.05 * (attempt + 1))
+    message = "Another import of the same SKUs kept conflicting with this one; retry the file."
+    return {
+        "created": 0,
+        "updated": 0,
+        "unchanged": 0,
+        "errors": [
+            {"row": number, "sku": sku, "errors": {"__all__": [message]}}
+            for number, sku, _ in chunk
+        ],
+    }
+
+
+def import_products(vendor, rows, chunk_size=None, max_rows=None):
+    """
+    Create or update ``vendor``'s products from ``rows`` (see ``iter_rows``),
+    matched by SKU. Returns counts plus the per-row errors (row numbers are
+    1-based over the data rows).
+    """
+    chunk_size = chunk_size or getattr(settings, "UPBT_PRODUCT_IMPORT_CHUNK_SIZE", 500)
+    max_rows = max_rows or getattr(settings, "UPBT_PRODUCT_IMPORT_MAX_ROWS", 50000)
+    result = {"created": 0, "updated": 0, "unchanged": 0, "failed": 0, "errors": []}
+
+    def fail(number, sku, message):
+        result["errors"].append({"row": number, "sku": sku, "errors": {"__all__": [message]}})
+
+    def flush(chunk):
+        chunk_result = _apply_chunk(vendor, chunk)
+        for name in ("created", "updated", "unchanged"):
+            result[name] += chunk_result[name]
+        result["errors"].extend(chunk_result["errors"])
+
+    chunk = []
+    seen = set()
+    number = 0
+    try:
+        for number, row in enumerate(rows, 1):
+            if number > max_rows:
+                fail(number, None, f"Only the first {max_rows} rows of a file are imported.")
+                break
+            if isinstance(row, BadRow):
+                fail(number, None, row.message)
+                continue
+            if not isinstance(row, dict):
+                fail(number, None, "Each product must be an object.")
+                continue
+            sku = str(row.get("sku") or "").strip()
+            if not sku:
+                fail(number, None, "sku is required.")
+                continue
+            if sku in seen:
+                fail(number, sku, "This SKU appears more than once in the file.")
+                continue
+            seen.add(sku)
+            chunk.append((number, sku, row))
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+    except (UnicodeDecodeError, csv.Error) as exc:
+        # Keep what was imported so far; report where reading stopped
+        fail(number + 1, None, f"Could not read the file: {exc}")
+    if chunk:
+        flush(chunk)
+
+    if result["created"] or result["updated"]:
+        bump_catalogue_version()
+    result["errors"].sort(key=lambda error: error["row"])
+    result["failed"] = len(result["errors"])
+    return result
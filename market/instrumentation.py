@@ -0,0 +1,303 @@
+"""
+Per-view request instrumentation.
+
+``RequestInstrumentationMiddleware`` measures, for every request, the total
+latency, the number of SQL queries and the time spent in them, and the time
+spent rendering templates, and adds them to in-memory histograms labelled by
+URL name. ``render_metrics`` turns those (plus the account-lock and API
+usage counters) into the Prometheus text format served at ``/metrics/``.
+
+Queries are counted by an execute wrapper installed on every database
+connection when it is opened; it reports to the collector of the current
+request through a context variable, so queries made from ``sync_to_async``
+threads of async views are counted too. Requests slower than
+``UPBT_SLOW_REQUEST_SECONDS`` are logged to ``market.slow_requests`` with
+their queries.
+
+Counters are per process; Prometheus adds them up across processes.
+"""
+import contextvars
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+from .locking import lock_metrics
+from .ratelimit import api_usage
+
+logger = logging.getLogger("market.slow_requests")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_current = contextvars.ContextVar("upbt_request_collector", default=None)
+
+
+class RequestCollector:
+    """What one request spent; filled in by the DB and template hooks."""
+
+    def __init__(self, keep_queries):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.keep_queries = keep_queries
+        self.query_log = []
+
+    def record_query(self, sql, duration):
+        self.queries += 1
+        self.db_seconds += duration
+        if len(self.query_log) < self.keep_queries:
+            self.query_log.append((duration, sql))
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestMetrics:
+    """Thread-safe per-view histograms and request counters."""
+
+    HISTOGRAMS = {
+        "upbt_http_request_duration_seconds": (
+            "Request latency by view.",
+            LATENCY_BUCKETS,
+        ),
+        "upbt_db_queries_per_request": (
+            "SQL queries per request by view.",
+            QUERY_COUNT_BUCKETS,
+        ),
+        "upbt_db_duration_seconds": (
+            "Time spent in SQL queries per request by view.",
+            LATENCY_BUCKETS,
+        ),
+        "upbt_template_render_seconds": (
+            "Time spent rendering templates per request by view.",
+            LATENCY_BUCKETS,
+        ),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {name: {} for name in self.HISTOGRAMS}
+            self._requests = {}
+
+    def record(self, view, method, status, latency, collector):
+        values = {
+            "upbt_http_request_duration_seconds": latency,
+            "upbt_db_queries_per_request": collector.queries,
+            "upbt_db_duration_seconds": collector.db_seconds,
+            "upbt_template_render_seconds": collector.template_seconds,
+        }
+        with self._lock:
+            for name, value in values.items():
+                histogram = self._histograms[name].get(view)
+                if histogram is None:
+                    histogram = self._histograms[name][view] = Histogram(
+                        self.HISTOGRAMS[name][1]
+                    )
+                histogram.observe(value)
+            key = (view, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+    def render(self):
+        lines = [
+            "# HELP upbt_http_requests_total Requests by view, method and status.",
+            "# TYPE upbt_http_requests_total counter",
+        ]
+        with self._lock:
+            for (view, method, status), count in sorted(self._requests.items()):
+                lines.append(
+                    f'upbt_http_requests_total{{view="{_escape(view)}",method="{method}",'
+                    f'status="{status}"}} {count}'
+                )
+            for name, (help_text, buckets) in self.HISTOGRAMS.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for view, histogram in sorted(self._histograms[name].items()):
+                    label = f'view="{_escape(view)}"'
+                    cumulative = 0
+                    for bound, count in zip(buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{name}_sum{{{label}}} {histogram.sum}")
+                    lines.append(f"{name}_count{{{label}}} {histogram.count}")
+        return lines
+
+
+request_metrics = RequestMetrics()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics():
+    """All process metrics in the Prometheus text exposition format."""
+    lines = request_metrics.render()
+
+    locks = lock_metrics.snapshot()
+    for name, kind, help_text in (
+        ("acquisitions", "counter", "Account lock acquisitions."),
+        ("rows_locked", "counter", "Account rows locked."),
+        ("wait_seconds_total", "counter", "Time spent waiting for account locks."),
+        ("wait_seconds_max", "gauge", "Longest wait for account locks."),
+        ("lock_failures", "counter", "NOWAIT/SKIP LOCKED lock failures."),
+        ("retries", "counter", "Transactions retried after a retryable error."),
+        ("retries_exhausted", "counter", "Transactions that ran out of retries."),
+    ):
+        metric = f"upbt_account_lock_{name}"
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.append(f"{metric} {locks[name]}")
+
+    usage = api_usage.snapshot()
+    for name, help_text in (
+        ("requests", "Vendor API requests let through, by API key."),
+        ("throttled", "Vendor API requests rejected by the rate limit, by API key."),
+        ("quota_rejected", "Transfers rejected by the daily quota, by API key."),
+        ("transferred_tokens", "Tokens transferred, by API key."),
+    ):
+        metric = f"upbt_api_{name}_total"
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} counter")
+        for key_id, counts in sorted(usage.items()):
+            lines.append(f'{metric}{{api_key="{key_id}"}} {counts[name]}')
+
+    return "\n".join(lines) + "\n"
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    collector = _current.get()
+    if collector is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        collector.record_query(sql, time.perf_counter() - started)
+
+
+def _install_execute_wrapper(sender, connection, **kwargs):
+    # The wrapper list outlives reconnects, so only add it once
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_execute_wrapper)
+
+
+def _instrument_templates():
+    from django.template.backends.django import Template
+
+    original = Template.render
+    if getattr(original, "_upbt_instrumented", False):
+        return
+
+    @functools.wraps(original)
+    def render(self, context=None, request=None):
+        collector = _current.get()
+        if collector is None:
+            return original(self, context, request)
+        started = time.perf_counter()
+        try:
+            return original(self, context, request)
+        finally:
+            collector.template_seconds += time.perf_counter() - started
+
+    render._upbt_instrumented = True
+    Template.render = render
+
+
+def install():
+    """Hook query and template timing; called from ``MarketConfig.ready``."""
+    if not getattr(settings, "UPBT_INSTRUMENTATION", True):
+        return
+    connection_created.connect(_install_execute_wrapper, dispatch_uid="upbt_instrumentation")
+    _instrument_templates()
+
+
+class RequestInstrumentationMiddleware:
+    """Record per-view latency, query count, DB and template time."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, "UPBT_INSTRUMENTATION", True)
+        self.slow_seconds = getattr(settings, "UPBT_SLOW_REQUEST_SECONDS", None)
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        collector, token, started = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._finish(request, response, collector, started)
+        return response
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        collector, token, started = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._finish(request, response, collector, started)
+        return response
+
+    def _start(self):
+        keep = (
+            getattr(settings, "UPBT_SLOW_REQUEST_MAX_QUERIES", 100)
+            if self.slow_seconds is not None
+            else 0
+        )
+        collector = RequestCollector(keep)
+        return collector, _current.set(collector), time.perf_counter()
+
+    def _finish(self, request, response, collector, started):
+        latency = time.perf_counter() - started
+        match = request.resolver_match
+        view = match.view_name if match and match.view_name else "<unresolved>"
+        request_metrics.record(view, request.method, response.status_code, latency, collector)
+
+        if self.slow_seconds is not None and latency >= self.slow_seconds:
+            queries = "\n".join(
+                f"  {1000 * duration:8.2f} ms  {sql}" for duration, sql in collector.query_log
+            )
+            logger.warning(
+                "Slow request: %s %s (%s) took %.0f ms, %d queries in %.0f ms, "
+                "templates %.0f ms\n%s",
+                request.method,
+                request.path,
+                view,
+                1000 * latency,
+                collector.queries,
+                1000 * collector.db_seconds,
+                1000 * collector.template_seconds,
+                queries,
+            )
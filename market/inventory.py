@@ -0,0 +1,280 @@
+"""
+Product stock.
+
+``Product.stock`` is None for unlimited products. Otherwise there are two
+modes:
+
+* Plain (``stock_buckets == 0``): ``take_stock`` decrements the product
+  rows with one conditional UPDATE (``WHERE stock >= quantity``) for all
+  products of an order.
+* Buckets (``stock_buckets > 0``): the stock is spread over N
+  ``StockBucket`` rows and ``Product.stock`` only holds units not spread
+  yet. Each sale or reservation takes its units from one bucket picked at
+  random that has enough, so concurrent buyers of a limited drop rarely
+  wait on the same row. Only when no single bucket has enough are the
+  product row and all its buckets locked to respread what is left.
+
+For bucketed products, adding to the cart reserves the units
+(``reserve_stock``) for ``UPBT_STOCK_RESERVATION_SECONDS``; checkout uses
+the reservation (``claim_stock``) and ``expire_reservations`` (run by the
+command of the same name) returns the units of carts never checked out.
+
+Lock order: reservation rows, then product/bucket rows (by product id),
+then account rows.
+"""
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Q, Subquery, Sum, Value, When
+from django.utils import timezone
+
+from .models import Product, StockBucket, StockReservation
+
+# Random buckets tried before falling back to a locked respread
+BUCKET_ATTEMPTS = 2
+
+
+class OutOfStock(Exception):
+    def __init__(self, products):
+        self.products = products
+        super().__init__("Not enough stock of " + ", ".join(p.name for p in products))
+
+
+def is_limited(product):
+    return product.stock is not None
+
+
+def is_bucketed(product):
+    return product.stock is not None and product.stock_buckets > 0
+
+
+def available_stock(product):
+    """Units left right now, read from the database (None = unlimited)."""
+    stock = Product.objects.filter(pk=product.pk).values_list("stock", flat=True).first()
+    if stock is None or not product.stock_buckets:
+        return stock
+    spread = StockBucket.objects.filter(product_id=product.pk).aggregate(total=Sum("available"))
+    return stock + (spread["total"] or 0)
+
+
+def _respread(product, take=0, total=None):
+    """
+    Lock the product row and its buckets, take ``take`` units and spread the
+    rest (or ``total``) evenly over the buckets. Returns False, changing
+    nothing, if there are fewer than ``take`` units.
+    """
+    locked = Product.objects.select_for_update().only("stock", "stock_buckets").get(pk=product.pk)
+    buckets = {
+        bucket.bucket: bucket
+        for bucket in StockBucket.objects.select_for_update()
+        .filter(product_id=product.pk)
+        .order_by("bucket")
+    }
+    if total is None:
+        total = (locked.stock or 0) + sum(bucket.available for bucket in buckets.values())
+    if total < take:
+        return False
+    total -= take
+
+    count = locked.stock_buckets
+    if not count:
+        StockBucket.objects.filter(product_id=product.pk).delete()
+        Product.objects.filter(pk=product.pk).update(stock=total)
+        return True
+
+    base, extra = divmod(total, count)
+    changed, created = [], []
+    for index in range(count):
+        available = base + (1 if index < extra else 0)
+        if index in buckets:
+            buckets[index].available = available
+            changed.append(buckets[index])
+        else:
+            created.append(StockBucket(product_id=product.pk, bucket=index, available=available))
+    StockBucket.objects.bulk_update(changed, ["available"])
+    StockBucket.objects.bulk_create(created)
+    StockBucket.objects.filter(product_id=product.pk, bucket__gte=count).delete()
+    Product.objects.filter(pk=product.pk).update(stock=0)
+    return True
+
+
+def set_stock(product, total):
+    """Set a product's stock to ``total`` units (None = unlimited), in either mode."""
+    with transaction.atomic():
+        if total is None:
+            StockBucket.objects.filter(product_id=product.pk).delete()
+            Product.objects.filter(pk=product.pk).update(stock=None)
+        else:
+            _respread(product, total=total)
+
+
+def respread_stock(product):
+    """Spread a product's stock over its (new number of) buckets."""
+    with transaction.atomic():
+        _respread(product)
+
+
+def _take_plain(quantities):
+    condition = Q()
+    for product, quantity in quantities.items():
+        condition |= Q(pk=product.pk, stock__gte=quantity)
+    updated = Product.objects.filter(condition).update(
+        stock=F("stock")
+        - Case(
+            *[When(pk=product.pk, then=Value(quantity)) for product, quantity in quantities.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    )
+    return updated == len(quantities)
+
+
+def _take_from_buckets(product, quantity):
+    for _ in range(BUCKET_ATTEMPTS):
+        candidate = (
+            StockBucket.objects.filter(product_id=product.pk, available__gte=quantity)
+            .order_by("?")
+            .values("pk")[:1]
+        )
+        # Re-checked in the UPDATE: a concurrent buyer may have emptied it
+        if StockBucket.objects.filter(
+            pk=Subquery(candidate), available__gte=quantity
+        ).update(available=F("available") - quantity):
+            return True
+    return _respread(product, take=quantity)
+
+
+def take_stock(quantities):
+    """
+    Take ``{product: units}`` out of stock, all or nothing. Unlimited
+    products are skipped. Raises ``OutOfStock`` listing the products that
+    are short.
+    """
+    plain = {p: q for p, q in quantities.items() if is_limited(p) and not is_bucketed(p)}
+    bucketed = sorted((p for p in quantities if is_bucketed(p)), key=lambda p: p.pk)
+    if not plain and not bucketed:
+        return
+    try:
+        with transaction.atomic():
+            if plain and not _take_plain(plain):
+                raise OutOfStock([])
+            for product in bucketed:
+                if not _take_from_buckets(product, quantities[product]):
+                    raise OutOfStock([])
+    except OutOfStock:
+        short = [
+            product
+            for product, quantity in quantities.items()
+            if is_limited(product) and (available_stock(product) or 0) < quantity
+        ]
+        raise OutOfStock(short or [p for p in quantities if is_limited(p)])
+
+
+def _return_stock(product, units):
+    if units <= 0:
+        return
+    if product.stock_buckets:
+        bucket = random.randrange(product.stock_buckets)
+        if StockBucket.objects.filter(product_id=product.pk, bucket=bucket).update(
+            available=F("available") + units
+        ):
+            return
+    # No such bucket (yet, or any more): back to the product row
+    Product.objects.filter(pk=product.pk, stock__isnull=False).update(stock=F("stock") + units)
+
+
+def reservation_expiry():
+    return timezone.now() + timedelta(
+        seconds=getattr(settings, "UPBT_STOCK_RESERVATION_SECONDS", 15 * 60)
+    )
+
+
+def reserve_stock(user, product, quantity):
+    """
+    Hold ``quantity`` more units of a bucketed product for ``user``'s cart
+    and restart the hold's timer. Does nothing for other products. Raises
+    ``OutOfStock``.
+    """
+    if not is_bucketed(product):
+        return
+    with transaction.atomic():
+        expires_at = reservation_expiry()
+        reservations = StockReservation.objects.filter(user=user, product=product)
+        if not reservations.update(quantity=F("quantity") + quantity, expires_at=expires_at):
+            try:
+                with transaction.atomic():
+                    StockReservation.objects.create(
+                        user=user, product=product, quantity=quantity, expires_at=expires_at
+                    )
+            except IntegrityError:
+                # Created concurrently from another tab
+                reservations.update(quantity=F("quantity") + quantity, expires_at=expires_at)
+        take_stock({product: quantity})
+
+
+def release_stock(user, product, quantity=None):
+    """Give back ``quantity`` (default: all) of the units held for ``user``."""
+    with transaction.atomic():
+        reservation = (
+            StockReservation.objects.select_for_update()
+            .filter(user=user, product=product)
+            .first()
+        )
+        if reservation is None:
+            return
+        units = reservation.quantity if quantity is None else min(quantity, reservation.quantity)
+        if units == reservation.quantity:
+            reservation.delete()
+        else:
+            StockReservation.objects.filter(pk=reservation.pk).update(
+                quantity=F("quantity") - units
+            )
+        _return_stock(product, units)
+
+
+def claim_stock(user, quantities):
+    """
+    Checkout: take ``{product: units}`` out of stock, using up whatever
+    ``user`` has reserved first (extra reserved units go back). Raises
+    ``OutOfStock``; nothing changes then.
+    """
+    with transaction.atomic():
+        reservations = {
+            reservation.product_id: reservation
+            for reservation in StockReservation.objects.select_for_update().filter(
+                user=user, product__in=[p for p in quantities if is_bucketed(p)]
+            )
+        }
+        missing = {}
+        for product, quantity in quantities.items():
+            held = reservations[product.pk].quantity if product.pk in reservations else 0
+            if held < quantity:
+                missing[product] = quantity - held
+            else:
+                _return_stock(product, held - quantity)
+        take_stock(missing)
+        if reservations:
+            StockReservation.objects.filter(
+                pk__in=[reservation.pk for reservation in reservations.values()]
+            ).delete()
+
+
+def expire_reservations(limit=500):
+    """Return the units of up to ``limit`` expired reservations; returns how many."""
+    with transaction.atomic():
+        expired = list(
+            StockReservation.objects.select_for_update(skip_locked=True, of=("self",))
+            .select_related("product")
+            .filter(expires_at__lte=timezone.now())
+            .order_by("product_id", "pk")[:limit]
+        )
+        units = {}
+        for reservation in expired:
+            product = reservation.product
+            units[product] = units.get(product, 0) + reservation.quantity
+        for product, count in units.items():
+            _return_stock(product, count)
+        StockReservation.objects.filter(pk__in=[r.pk for r in expired]).delete()
+    return len(expired)
@@ -0,0 +1,181 @@
+"""
+Append-only ledger helpers.
+
+Every money movement writes one ``LedgerEntry`` per account it touches, in
+the same transaction as the movement itself. Historical balances are then
+``nearest snapshot + sum(entries after it)``, so the cost of a statement or
+audit is bounded by the snapshot interval rather than the account's age.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from .models import BalanceSnapshot, LedgerEntry
+
+
+def _purchase_entries(purchase, vendor=None):
+    entries = [
+        LedgerEntry(
+            user_id=purchase.user_id,
+            kind=LedgerEntry.KIND_PURCHASE,
+            amount_tokens=-purchase.total_tokens,
+            description=f"{purchase.quantity} x {purchase.product.name}",
+            purchase=purchase,
+            created_at=purchase.created_at,
+        )
+    ]
+    if vendor is not None:
+        entries.append(
+            LedgerEntry(
+                user_id=vendor.pk,
+                kind=LedgerEntry.KIND_SALE,
+                amount_tokens=purchase.total_tokens,
+                description=f"{purchase.quantity} x {purchase.product.name}",
+                purchase=purchase,
+                created_at=purchase.created_at,
+            )
+        )
+    return entries
+
+
+def record_purchase(purchase, vendor=None):
+    """Debit the buyer and, if the product has a vendor account, credit it."""
+    return LedgerEntry.objects.bulk_create(_purchase_entries(purchase, vendor))
+
+
+def record_purchases(purchases, vendors):
+    """
+    ``record_purchase`` for many purchases in one INSERT; ``vendors`` maps
+    each purchase's vendor id to the vendor to credit (missing: no credit).
+    """
+    entries = []
+    for purchase in purchases:
+        entries.extend(_purchase_entries(purchase, vendors.get(purchase.vendor_id)))
+    return LedgerEntry.objects.bulk_create(entries)
+
+
+def record_topup(topup):
+    return LedgerEntry.objects.create(
+        user_id=topup.user_id,
+        kind=LedgerEntry.KIND_TOPUP,
+        amount_tokens=topup.amount_tokens,
+        description=topup.description,
+        topup=topup,
+        created_at=topup.created_at,
+    )
+
+
+def record_transfers(transfers):
+    """Write the outgoing and incoming entries for any number of transfers."""
+    entries = []
+    for transfer in transfers:
+        entries.append(
+            LedgerEntry(
+                user_id=transfer.from_user_id,
+                kind=LedgerEntry.KIND_TRANSFER_OUT,
+                amount_tokens=-transfer.amount_tokens,
+                description=transfer.description,
+                transfer=transfer,
+                created_at=transfer.created_at,
+            )
+        )
+        entries.append(
+            LedgerEntry(
+                user_id=transfer.to_user_id,
+                kind=LedgerEntry.KIND_TRANSFER_IN,
+                amount_tokens=transfer.amount_tokens,
+                description=transfer.description,
+                transfer=transfer,
+                created_at=transfer.created_at,
+            )
+        )
+    return LedgerEntry.objects.bulk_create(entries)
+
+
+def nearest_snapshot(user, when=None):
+    """Latest snapshot taken at or before ``when`` (or overall), or None."""
+    snapshots = BalanceSnapshot.objects.filter(user=user)
+    if when is not None:
+        snapshots = snapshots.filter(as_of__lte=when)
+    return snapshots.order_by("-last_entry_id").first()
+
+
+def balance_at(user, when=None):
+    """
+    Balance of ``user`` at ``when`` (default: now), computed from the nearest
+    snapshot plus the entries recorded after it.
+    """
+    snapshot = nearest_snapshot(user, when)
+    entries = LedgerEntry.objects.filter(user=user)
+    base = 0
+    if snapshot is not None:
+        entries = entries.filter(id__gt=snapshot.last_entry_id)
+        base = snapshot.balance
+    if when is not None:
+        entries = entries.filter(created_at__lte=when)
+    return base + (entries.aggregate(total=Sum("amount_tokens"))["total"] or 0)
+
+
+def statement(user, start, end=None):
+    """
+    Return ``(opening_balance, entries)`` for movements in ``(start, end]``.
+    """
+    opening = balance_at(user, start)
+    entries = LedgerEntry.objects.filter(user=user, created_at__gt=start)
+    if end is not None:
+        entries = entries.filter(created_at__lte=end)
+    return opening, entries.order_by("created_at", "id")
+
+
+def snapshot_account(user_id, cutoff, min_entries=1):
+    """
+    Snapshot one account up to the entry before its first one created at or
+    after ``cutoff``, if at least ``min_entries`` entries happened since its
+    previous snapshot. Returns the new snapshot or None.
+
+    Ids and ``created_at`` don't always agree, so the watermark stops short
+    of the first late entry: every entry up to it is in the sum, and none
+    after it is skipped by the next snapshot.
+    """
+    previous = (
+        BalanceSnapshot.objects.filter(user_id=user_id)
+        .order_by("-last_entry_id")
+        .first()
+    )
+    entries = LedgerEntry.objects.filter(user_id=user_id)
+    base = 0
+    if previous is not None:
+        entries = entries.filter(id__gt=previous.last_entry_id)
+        base = previous.balance
+
+    first_late = (
+        entries.filter(created_at__gte=cutoff)
+        .order_by("id")
+        .values_list("id", flat=True)
+        .first()
+    )
+    if first_late is not None:
+        entries = entries.filter(id__lt=first_late)
+    totals = entries.aggregate(
+        last=Max("id"), as_of=Max("created_at"), count=Count("id"), total=Sum("amount_tokens")
+    )
+    if totals["last"] is None or totals["count"] < min_entries:
+        return None
+
+    return BalanceSnapshot.objects.create(
+        user_id=user_id,
+        last_entry_id=totals["last"],
+        as_of=totals["as_of"],
+        balance=base + (totals["total"] or 0),
+    )
+
+
+def snapshot_cutoff():
+    """
+    Only entries older than this are snapshotted: concurrent transactions may
+    commit ids out of order, so we leave a settling window behind "now".
+    """
+    lag = getattr(settings, "UPBT_LEDGER_SNAPSHOT_LAG_SECONDS", 300)
+    return timezone.now() - timedelta(seconds=lag)
@@ -0,0 +1,218 @@
+"""
+Account locking service.
+
+Every code path that moves tokens between accounts takes its row locks in
+one global order: by ``user_id``, the account's unique key. ``lock_accounts``
+takes all rows in a single ``SELECT ... FOR UPDATE`` in that order, and
+``move_tokens`` applies single-statement debits/credits in that order, so two
+opposite transfers between the same users can no longer deadlock. ``atomic_with_retry`` wraps a
+view in a transaction and retries it on serialization failures, deadlocks and
+lock timeouts. Counters are kept in ``lock_metrics`` for monitoring.
+"""
+import functools
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connection, transaction
+
+from .models import UserTokenAccount
+
+# PostgreSQL SQLSTATEs worth retrying the whole transaction for
+RETRYABLE_SQLSTATES = {
+    "40001",  # serialization_failure
+    "40P01",  # deadlock_detected
+    "55P03",  # lock_not_available (NOWAIT)
+}
+
+
+class AccountLockError(Exception):
+    """Raised when ``nowait``/``skip_locked`` could not take every account."""
+
+
+class InsufficientFunds(Exception):
+    """The account to debit doesn't have enough tokens."""
+
+
+class LockMetrics:
+    """Thread-safe counters describing account lock contention."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.acquisitions = 0
+            self.rows_locked = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+            self.lock_failures = 0
+            self.retries = 0
+            self.retries_exhausted = 0
+
+    def record_acquisition(self, rows, waited):
+        with self._lock:
+            self.acquisitions += 1
+            self.rows_locked += rows
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def record_lock_failure(self):
+        with self._lock:
+            self.lock_failures += 1
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def record_retries_exhausted(self):
+        with self._lock:
+            self.retries_exhausted += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "acquisitions": self.acquisitions,
+                "rows_locked": self.rows_locked,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+                "lock_failures": self.lock_failures,
+                "retries": self.retries,
+                "retries_exhausted": self.retries_exhausted,
+            }
+
+
+lock_metrics = LockMetrics()
+
+
+def lock_accounts(user_ids, nowait=None, skip_locked=None):
+    """
+    Lock the ``UserTokenAccount`` rows of ``user_ids`` with one query, in
+    user id order, and return them as ``{user_id: account}``.
+
+    Users without an account are simply absent from the result. ``nowait``
+    and ``skip_locked`` default to the ``UPBT_ACCOUNT_LOCK_*`` settings; if
+    either prevents us from taking every existing row, ``AccountLockError``
+    is raised (and retried by ``atomic_with_retry``).
+    """
+    if nowait is None:
+        nowait = getattr(settings, "UPBT_ACCOUNT_LOCK_NOWAIT", False)
+    if skip_locked is None:
+        skip_locked = getattr(settings, "UPBT_ACCOUNT_LOCK_SKIP_LOCKED", False)
+    features = connection.features
+    nowait = nowait and features.has_select_for_update_nowait
+    # The two options are mutually exclusive; NOWAIT wins
+    skip_locked = (
+        skip_locked and not nowait and features.has_select_for_update_skip_locked
+    )
+
+    user_ids = set(user_ids)
+    started = time.monotonic()
+    try:
+        accounts = {
+            account.user_id: account
+            for account in UserTokenAccount.objects.select_for_update(
+                nowait=nowait,
+                skip_locked=skip_locked,
+            )
+            .filter(user_id__in=user_ids)
+            .order_by("user_id")
+        }
+    except OperationalError:
+        lock_metrics.record_lock_failure()
+        raise
+    waited = time.monotonic() - started
+
+    if skip_locked and len(accounts) < len(user_ids):
+        # Tell "locked by someone else" apart from "has no account"
+        missing = user_ids - accounts.keys()
+        if UserTokenAccount.objects.filter(user_id__in=missing).exists():
+            lock_metrics.record_lock_failure()
+            raise AccountLockError("Some accounts are locked by another transaction")
+
+    lock_metrics.record_acquisition(len(accounts), waited)
+    return accounts
+
+
+def move_tokens(from_user_id, to_user_id, amount, purchase=False):
+    """
+    Debit ``from_user_id`` and credit ``to_user_id`` with one conditional
+    UPDATE each, issued in user id order. Returns the two new balances.
+
+    Raises ``InsufficientFunds`` (leaving both accounts untouched) if the
+    debit fails, and ``UserTokenAccount.DoesNotExist`` if the recipient has
+    no account. ``purchase`` is passed on to ``debit``.
+    """
+    started = time.monotonic()
+    balances = {}
+    movements = sorted([(from_user_id, -amount), (to_user_id, amount)])
+    # Savepoint: if the debit comes second, the credit must be undone
+    with transaction.atomic():
+        for user_id, delta in movements:
+            if delta < 0:
+                balance = UserTokenAccount.objects.debit(
+                    user_id, -delta, purchase=purchase
+                )
+                if balance is None:
+                    raise InsufficientFunds()
+            else:
+                balance = UserTokenAccount.objects.credit(user_id, delta)
+                if balance is None:
+                    raise UserTokenAccount.DoesNotExist()
+            balances[user_id] = balance
+    lock_metrics.record_acquisition(len(balances), time.monotonic() - started)
+    # For a self-transfer both entries are the same (final) balance
+    return balances[from_user_id], balances[to_user_id]
+
+
+def is_retryable_error(exc):
+    if isinstance(exc, AccountLockError):
+        return True
+    if not isinstance(exc, OperationalError):
+        return False
+    cause = exc.__cause__
+    sqlstate = getattr(cause, "pgcode", None) or getattr(cause, "sqlstate", None)
+    if sqlstate in RETRYABLE_SQLSTATES:
+        return True
+    # SQLite reports lock contention as a plain OperationalError
+    return "database is locked" in str(exc)
+
+
+def atomic_with_retry(func=None, *, attempts=None):
+    """
+    Like ``transaction.atomic`` but re-runs the whole function when the
+    transaction fails for a retryable reason (see ``is_retryable_error``).
+    Retrying is only possible at the outermost transaction; inside an
+    existing atomic block the function just runs in a savepoint.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            max_attempts = attempts or getattr(settings, "UPBT_ACCOUNT_LOCK_RETRIES", 3)
+            if connection.in_atomic_block:
+                with transaction.atomic():
+                    return view(*args, **kwargs)
+
+            backoff = getattr(settings, "UPBT_ACCOUNT_LOCK_RETRY_BACKOFF", 0.05)
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    with transaction.atomic():
+                        return view(*args, **kwargs)
+                except Exception as exc:
+                    if not is_retryable_error(exc):
+                        raise
+                    if attempt == max_attempts:
+                        lock_metrics.record_retries_exhausted()
+                        raise
+                    lock_metrics.record_retry()
+                    # Jittered exponential backoff so retries don't collide again
+                    time.sleep(backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
@@ -0,0 +1,468 @@
+"""
+Load test for the purchase and transfer hot paths.
+
+Seeds ``bench-*`` buyers, vendors, products and API keys, then has
+``--processes`` x ``--threads`` workers drive ``buy_product`` and
+``api_transfer_tokens`` through the full Django stack (middleware included)
+with the test client. Reports latency percentiles, throughput, lock retries
+and a final check that no tokens were created or lost, and optionally writes
+everything as JSON for comparing commits.
+
+The requests never leave the process, so the figures are view + database
+time: they compare commits, not deployments. Point an HTTP load tool at a
+real server to measure server throughput.
+
+By default everything runs in a temporary database (created like the test
+database, and dropped afterwards). ``--use-configured-database`` runs against
+the configured one instead, reusing the ``bench-*`` rows and API keys of
+earlier runs. Set ``UPBT_POSTGRES_DB`` (see settings) to benchmark
+PostgreSQL.
+"""
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.db.models import Sum
+from django.test import Client
+from django.urls import reverse
+
+from market import ledger
+from market.locking import lock_metrics
+from market.models import (
+    LedgerEntry,
+    Product,
+    TokenTopUp,
+    UserTokenAccount,
+    VendorAPIKey,
+    VendorCreditShard,
+    generate_api_key,
+    hash_api_key,
+)
+
+PREFIX = "bench-"
+OPS = ("purchase", "transfer")
+
+
+def _percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def _init_process(database_name):
+    django.setup()
+    # Spawned (not forked) workers must also use the benchmark database
+    settings.DATABASES["default"]["NAME"] = database_name
+    connections["default"].settings_dict["NAME"] = database_name
+
+
+def _run_thread(plan, seed):
+    rng = random.Random(seed)
+    host = plan["host"]
+    api_client = Client(HTTP_HOST=host)
+    buyer_clients = {}
+    dashboard_url = reverse("dashboard")
+    samples = []
+
+    for _ in range(plan["operations"]):
+        op = "purchase" if rng.random() < plan["purchase_ratio"] else "transfer"
+        started = time.perf_counter()
+        try:
+            if op == "purchase":
+                buyer_id = rng.choice(plan["buyer_ids"])
+                client = buyer_clients.get(buyer_id)
+                if client is None:
+                    client = buyer_clients[buyer_id] = Client(HTTP_HOST=host)
+                    client.force_login(User.objects.get(pk=buyer_id))
+                response = client.post(
+                    reverse("buy_product", args=[rng.choice(plan["product_ids"])]),
+                    {"quantity": 1},
+                )
+                ok = response.status_code == 302 and response["Location"] == dashboard_url
+                outcome = "ok" if ok else "rejected"
+            else:
+                raw_key = rng.choice(plan["api_keys"])
+                response = api_client.post(
+                    reverse("api_transfer_tokens"),
+                    json.dumps(
+                        {
+                            "recipient_username": rng.choice(plan["recipients"]),
+                            "amount_tokens": rng.randint(1, plan["max_transfer"]),
+                        }
+                    ),
+                    content_type="application/json",
+                    HTTP_X_API_KEY=raw_key,
+                )
+                if response.status_code == 201:
+                    outcome = "ok"
+                elif response.status_code < 500:
+                    outcome = "rejected"
+                else:
+                    outcome = "error"
+        except Exception as e:
+            outcome = f"error:{e.__class__.__name__}"
+        samples.append((op, time.perf_counter() - started, outcome))
+
+    connections.close_all()
+    return samples
+
+
+def _run_worker(plan, seed):
+    """One process: run ``plan["threads"]`` client threads, return samples + lock counters."""
+    lock_metrics.reset()
+    with ThreadPoolExecutor(max_workers=plan["threads"]) as pool:
+        futures = [
+            pool.submit(_run_thread, plan, seed * 1000 + index)
+            for index in range(plan["threads"])
+        ]
+        samples = [sample for future in futures for sample in future.result()]
+    return samples, lock_metrics.snapshot()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark buy_product and api_transfer_tokens under concurrency and "
+        "check that balances are conserved. Runs in a temporary database "
+        "unless --use-configured-database is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--buyers", type=int, default=50)
+        parser.add_argument("--vendors", type=int, default=5)
+        parser.add_argument("--products-per-vendor", type=int, default=4)
+        parser.add_argument("--processes", type=int, default=1)
+        parser.add_argument("--threads", type=int, default=8, help="Threads per process.")
+        parser.add_argument(
+            "--operations", type=int, default=200, help="Requests per thread."
+        )
+        parser.add_argument(
+            "--purchase-ratio",
+            type=float,
+            default=0.7,
+            help="Share of purchases among operations; the rest are transfers.",
+        )
+        parser.add_argument(
+            "--sharded-vendors",
+            type=int,
+            default=0,
+            help="Give this many vendors credit shards (see market/credits.py).",
+        )
+        parser.add_argument("--balance", type=int, default=1_000_000, help="Seed balance.")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+        parser.add_argument("--host", default=None, help="Host header for requests.")
+        parser.add_argument("--output", default=None, help="Write the results as JSON here.")
+        parser.add_argument(
+            "--use-configured-database",
+            action="store_true",
+            help=(
+                "Seed and run in the configured database instead of a temporary "
+                "one; bench-* rows stay there unless --cleanup is given."
+            ),
+        )
+        parser.add_argument(
+            "--cleanup",
+            action="store_true",
+            help="With --use-configured-database: delete the bench-* users afterwards.",
+        )
+
+    def handle(self, *args, **options):
+        if not 0 <= options["purchase_ratio"] <= 1:
+            raise CommandError("--purchase-ratio must be between 0 and 1")
+        if options["buyers"] < 2 or options["vendors"] < 1 or options["products_per_vendor"] < 1:
+            raise CommandError("Need at least 2 buyers, 1 vendor and 1 product per vendor")
+        if options["cleanup"] and not options["use_configured_database"]:
+            raise CommandError("--cleanup only applies with --use-configured-database")
+
+        if options["use_configured_database"]:
+            return self.run(options)
+
+        original_name = connection.settings_dict["NAME"]
+        test_settings = connection.settings_dict.setdefault("TEST", {})
+        scratch = None
+        if connection.vendor == "sqlite":
+            # A file, not the in-memory default: worker processes share it
+            scratch = tempfile.mkdtemp(prefix="upbt-benchmark-")
+            test_settings["NAME"] = os.path.join(scratch, "benchmark.sqlite3")
+        else:
+            test_settings["NAME"] = f"{original_name}_benchmark"
+        self.stdout.write("Creating a temporary database...")
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.run(options)
+        finally:
+            connection.creation.destroy_test_db(original_name, verbosity=0)
+            if scratch:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+    def run(self, options):
+        plan = self.seed(options)
+        before = self.total_balance()
+
+        total_threads = options["processes"] * options["threads"]
+        self.stdout.write(
+            f"Running {total_threads} clients x {options['operations']} operations "
+            f"on {connection.vendor}..."
+        )
+        # Child processes must open their own connections
+        connections.close_all()
+        started = time.perf_counter()
+        if options["processes"] > 1:
+            with ProcessPoolExecutor(
+                max_workers=options["processes"],
+                initializer=_init_process,
+                initargs=(connection.settings_dict["NAME"],),
+            ) as pool:
+                results = list(
+                    pool.map(
+                        _run_worker,
+                        [plan] * options["processes"],
+                        [options["seed"] + index for index in range(options["processes"])],
+                    )
+                )
+        else:
+            results = [_run_worker(plan, options["seed"])]
+        elapsed = time.perf_counter() - started
+
+        samples = [sample for worker_samples, _ in results for sample in worker_samples]
+        locks = {}
+        for _, snapshot in results:
+            for name, value in snapshot.items():
+                if name == "wait_seconds_max":
+                    locks[name] = max(locks.get(name, 0), value)
+                else:
+                    locks[name] = locks.get(name, 0) + value
+
+        after = self.total_balance()
+        report = {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "commit": self.git_commit(),
+            "database": connection.vendor,
+            "client": "in-process test client",
+            "python": platform.python_version(),
+            "options": {
+                name: options[name]
+                for name in (
+                    "buyers",
+                    "vendors",
+                    "products_per_vendor",
+                    "processes",
+                    "threads",
+                    "operations",
+                    "purchase_ratio",
+                    "sharded_vendors",
+                    "seed",
+                )
+            },
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_ops_per_second": round(len(samples) / elapsed, 1) if elapsed else None,
+            "operations": self.summarize(samples),
+            "locks": locks,
+            "conservation": {
+                "balance_before": before,
+                "balance_after": after,
+                "conserved": before == after,
+                "ledger_mismatches": self.ledger_mismatches(),
+                "negative_balances": UserTokenAccount.objects.filter(
+                    user__username__startswith=PREFIX, token_balance__lt=0
+                ).count(),
+            },
+        }
+
+        self.print_report(report)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        VendorAPIKey.objects.filter(key_hash__in=plan["key_hashes"]).update(is_active=False)
+        if options["cleanup"]:
+            User.objects.filter(username__startswith=PREFIX).delete()
+        if not report["conservation"]["conserved"] or report["conservation"]["ledger_mismatches"]:
+            raise CommandError("Balance conservation check failed")
+
+    @transaction.atomic
+    def seed(self, options):
+        """Create (or reuse) the bench-* accounts and return the worker plan."""
+        names = [f"{PREFIX}buyer-{i}" for i in range(options["buyers"])]
+        names += [f"{PREFIX}vendor-{i}" for i in range(options["vendors"])]
+        existing = set(User.objects.filter(username__in=names).values_list("username", flat=True))
+        new_users = []
+        for name in names:
+            if name not in existing:
+                user = User(username=name)
+                user.set_unusable_password()
+                new_users.append(user)
+        User.objects.bulk_create(new_users)
+
+        users = {user.username: user for user in User.objects.filter(username__in=names)}
+        # bulk_create skips the post_save signal that creates accounts
+        UserTokenAccount.objects.bulk_create(
+            [UserTokenAccount(user=user) for user in users.values()],
+            ignore_conflicts=True,
+        )
+        # Fund every account through the normal top-up path so the ledger matches
+        for user in users.values():
+            account = UserTokenAccount.objects.get(user=user)
+            missing = options["balance"] - account.token_balance
+            if missing > 0:
+                UserTokenAccount.objects.credit(user.pk, missing)
+                ledger.record_topup(
+                    TokenTopUp.objects.create(
+                        user=user, amount_tokens=missing, description="Benchmark seed"
+                    )
+                )
+
+        vendors = [users[f"{PREFIX}vendor-{i}"] for i in range(options["vendors"])]
+        for index, vendor in enumerate(vendors):
+            UserTokenAccount.objects.filter(user=vendor).update(
+                credit_shards=8 if index < options["sharded_vendors"] else 0
+            )
+            for p in range(options["products_per_vendor"]):
+                Product.objects.get_or_create(
+                    owner=vendor,
+                    name=f"{PREFIX}product-{index}-{p}",
+                    defaults={"price_tokens": random.randint(1, 50), "active": True},
+                )
+
+        # One key per vendor, reused across runs with a fresh secret
+        keys = []
+        for vendor in vendors:
+            key = VendorAPIKey.objects.filter(vendor=vendor, name="benchmark").first()
+            if key is None:
+                key = VendorAPIKey(vendor=vendor, name="benchmark")
+            key.raw_key = generate_api_key()
+            key.key_hash = hash_api_key(key.raw_key)
+            key.key_prefix = key.raw_key[:8]
+            key.is_active = True
+            # Measure the transfer path, not the throttle
+            key.rate_limit_per_minute = 2_000_000_000
+            key.rate_limit_burst = 2_000_000_000
+            key.save()
+            keys.append(key)
+
+        return {
+            "host": options["host"] or next(
+                (h for h in settings.ALLOWED_HOSTS if h != "*" and not h.startswith(".")),
+                "localhost",
+            ),
+            "threads": options["threads"],
+            "operations": options["operations"],
+            "purchase_ratio": options["purchase_ratio"],
+            "max_transfer": 20,
+            "buyer_ids": [users[f"{PREFIX}buyer-{i}"].pk for i in range(options["buyers"])],
+            "recipients": [f"{PREFIX}buyer-{i}" for i in range(options["buyers"])],
+            "product_ids": list(
+                Product.objects.filter(owner__in=vendors, active=True).values_list("pk", flat=True)
+            ),
+            "api_keys": [key.raw_key for key in keys],
+            "key_hashes": [key.key_hash for key in keys],
+        }
+
+    def total_balance(self):
+        """Spendable plus pending-shard tokens of every bench account."""
+        spendable = UserTokenAccount.objects.filter(
+            user__username__startswith=PREFIX
+        ).aggregate(total=Sum("token_balance"))["total"] or 0
+        pending = VendorCreditShard.objects.filter(
+            user__username__startswith=PREFIX
+        ).aggregate(total=Sum("pending_tokens"))["total"] or 0
+        return spendable + pending
+
+    def ledger_mismatches(self):
+        """Bench accounts whose ledger doesn't add up to their balance."""
+        ledger_totals = dict(
+            LedgerEntry.objects.filter(user__username__startswith=PREFIX)
+            .values("user_id")
+            .annotate(total=Sum("amount_tokens"))
+            .values_list("user_id", "total")
+        )
+        pending = dict(
+            VendorCreditShard.objects.filter(user__username__startswith=PREFIX)
+            .values("user_id")
+            .annotate(total=Sum("pending_tokens"))
+            .values_list("user_id", "total")
+        )
+        mismatches = 0
+        for user_id, balance in UserTokenAccount.objects.filter(
+            user__username__startswith=PREFIX
+        ).values_list("user_id", "token_balance"):
+            if ledger_totals.get(user_id, 0) != balance + pending.get(user_id, 0):
+                mismatches += 1
+        return mismatches
+
+    def summarize(self, samples):
+        summary = {}
+        for op in OPS:
+            latencies = sorted(latency for name, latency, _ in samples if name == op)
+            outcomes = {}
+            for name, _, outcome in samples:
+                if name == op:
+                    outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            summary[op] = {
+                "count": len(latencies),
+                "outcomes": outcomes,
+                "latency_ms": {
+                    "mean": round(1000 * sum(latencies) / len(latencies), 3) if latencies else None,
+                    **{
+                        f"p{pct}": (
+                            round(1000 * _percentile(latencies, pct), 3) if latencies else None
+                        )
+                        for pct in (50, 95, 99)
+                    },
+                    "max": round(1000 * latencies[-1], 3) if latencies else None,
+                },
+            }
+        return summary
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=settings.BASE_DIR,
+                capture_output=True,
+                text=True,
+                timeout=5,
+            ).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    def print_report(self, report):
+        self.stdout.write(
+            f"{report['elapsed_seconds']}s, {report['throughput_ops_per_second']} ops/s "
+            f"({report['client']}, not server throughput)"
+        )
+        for op, data in report["operations"].items():
+            latency = data["latency_ms"]
+            self.stdout.write(
+                f"  {op:<9} n={data['count']:<6} p50={latency['p50']}ms "
+                f"p95={latency['p95']}ms p99={latency['p99']}ms outcomes={data['outcomes']}"
+            )
+        locks = report["locks"]
+        self.stdout.write(
+            f"  locks: retries={locks.get('retries', 0)} "
+            f"exhausted={locks.get('retries_exhausted', 0)} "
+            f"failures={locks.get('lock_failures', 0)}"
+        )
+        conservation = report["conservation"]
+        style = self.style.SUCCESS if conservation["conserved"] else self.style.ERROR
+        self.stdout.write(
+            style(
+                f"  conservation: before={conservation['balance_before']} "
+                f"after={conservation['balance_after']} "
+                f"ledger_mismatches={conservation['ledger_mismatches']}"
+            )
+        )
@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from market.webhooks import (
+    WebhookClient,
+    aprocess_due_deliveries,
+    async_client,
+    process_due_deliveries,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Deliver pending webhook events from the outbox, retrying failures "
+        "with exponential backoff until they are delivered or dead-lettered."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Drain the currently due deliveries and exit.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="How many deliveries to claim per round (default: 100).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Concurrent HTTP requests per round (default: 8).",
+        )
+        parser.add_argument(
+            "--async",
+            action="store_true",
+            dest="use_async",
+            help=(
+                "Send from one event loop over a pooled httpx client; --workers "
+                "then sets how many requests may be in flight."
+            ),
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=2.0,
+            help="Seconds to sleep when there is nothing to deliver (default: 2).",
+        )
+
+    def handle(self, *args, **options):
+        if options["use_async"]:
+            asyncio.run(self.handle_async(options))
+            return
+
+        # One client for the whole run, so connections to vendors are reused
+        with WebhookClient(max_workers=options["workers"]) as client:
+            while True:
+                delivered, failed = process_due_deliveries(
+                    batch_size=options["batch_size"],
+                    client=client,
+                )
+                if delivered or failed:
+                    self.stdout.write(f"Delivered {delivered}, failed {failed}")
+                    continue
+                if options["once"]:
+                    break
+                time.sleep(options["interval"])
+
+    async def handle_async(self, options):
+        # One client for the whole run, so connections to vendors are reused
+        async with async_client(max_connections=options["workers"]) as client:
+            while True:
+                delivered, failed = await aprocess_due_deliveries(
+                    client,
+                    batch_size=options["batch_size"],
+                    concurrency=options["workers"],
+                )
+                if delivered or failed:
+                    self.stdout.write(f"Delivered {delivered}, failed {failed}")
+                    continue
+                if options["once"]:
+                    break
+                await asyncio.sleep(options["interval"])
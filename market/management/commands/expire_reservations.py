@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from market.inventory import expire_reservations
+
+
+class Command(BaseCommand):
+    help = "Return the stock held by expired cart reservations."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Reservations expired per transaction (default: 500).",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Keep running, sweeping every N seconds (default: run once).",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            expired = 0
+            while True:
+                count = expire_reservations(options["batch_size"])
+                expired += count
+                if count < options["batch_size"]:
+                    break
+            if expired:
+                self.stdout.write(f"Expired {expired} reservations")
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from market.credits import fold_credit_shards, vendors_with_pending_credits
+
+
+class Command(BaseCommand):
+    help = "Fold pending sharded vendor credits into the vendors' token balances."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0,
+            help="Keep running, folding every N seconds (default: run once).",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            folded = vendors = 0
+            for row in vendors_with_pending_credits():
+                folded += fold_credit_shards(row["user_id"])
+                vendors += 1
+            if folded:
+                self.stdout.write(f"Folded {folded} UPBT for {vendors} vendors")
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
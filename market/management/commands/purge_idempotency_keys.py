@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from market.models import IdempotencyRecord
+
+
+class Command(BaseCommand):
+    help = "Delete stored idempotency-key responses older than the retention window."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hours",
+            type=int,
+            default=getattr(settings, "UPBT_IDEMPOTENCY_KEY_TTL_HOURS", 24),
+            help="Keep records newer than this many hours.",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options["hours"])
+        deleted, _ = IdempotencyRecord.objects.filter(created_at__lt=cutoff).delete()
+        self.stdout.write(f"Deleted {deleted} idempotency records.")
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from market.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the hourly/daily vendor sales rollups from the purchase "
+        "table. Run it while purchases are paused."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--vendor",
+            type=int,
+            help="Only rebuild this vendor's rollups (user id).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Rows inserted per statement (default: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        written = rebuild_rollups(options["vendor"], options["batch_size"])
+        self.stdout.write(f"Wrote {written} rollup rows.")
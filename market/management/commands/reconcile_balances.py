@@ -0,0 +1,107 @@
+"""
+Check every account's balance against its history.
+
+Accounts are split into user id ranges of ``--chunk-size`` accounts and
+reconciled by ``--workers`` processes (see market/reconcile.py). Each run
+only aggregates the movements recorded since the previous one; ``--full``
+recounts everything.
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from market.ledger import snapshot_cutoff
+from market.reconcile import (
+    account_chunks,
+    baseline,
+    reconcile_chunk,
+    reset_reconciliations,
+    watermarks,
+)
+
+
+def _init_process():
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = (
+        "Check that every account's balance equals its opening balance plus "
+        "top-ups, sales and incoming transfers minus purchases and outgoing "
+        "transfers, and report the accounts that drift."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Recount every account's whole history instead of the new movements.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=getattr(settings, "UPBT_RECONCILE_WORKERS", 4),
+            help="Worker processes reconciling chunks in parallel (1: no subprocesses).",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=getattr(settings, "UPBT_RECONCILE_CHUNK_SIZE", 1000),
+            help="Accounts per chunk.",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1 or options["chunk_size"] < 1:
+            raise CommandError("--workers and --chunk-size must be at least 1")
+        if options["full"]:
+            self.stdout.write(f"Cleared the sums of {reset_reconciliations()} accounts.")
+
+        marks = watermarks(snapshot_cutoff())
+        start = baseline()
+        chunks = list(account_chunks(options["chunk_size"]))
+
+        if options["workers"] > 1 and len(chunks) > 1:
+            # Child processes must open their own connections
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=options["workers"], initializer=_init_process
+            ) as pool:
+                results = list(
+                    pool.map(
+                        reconcile_chunk,
+                        [first for first, _ in chunks],
+                        [last for _, last in chunks],
+                        [marks] * len(chunks),
+                        [start] * len(chunks),
+                    )
+                )
+        else:
+            results = [reconcile_chunk(first, last, marks, start) for first, last in chunks]
+
+        checked = sum(count for count, _ in results)
+        drifts = sorted(
+            (report for _, reports in results for report in reports),
+            key=lambda report: report["user_id"],
+        )
+        self.stdout.write(f"Checked {checked} accounts in {len(chunks)} chunks.")
+        if not drifts:
+            self.stdout.write(self.style.SUCCESS("No balance drift."))
+            return
+
+        names = dict(
+            User.objects.filter(pk__in=[report["user_id"] for report in drifts]).values_list(
+                "pk", "username"
+            )
+        )
+        self.stdout.write(self.style.WARNING(f"{len(drifts)} accounts drift:"))
+        for report in drifts:
+            self.stdout.write(
+                f"  {names.get(report['user_id'], report['user_id'])}: expected "
+                f"{report['expected']} UPBT, actual {report['actual']} UPBT "
+                f"({report['drift']:+})"
+            )
+        self.stdout.write(f"Net drift: {sum(report['drift'] for report in drifts):+} UPBT")
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from market.ledger import snapshot_account, snapshot_cutoff
+from market.models import LedgerEntry
+
+
+class Command(BaseCommand):
+    help = (
+        "Write per-account balance snapshots so historical balances only need "
+        "to scan the ledger entries recorded since the nearest snapshot."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-entries",
+            type=int,
+            default=getattr(settings, "UPBT_LEDGER_SNAPSHOT_EVERY", 500),
+            help="Only snapshot accounts with at least this many new entries.",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = snapshot_cutoff()
+        user_ids = (
+            LedgerEntry.objects.filter(created_at__lt=cutoff)
+            .values_list("user_id", flat=True)
+            .distinct()
+            .order_by("user_id")
+        )
+        created = 0
+        for user_id in user_ids.iterator(chunk_size=2000):
+            if snapshot_account(user_id, cutoff, options["min_entries"]):
+                created += 1
+        self.stdout.write(f"Created {created} balance snapshots.")
@@ -0,0 +1,65 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.http import JsonResponse
+
+from .apikeys import get_api_key_from_request
+from .ratelimit import check_rate_limit
+
+VENDOR_API_PREFIX = "/api/vendor/"
+
+
+class VendorAPIRateLimitMiddleware:
+    """
+    Throttle ``/api/vendor/`` calls per API key (see market/ratelimit.py).
+    Requests without a valid key pass through; the view rejects them.
+
+    Works both under WSGI and ASGI; in async mode the key lookup and bucket
+    update run in a worker thread so async views stay on the event loop.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not request.path.startswith(VENDOR_API_PREFIX):
+            return self.get_response(request)
+        api_key = get_api_key_from_request(request)
+        if api_key is None:
+            return self.get_response(request)
+
+        limit = check_rate_limit(api_key)
+        response = self._throttled(limit) or self.get_response(request)
+        return self._add_headers(response, limit)
+
+    async def __acall__(self, request):
+        if not request.path.startswith(VENDOR_API_PREFIX):
+            return await self.get_response(request)
+        api_key = await sync_to_async(get_api_key_from_request)(request)
+        if api_key is None:
+            return await self.get_response(request)
+
+        limit = await sync_to_async(check_rate_limit)(api_key)
+        response = self._throttled(limit) or await self.get_response(request)
+        return self._add_headers(response, limit)
+
+    def _throttled(self, limit):
+        allowed, _, _, retry_after = limit
+        if allowed:
+            return None
+        response = JsonResponse({"error": "Rate limit exceeded"}, status=429)
+        response["Retry-After"] = str(retry_after)
+        return response
+
+    def _add_headers(self, response, limit):
+        _, rate, remaining, _ = limit
+        if rate is not None:
+            response["X-RateLimit-Limit"] = str(rate)
+            response["X-RateLimit-Remaining"] = str(remaining)
+        return response
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:34
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0006_webhookdelivery'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_entry_id', models.BigIntegerField()),
+                ('as_of', models.DateTimeField(help_text='created_at of the last included entry.')),
+                ('balance', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_snapshots', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'last_entry_id'], name='market_bala_user_id_bb086a_idx'), models.Index(fields=['user', 'as_of'], name='market_bala_user_id_7f246b_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('opening', 'Opening balance'), ('topup', 'Top-up'), ('purchase', 'Purchase'), ('sale', 'Sale'), ('transfer_in', 'Incoming transfer'), ('transfer_out', 'Outgoing transfer')], max_length=20)),
+                ('amount_tokens', models.BigIntegerField()),
+                ('description', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('purchase', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='market.purchase')),
+                ('topup', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='market.tokentopup')),
+                ('transfer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='market.tokentransfer')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'id'], name='market_ledg_user_id_2b7222_idx'), models.Index(fields=['user', 'created_at'], name='market_ledg_user_id_e7d79c_idx')],
+            },
+        ),
+    ]
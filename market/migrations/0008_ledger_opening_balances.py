@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def create_opening_entries(apps, schema_editor):
+    """
+    Seed the ledger with each account's current balance so that, from here
+    on, the sum of an account's entries equals its token_balance.
+    """
+    UserTokenAccount = apps.get_model("market", "UserTokenAccount")
+    LedgerEntry = apps.get_model("market", "LedgerEntry")
+    LedgerEntry.objects.bulk_create(
+        [
+            LedgerEntry(
+                user_id=account.user_id,
+                kind="opening",
+                amount_tokens=account.token_balance,
+                description="Opening balance",
+            )
+            for account in UserTokenAccount.objects.filter(token_balance__gt=0)
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0007_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_opening_entries, migrations.RunPython.noop),
+    ]
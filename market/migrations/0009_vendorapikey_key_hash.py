@@ -0,0 +1,42 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_existing_keys(apps, schema_editor):
+    VendorAPIKey = apps.get_model("market", "VendorAPIKey")
+    for api_key in VendorAPIKey.objects.all():
+        api_key.key_hash = hashlib.sha256(api_key.key.encode("utf-8")).hexdigest()
+        api_key.key_prefix = api_key.key[:8]
+        api_key.save(update_fields=["key_hash", "key_prefix"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0008_ledger_opening_balances'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vendorapikey',
+            name='key_hash',
+            field=models.CharField(editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='vendorapikey',
+            name='key_prefix',
+            field=models.CharField(default='', editable=False, max_length=12),
+            preserve_default=False,
+        ),
+        migrations.RunPython(hash_existing_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='vendorapikey',
+            name='key_hash',
+            field=models.CharField(editable=False, max_length=64, unique=True),
+        ),
+        migrations.RemoveField(
+            model_name='vendorapikey',
+            name='key',
+        ),
+    ]
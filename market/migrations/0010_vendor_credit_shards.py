@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0009_vendorapikey_key_hash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertokenaccount',
+            name='credit_shards',
+            field=models.PositiveSmallIntegerField(default=0, help_text='If > 0, sale income is written to this many VendorCreditShard rows and folded into token_balance periodically (for very hot vendors).'),
+        ),
+        migrations.CreateModel(
+            name='VendorCreditShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('pending_tokens', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='credit_shards', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'shard'), name='unique_credit_shard')],
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:41
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_vendor(apps, schema_editor):
+    Purchase = apps.get_model("market", "Purchase")
+    Product = apps.get_model("market", "Product")
+    Purchase.objects.update(
+        vendor_id=models.Subquery(
+            Product.objects.filter(pk=models.OuterRef("product_id")).values("owner_id")[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0010_vendor_credit_shards'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchase',
+            name='vendor',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sales', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill_vendor, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['vendor', 'created_at', 'id'], name='market_purc_vendor__1f9078_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['product', 'created_at', 'id'], name='market_purc_product_0fcb26_idx'),
+        ),
+    ]
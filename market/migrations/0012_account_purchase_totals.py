@@ -0,0 +1,39 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:42
+
+from django.db import migrations, models
+
+
+def backfill_totals(apps, schema_editor):
+    UserTokenAccount = apps.get_model("market", "UserTokenAccount")
+    Purchase = apps.get_model("market", "Purchase")
+    totals = (
+        Purchase.objects.values("user_id")
+        .annotate(spent=models.Sum("total_tokens"), count=models.Count("id"))
+        .order_by()
+    )
+    for row in totals:
+        UserTokenAccount.objects.filter(user_id=row["user_id"]).update(
+            total_spent=row["spent"],
+            purchase_count=row["count"],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0011_purchase_vendor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertokenaccount',
+            name='purchase_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='usertokenaccount',
+            name='total_spent',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:44
+
+from django.conf import settings
+from django.db import migrations, models
+
+SQLITE_FTS_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE market_product_fts USING fts5(
+        name, description, content='market_product', content_rowid='id'
+    )
+    """,
+    """
+    CREATE TRIGGER market_product_fts_ai AFTER INSERT ON market_product BEGIN
+        INSERT INTO market_product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER market_product_fts_ad AFTER DELETE ON market_product BEGIN
+        INSERT INTO market_product_fts(market_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER market_product_fts_au AFTER UPDATE ON market_product BEGIN
+        INSERT INTO market_product_fts(market_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO market_product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    """,
+    "INSERT INTO market_product_fts(market_product_fts) VALUES ('rebuild')",
+]
+
+SQLITE_FTS_BACKWARD = [
+    "DROP TRIGGER IF EXISTS market_product_fts_ai",
+    "DROP TRIGGER IF EXISTS market_product_fts_ad",
+    "DROP TRIGGER IF EXISTS market_product_fts_au",
+    "DROP TABLE IF EXISTS market_product_fts",
+]
+
+# Keep in sync with market.catalogue.PG_SEARCH_SQL
+POSTGRES_SEARCH_FORWARD = [
+    """
+    CREATE INDEX market_product_search_idx ON market_product USING GIN (
+        to_tsvector('simple', coalesce("market_product"."name", '') || ' ' ||
+                              coalesce("market_product"."description", ''))
+    )
+    """,
+]
+
+POSTGRES_SEARCH_BACKWARD = [
+    "DROP INDEX IF EXISTS market_product_search_idx",
+]
+
+
+def _sqlite_has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def _run(schema_editor, statements):
+    for sql in statements:
+        schema_editor.execute(sql)
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == "sqlite" and _sqlite_has_fts5(connection):
+        _run(schema_editor, SQLITE_FTS_FORWARD)
+    elif connection.vendor == "postgresql":
+        _run(schema_editor, POSTGRES_SEARCH_FORWARD)
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == "sqlite":
+        _run(schema_editor, SQLITE_FTS_BACKWARD)
+    elif connection.vendor == "postgresql":
+        _run(schema_editor, POSTGRES_SEARCH_BACKWARD)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0012_account_purchase_totals'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['active', 'name', 'id'], name='market_prod_active_f8c8af_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['active', 'price_tokens'], name='market_prod_active_c677b6_idx'),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
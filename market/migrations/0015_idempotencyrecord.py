@@ -0,0 +1,32 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0014_product_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(help_text="Who the key belongs to, e.g. 'user:12' or 'apikey:3'.", max_length=50)),
+                ('key', models.CharField(max_length=255)),
+                ('endpoint', models.CharField(max_length=100)),
+                ('request_hash', models.CharField(max_length=64)),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('content_type', models.CharField(blank=True, max_length=100)),
+                ('location', models.CharField(blank=True, max_length=500)),
+                ('response_body', models.BinaryField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='market_idem_created_2df089_idx')],
+                'constraints': [models.UniqueConstraint(fields=('scope', 'key'), name='unique_idempotency_key')],
+            },
+        ),
+    ]
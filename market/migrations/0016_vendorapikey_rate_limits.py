@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:49
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0015_idempotencyrecord'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vendorapikey',
+            name='daily_transfer_quota_tokens',
+            field=models.PositiveBigIntegerField(blank=True, help_text='Most tokens this key may transfer out per day.', null=True),
+        ),
+        migrations.AddField(
+            model_name='vendorapikey',
+            name='rate_limit_burst',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vendorapikey',
+            name='rate_limit_per_minute',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='tokentransfer',
+            index=models.Index(fields=['api_key', 'created_at'], name='market_toke_api_key_aa7a97_idx'),
+        ),
+    ]
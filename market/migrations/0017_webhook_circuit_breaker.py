@@ -0,0 +1,63 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0016_vendorapikey_rate_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='circuit_open_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='consecutive_failures',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='deliveries_failed',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='deliveries_succeeded',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='last_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='last_latency_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='last_status_code',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='timeout_seconds',
+            field=models.FloatField(blank=True, help_text='Per-request timeout; empty uses UPBT_WEBHOOK_TIMEOUT_SECONDS.', null=True),
+        ),
+        migrations.AddField(
+            model_name='webhookdelivery',
+            name='latency_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='webhookdelivery',
+            name='response_status',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
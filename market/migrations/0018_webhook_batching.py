@@ -0,0 +1,48 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0017_webhook_circuit_breaker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='batch_size',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Events per delivery; 1 sends every event on its own.'),
+        ),
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='batch_window_seconds',
+            field=models.PositiveIntegerField(default=5, help_text='Longest an event waits for its batch to fill up.'),
+        ),
+        migrations.AddField(
+            model_name='vendorwebhook',
+            name='next_sequence',
+            field=models.PositiveBigIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='webhookdelivery',
+            name='batch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='events', to='market.webhookdelivery'),
+        ),
+        migrations.AddField(
+            model_name='webhookdelivery',
+            name='sequence',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='webhookdelivery',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Waiting for a batch'), ('pending', 'Pending'), ('batched', 'Sent in a batch'), ('delivered', 'Delivered'), ('dead', 'Dead letter')], default='pending', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='webhookdelivery',
+            index=models.Index(fields=['webhook', 'status', 'id'], name='market_webh_webhook_2e70e5_idx'),
+        ),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 5.2.7 on 2026-10-18 07:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Copied into each migration that rebuilds market_product on SQLite (which
+# drops the FTS sync triggers created in 0013), so the migration keeps working
+# whatever later code does.
+SQLITE_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS market_product_fts_ai AFTER INSERT ON market_product BEGIN
+        INSERT INTO market_product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS market_product_fts_ad AFTER DELETE ON market_product BEGIN
+        INSERT INTO market_product_fts(market_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS market_product_fts_au AFTER UPDATE ON market_product BEGIN
+        INSERT INTO market_product_fts(market_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO market_product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    """,
+    "INSERT INTO market_product_fts(market_product_fts) VALUES ('rebuild')",
+]
+
+
+def restore_sqlite_triggers(apps, schema_editor):
+    """Re-create the FTS sync triggers after market_product was rebuilt."""
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return
+    if "market_product_fts" not in connection.introspection.table_names():
+        return
+    for sql in SQLITE_FTS_TRIGGERS:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0019_cartitem'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='stock',
+            field=models.PositiveIntegerField(blank=True, help_text='Units available. Leave empty for unlimited.', null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='stock_buckets',
+            field=models.PositiveSmallIntegerField(default=0, help_text="If > 0, stock is split into this many StockBucket rows and units added to carts are reserved, so a limited drop with many buyers doesn't funnel every sale through one row."),
+        ),
+        # SQLite rebuilds market_product for this field, dropping the FTS triggers
+        migrations.RunPython(restore_sqlite_triggers, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='StockBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.PositiveSmallIntegerField()),
+                ('available', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='buckets', to='market.product')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('product', 'bucket'), name='unique_stock_bucket')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='market.product')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_reservations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['expires_at'], name='market_stoc_expires_c384e6_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'product'), name='unique_stock_reservation')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-18 07:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0020_product_stock'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VendorSalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('bucket_start', models.DateTimeField()),
+                ('shard', models.PositiveSmallIntegerField(default=0)),
+                ('units', models.PositiveBigIntegerField(default=0)),
+                ('tokens', models.PositiveBigIntegerField(default=0)),
+                ('buyers', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='market.product')),
+                ('vendor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sales_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['vendor', 'period', 'bucket_start'], name='market_vend_vendor__a6c051_idx')],
+                'constraints': [models.UniqueConstraint(fields=('vendor', 'product', 'period', 'bucket_start', 'shard'), name='unique_sales_rollup')],
+            },
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.2.7 on 2026-10-18 07:08
+
+from django.conf import settings
+from django.db import migrations, models
+
+# Copied into each migration that rebuilds market_product on SQLite (which
+# drops the FTS sync triggers created in 0013), so the migration keeps working
+# whatever later code does.
+SQLITE_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS market_product_fts_ai AFTER INSERT ON market_product BEGIN
+        INSERT INTO market_product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS market_product_fts_ad AFTER DELETE ON market_product BEGIN
+        INSERT INTO market_product_fts(market_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS market_product_fts_au AFTER UPDATE ON market_product BEGIN
+        INSERT INTO market_product_fts(market_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO market_product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    """,
+    "INSERT INTO market_product_fts(market_product_fts) VALUES ('rebuild')",
+]
+
+
+def restore_sqlite_triggers(apps, schema_editor):
+    """Re-create the FTS sync triggers after market_product was rebuilt."""
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return
+    if "market_product_fts" not in connection.introspection.table_names():
+        return
+    for sql in SQLITE_FTS_TRIGGERS:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0021_vendorsalesrollup'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='sku',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.UniqueConstraint(condition=models.Q(('sku', ''), _negated=True), fields=('owner', 'sku'), name='unique_product_sku'),
+        ),
+        # SQLite rebuilds market_product for this field, dropping the FTS triggers
+        migrations.RunPython(restore_sqlite_triggers, migrations.RunPython.noop),
+    ]
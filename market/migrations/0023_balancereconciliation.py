@@ -0,0 +1,37 @@
+# Generated by Django 5.2.7 on 2026-10-18 07:12
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0022_product_sku'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceReconciliation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('opening', models.BigIntegerField(default=0, help_text='Balance when the ledger started (its opening entry).')),
+                ('topups', models.PositiveBigIntegerField(default=0)),
+                ('spent', models.PositiveBigIntegerField(default=0)),
+                ('sales', models.PositiveBigIntegerField(default=0)),
+                ('transfers_in', models.PositiveBigIntegerField(default=0)),
+                ('transfers_out', models.PositiveBigIntegerField(default=0)),
+                ('topup_through_id', models.BigIntegerField(default=0)),
+                ('purchase_through_id', models.BigIntegerField(default=0)),
+                ('transfer_through_id', models.BigIntegerField(default=0)),
+                ('drift', models.BigIntegerField(default=0, help_text='Actual minus expected balance at the last check.')),
+                ('checked_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='balance_reconciliation', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['drift'], name='market_bala_drift_4249a7_idx')],
+            },
+        ),
+    ]
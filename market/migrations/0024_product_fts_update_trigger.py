@@ -0,0 +1,83 @@
+from django.db import migrations
+
+# Copied into each migration that rebuilds market_product on SQLite (which
+# drops the FTS sync triggers created in 0013), so the migration keeps working
+# whatever later code does. The update trigger only reindexes a product when
+# its name or description changes, not on every stock or updated_at write.
+SQLITE_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS market_product_fts_ai AFTER INSERT ON market_product BEGIN
+        INSERT INTO market_product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS market_product_fts_ad AFTER DELETE ON market_product BEGIN
+        INSERT INTO market_product_fts(market_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS market_product_fts_au
+    AFTER UPDATE OF name, description ON market_product
+    WHEN old.name IS NOT new.name OR old.description IS NOT new.description
+    BEGIN
+        INSERT INTO market_product_fts(market_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO market_product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+    """,
+    "INSERT INTO market_product_fts(market_product_fts) VALUES ('rebuild')",
+]
+
+# The update trigger as 0013 to 0022 created it
+SQLITE_FTS_UPDATE_TRIGGER_BEFORE = """
+    CREATE TRIGGER market_product_fts_au AFTER UPDATE ON market_product BEGIN
+        INSERT INTO market_product_fts(market_product_fts, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO market_product_fts(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END
+"""
+
+
+def _has_fts_table(schema_editor):
+    connection = schema_editor.connection
+    return (
+        connection.vendor == "sqlite"
+        and "market_product_fts" in connection.introspection.table_names()
+    )
+
+
+def restore_sqlite_triggers(apps, schema_editor):
+    """Re-create the FTS sync triggers after market_product was rebuilt."""
+    if not _has_fts_table(schema_editor):
+        return
+    for sql in SQLITE_FTS_TRIGGERS:
+        schema_editor.execute(sql)
+
+
+def replace_update_trigger(apps, schema_editor):
+    if not _has_fts_table(schema_editor):
+        return
+    schema_editor.execute("DROP TRIGGER IF EXISTS market_product_fts_au")
+    restore_sqlite_triggers(apps, schema_editor)
+
+
+def restore_update_trigger(apps, schema_editor):
+    if not _has_fts_table(schema_editor):
+        return
+    schema_editor.execute("DROP TRIGGER IF EXISTS market_product_fts_au")
+    schema_editor.execute(SQLITE_FTS_UPDATE_TRIGGER_BEFORE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('market', '0023_balancereconciliation'),
+    ]
+
+    operations = [
+        migrations.RunPython(replace_update_trigger, restore_update_trigger),
+    ]
@@ -1,5 +1,10 @@
+import hashlib
 import secrets
-from django.db import models
+from django.db import connections, models
+from django.db.models import F
+from django.utils import timezone
+
+from .usercontext import invalidate_user_context
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -7,10 +12,27 @@ from django.dispatch import receiver
 
 
 class Product(models.Model):
+    # Vendor's own product code; bulk imports match existing products by it
+    sku = models.CharField(max_length=64, blank=True, default="")
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
     price_tokens = models.PositiveIntegerField()
     active = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Units left to sell; None = unlimited. See market/inventory.py
+    stock = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Units available. Leave empty for unlimited.",
+    )
+    stock_buckets = models.PositiveSmallIntegerField(
+        default=0,
+        help_text=(
+            "If > 0, stock is split into this many StockBucket rows and units "
+            "added to carts are reserved, so a limited drop with many buyers "
+            "doesn't funnel every sale through one row."
+        ),
+    )
 
     owner = models.ForeignKey(
         User,
@@ -20,18 +42,153 @@ class Product(models.Model):
         related_name="products",
     )
 
+    class Meta:
+        constraints = [
+            # Bulk imports look products up by (owner, sku); blank SKUs may repeat
+            models.UniqueConstraint(
+                fields=["owner", "sku"],
+                condition=~models.Q(sku=""),
+                name="unique_product_sku",
+            ),
+        ]
+        indexes = [
+            # Catalogue listing: WHERE active ORDER BY name / price_tokens
+            models.Index(fields=["active", "name", "id"]),
+            models.Index(fields=["active", "price_tokens"]),
+        ]
+
     def __str__(self):
         return f"{self.name} ({self.price_tokens} UPBT)"
 
 
+def _can_update_returning(connection):
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+class UserTokenAccountManager(models.Manager):
+    """
+    Single-statement balance updates. Both methods run one
+    ``UPDATE ... RETURNING`` (or an UPDATE plus a SELECT on backends without
+    RETURNING) and never hold a row lock across Python code.
+    """
+
+    def _apply(self, user_id, delta, require_funds, purchase=False):
+        connection = connections[self.db]
+        if _can_update_returning(connection):
+            qn = connection.ops.quote_name
+            sql = (
+                f"UPDATE {qn(self.model._meta.db_table)} "
+                f"SET {qn('token_balance')} = {qn('token_balance')} + %s"
+            )
+            params = [delta]
+            if purchase:
+                sql += (
+                    f", {qn('total_spent')} = {qn('total_spent')} + %s"
+                    f", {qn('purchase_count')} = {qn('purchase_count')} + 1"
+                )
+                params.append(-delta)
+            sql += f" WHERE {qn('user_id')} = %s"
+            params.append(user_id)
+            if require_funds:
+                sql += f" AND {qn('token_balance')} >= %s"
+                params.append(-delta)
+            sql += f" RETURNING {qn('token_balance')}"
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                row = cursor.fetchone()
+            if row is None:
+                return None
+            invalidate_user_context(user_id, using=self.db)
+            return row[0]
+
+        accounts = self.filter(user_id=user_id)
+        if require_funds:
+            accounts = accounts.filter(token_balance__gte=-delta)
+        changes = {"token_balance": F("token_balance") + delta}
+        if purchase:
+            changes["total_spent"] = F("total_spent") - delta
+            changes["purchase_count"] = F("purchase_count") + 1
+        if not accounts.update(**changes):
+            return None
+        invalidate_user_context(user_id, using=self.db)
+        return self.filter(user_id=user_id).values_list("token_balance", flat=True).get()
+
+    def debit(self, user_id, amount, purchase=False):
+        """
+        Take ``amount`` from the account only if it has enough funds.
+        Returns the new balance, or None if the balance was insufficient
+        (or the account doesn't exist); in that case nothing is changed.
+
+        With ``purchase=True`` the same statement also bumps the account's
+        ``total_spent`` and ``purchase_count``.
+        """
+        return self._apply(user_id, -amount, require_funds=True, purchase=purchase)
+
+    def credit(self, user_id, amount):
+        """Add ``amount``; returns the new balance, or None if there is no account."""
+        return self._apply(user_id, amount, require_funds=False)
+
+
 class UserTokenAccount(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="token_account")
     token_balance = models.PositiveIntegerField(default=0)
+    credit_shards = models.PositiveSmallIntegerField(
+        default=0,
+        help_text=(
+            "If > 0, sale income is written to this many VendorCreditShard rows "
+            "and folded into token_balance periodically (for very hot vendors)."
+        ),
+    )
+
+    # Running totals, bumped by UserTokenAccountManager.debit(purchase=True)
+    total_spent = models.PositiveBigIntegerField(default=0)
+    purchase_count = models.PositiveIntegerField(default=0)
+
+    objects = UserTokenAccountManager()
+
+    @property
+    def total_balance(self):
+        """token_balance plus sale credits not yet folded in from shards."""
+        if not self.credit_shards:
+            return self.token_balance
+        pending = VendorCreditShard.objects.filter(user_id=self.user_id).aggregate(
+            total=models.Sum("pending_tokens")
+        )["total"]
+        return self.token_balance + (pending or 0)
 
     def __str__(self):
         return f"TokenAccount of {self.user.username}: {self.token_balance} UPBT"
 
 
+class VendorCreditShard(models.Model):
+    """
+    One of N sub-counters that absorb a vendor's sale credits, so concurrent
+    purchases from the same vendor update different rows. The
+    ``fold_credit_shards`` command moves ``pending_tokens`` into the
+    vendor's ``token_balance``.
+    """
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="credit_shards",
+    )
+    shard = models.PositiveSmallIntegerField()
+    pending_tokens = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "shard"], name="unique_credit_shard"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} shard {self.shard}: {self.pending_tokens} UPBT pending"
+
+
 @receiver(post_save, sender=User)
 def create_user_token_account(sender, instance, created, **kwargs):
     if created:
@@ -41,14 +198,130 @@ def create_user_token_account(sender, instance, created, **kwargs):
 class Purchase(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="purchases")
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    # Copy of product.owner at purchase time, so vendor listings don't need a join
+    vendor = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="sales",
+    )
     quantity = models.PositiveIntegerField(default=1)
     total_tokens = models.PositiveIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
-    
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of a vendor's sales: WHERE vendor = ? ORDER BY created_at, id
+            models.Index(fields=["vendor", "created_at", "id"]),
+            models.Index(fields=["product", "created_at", "id"]),
+        ]
 
     def __str__(self):
         return f"{self.user.username} bought {self.quantity} x {self.product.name}"
 
+
+class CartItem(models.Model):
+    """One line of a user's cart; bought all at once by checkout (see market/checkout.py)."""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="cart_items")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="+")
+    quantity = models.PositiveIntegerField(default=1)
+    added_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "product"], name="unique_cart_line"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.quantity} x {self.product.name}"
+
+
+class StockBucket(models.Model):
+    """A slice of a bucketed product's stock; buyers pick one at random."""
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="buckets")
+    bucket = models.PositiveSmallIntegerField()
+    available = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["product", "bucket"], name="unique_stock_bucket"),
+        ]
+
+    def __str__(self):
+        return f"{self.product.name} bucket {self.bucket}: {self.available}"
+
+
+class StockReservation(models.Model):
+    """
+    Units taken out of stock for a cart line. Checkout turns them into a
+    sale; ``expire_reservations`` puts expired ones back.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="stock_reservations")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="reservations")
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            # One reservation per cart line
+            models.UniqueConstraint(fields=["user", "product"], name="unique_stock_reservation"),
+        ]
+        indexes = [
+            models.Index(fields=["expires_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product.name} for {self.user.username}"
+
+
+class VendorSalesRollup(models.Model):
+    """
+    Sales of one product in one hour or day, kept up to date by every
+    purchase (see market/rollups.py) so vendor reports read a few
+    pre-aggregated rows instead of the purchase table.
+
+    ``buyers`` counts distinct buyers of the product in the bucket; hot
+    vendors (``credit_shards > 0``) write to several ``shard`` rows per
+    bucket, which reports add up.
+    """
+
+    PERIOD_HOUR = "hour"
+    PERIOD_DAY = "day"
+    PERIOD_CHOICES = [
+        (PERIOD_HOUR, "Hour"),
+        (PERIOD_DAY, "Day"),
+    ]
+
+    vendor = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sales_rollups")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="+")
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    bucket_start = models.DateTimeField()
+    shard = models.PositiveSmallIntegerField(default=0)
+    units = models.PositiveBigIntegerField(default=0)
+    tokens = models.PositiveBigIntegerField(default=0)
+    buyers = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["vendor", "product", "period", "bucket_start", "shard"],
+                name="unique_sales_rollup",
+            ),
+        ]
+        indexes = [
+            # Vendor reports: WHERE vendor = ? AND period = ? AND bucket_start >= ?
+            models.Index(fields=["vendor", "period", "bucket_start"]),
+        ]
+
+    def __str__(self):
+        return f"{self.product.name} {self.period} {self.bucket_start:%Y-%m-%d %H:%M}: {self.tokens} UPBT"
+
+
 class TokenTopUp(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="token_topups")
     amount_tokens = models.PositiveIntegerField()
@@ -58,11 +331,16 @@ class TokenTopUp(models.Model):
     def __str__(self):
         return f"{self.user.username} +{self.amount_tokens} UPBT on {self.created_at:%Y-%m-%d}"
 
-import secrets
 def generate_api_key():
     # 40+ chars, URL safe
     return secrets.token_urlsafe(40)
 
+
+def hash_api_key(raw_key):
+    """Fixed-width digest used to store and look up API keys."""
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
 class VendorAPIKey(models.Model):
     vendor = models.ForeignKey(
         User,
@@ -70,13 +348,26 @@ class VendorAPIKey(models.Model):
         related_name="api_keys",
     )
     name = models.CharField(max_length=100)
-    key = models.CharField(max_length=100, unique=True, editable=False)
+    # Only the SHA-256 of the key is stored; the raw key is shown once on creation
+    key_hash = models.CharField(max_length=64, unique=True, editable=False)
+    key_prefix = models.CharField(max_length=12, editable=False)
     is_active = models.BooleanField(default=True)
+    # Throttling; empty means the UPBT_API_RATE_LIMIT_* defaults / no quota
+    rate_limit_per_minute = models.PositiveIntegerField(null=True, blank=True)
+    rate_limit_burst = models.PositiveIntegerField(null=True, blank=True)
+    daily_transfer_quota_tokens = models.PositiveBigIntegerField(
+        null=True,
+        blank=True,
+        help_text="Most tokens this key may transfer out per day.",
+    )
     created_at = models.DateTimeField(auto_now_add=True)
 
     def save(self, *args, **kwargs):
-        if not self.key:
-            self.key = generate_api_key()
+        if not self.key_hash:
+            # Kept on the instance (never persisted) so the caller can display it
+            self.raw_key = generate_api_key()
+            self.key_hash = hash_api_key(self.raw_key)
+            self.key_prefix = self.raw_key[:8]
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -104,6 +395,12 @@ class TokenTransfer(models.Model):
         related_name="transfers",
     )
 
+    class Meta:
+        indexes = [
+            # Daily transfer quota per API key
+            models.Index(fields=["api_key", "created_at"]),
+        ]
+
     def __str__(self):
         return f"{self.from_user.username} → {self.to_user.username}: {self.amount_tokens} UPBT"
     
@@ -121,8 +418,278 @@ class VendorWebhook(models.Model):
         help_text="Optional secret used to sign webhook payloads.",
     )
     is_active = models.BooleanField(default=True)
+    timeout_seconds = models.FloatField(
+        null=True,
+        blank=True,
+        help_text="Per-request timeout; empty uses UPBT_WEBHOOK_TIMEOUT_SECONDS.",
+    )
+    # Batching: with batch_size > 1, events are coalesced into one signed
+    # JSON array per batch_size events or batch_window_seconds
+    batch_size = models.PositiveSmallIntegerField(
+        default=1,
+        help_text="Events per delivery; 1 sends every event on its own.",
+    )
+    batch_window_seconds = models.PositiveIntegerField(
+        default=5,
+        help_text="Longest an event waits for its batch to fill up.",
+    )
+    next_sequence = models.PositiveBigIntegerField(default=1, editable=False)
+    # Circuit breaker: after enough consecutive failures the endpoint is
+    # skipped until circuit_open_until (see market/webhooks.py)
+    consecutive_failures = models.PositiveIntegerField(default=0)
+    circuit_open_until = models.DateTimeField(null=True, blank=True)
+    # Delivery stats
+    deliveries_succeeded = models.PositiveBigIntegerField(default=0)
+    deliveries_failed = models.PositiveBigIntegerField(default=0)
+    last_attempt_at = models.DateTimeField(null=True, blank=True)
+    last_status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    last_latency_ms = models.PositiveIntegerField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"Webhook for {self.vendor.username} -> {self.url}"
+
+    @property
+    def circuit_open(self):
+        return self.circuit_open_until is not None and self.circuit_open_until > timezone.now()
+
+
+class WebhookDelivery(models.Model):
+    """
+    Outbox row for a single webhook event.
+
+    Rows are written in the same transaction as the event that caused them
+    (e.g. a Purchase) and delivered later by the ``deliver_webhooks``
+    management command, so purchases never wait on vendor endpoints.
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_PENDING = "pending"
+    STATUS_BATCHED = "batched"
+    STATUS_DELIVERED = "delivered"
+    STATUS_DEAD = "dead"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Waiting for a batch"),
+        (STATUS_PENDING, "Pending"),
+        (STATUS_BATCHED, "Sent in a batch"),
+        (STATUS_DELIVERED, "Delivered"),
+        (STATUS_DEAD, "Dead letter"),
+    ]
+
+    EVENT_BATCH = "batch"
+
+    webhook = models.ForeignKey(
+        VendorWebhook,
+        on_delete=models.CASCADE,
+        related_name="deliveries",
+    )
+    event = models.CharField(max_length=50)
+    payload = models.TextField(help_text="JSON body, exactly as it will be sent.")
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=STATUS_PENDING,
+    )
+    # Per-webhook message number, assigned when first sent
+    sequence = models.PositiveBigIntegerField(null=True, blank=True)
+    # For events coalesced into a batch: the delivery that carries them
+    batch = models.ForeignKey(
+        "self",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="events",
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    # Outcome of the latest attempt (no status code on network errors)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    latency_ms = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"]),
+            models.Index(fields=["webhook", "status", "id"]),
+        ]
+
+    def __str__(self):
+        return f"{self.event} -> {self.webhook.url} ({self.status})"
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only record of every balance movement, one row per account touched.
+
+    ``amount_tokens`` is signed (credits positive, debits negative), so an
+    account's balance is the sum of its entries. ``BalanceSnapshot`` rows let
+    us answer that sum without scanning the whole history.
+    """
+
+    KIND_OPENING = "opening"
+    KIND_TOPUP = "topup"
+    KIND_PURCHASE = "purchase"
+    KIND_SALE = "sale"
+    KIND_TRANSFER_IN = "transfer_in"
+    KIND_TRANSFER_OUT = "transfer_out"
+    KIND_CHOICES = [
+        (KIND_OPENING, "Opening balance"),
+        (KIND_TOPUP, "Top-up"),
+        (KIND_PURCHASE, "Purchase"),
+        (KIND_SALE, "Sale"),
+        (KIND_TRANSFER_IN, "Incoming transfer"),
+        (KIND_TRANSFER_OUT, "Outgoing transfer"),
+    ]
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="ledger_entries",
+    )
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    amount_tokens = models.BigIntegerField()
+    description = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    purchase = models.ForeignKey(
+        Purchase,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="ledger_entries",
+    )
+    topup = models.ForeignKey(
+        TokenTopUp,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="ledger_entries",
+    )
+    transfer = models.ForeignKey(
+        TokenTransfer,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="ledger_entries",
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "id"]),
+            models.Index(fields=["user", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} {self.amount_tokens:+} UPBT ({self.kind})"
+
+
+class BalanceSnapshot(models.Model):
+    """
+    Balance of an account after a given ledger entry (inclusive).
+    Written periodically by the ``snapshot_balances`` command.
+    """
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="balance_snapshots",
+    )
+    last_entry_id = models.BigIntegerField()
+    as_of = models.DateTimeField(help_text="created_at of the last included entry.")
+    balance = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "last_entry_id"]),
+            models.Index(fields=["user", "as_of"]),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.balance} UPBT as of {self.as_of:%Y-%m-%d %H:%M}"
+
+
+class BalanceReconciliation(models.Model):
+    """
+    Expected balance of one account, summed from the history tables by the
+    ``reconcile_balances`` command. The ``*_through_id`` watermarks are the
+    last top-up/purchase/transfer ids already counted, so each run only
+    aggregates the movements recorded since.
+    """
+
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        related_name="balance_reconciliation",
+    )
+    opening = models.BigIntegerField(
+        default=0, help_text="Balance when the ledger started (its opening entry)."
+    )
+    topups = models.PositiveBigIntegerField(default=0)
+    spent = models.PositiveBigIntegerField(default=0)
+    sales = models.PositiveBigIntegerField(default=0)
+    transfers_in = models.PositiveBigIntegerField(default=0)
+    transfers_out = models.PositiveBigIntegerField(default=0)
+
+    topup_through_id = models.BigIntegerField(default=0)
+    purchase_through_id = models.BigIntegerField(default=0)
+    transfer_through_id = models.BigIntegerField(default=0)
+
+    drift = models.BigIntegerField(
+        default=0, help_text="Actual minus expected balance at the last check."
+    )
+    checked_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["drift"]),
+        ]
+
+    @property
+    def expected_balance(self):
+        return (
+            self.opening
+            + self.topups
+            - self.spent
+            + self.sales
+            + self.transfers_in
+            - self.transfers_out
+        )
+
+    def __str__(self):
+        return f"{self.user.username}: expected {self.expected_balance} UPBT (drift {self.drift:+})"
+
+
+class IdempotencyRecord(models.Model):
+    """
+    Stored outcome of a request made with an ``Idempotency-Key``, so retries
+    of the same request get the original response instead of repeating the
+    money movement. Written in the same transaction as the movement.
+    """
+
+    scope = models.CharField(
+        max_length=50,
+        help_text="Who the key belongs to, e.g. 'user:12' or 'apikey:3'.",
+    )
+    key = models.CharField(max_length=255)
+    endpoint = models.CharField(max_length=100)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    location = models.CharField(max_length=500, blank=True)
+    response_body = models.BinaryField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "key"], name="unique_idempotency_key"),
+        ]
+        indexes = [
+            models.Index(fields=["created_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key} -> {self.status_code}"
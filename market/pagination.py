@@ -0,0 +1,57 @@
+"""
+Keyset ("seek") pagination over ``(created_at, id)``.
+
+Unlike OFFSET pagination, every page is a bounded index range scan starting
+right after the previous page's last row, so page 10,000 costs the same as
+page 1. Cursors are opaque URL-safe strings.
+"""
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+def encode_cursor(created_at, pk):
+    raw = json.dumps([created_at.isoformat(), pk]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return ``(created_at, pk)``; raises ValueError on a malformed cursor."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, pk = json.loads(base64.urlsafe_b64decode(padded))
+        created_at = parse_datetime(created_at)
+        pk = int(pk)
+    except (TypeError, ValueError, json.JSONDecodeError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+    if created_at is None:
+        raise ValueError("Invalid cursor")
+    return created_at, pk
+
+
+def keyset_page(queryset, cursor=None, limit=100, descending=False):
+    """
+    Return ``(rows, next_cursor)`` for the page after ``cursor``.
+    ``next_cursor`` is None on the last page.
+    """
+    if descending:
+        queryset = queryset.order_by("-created_at", "-id")
+    else:
+        queryset = queryset.order_by("created_at", "id")
+
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        if descending:
+            after = Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+        else:
+            after = Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+        queryset = queryset.filter(after)
+
+    rows = list(queryset[: limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last.created_at, last.pk)
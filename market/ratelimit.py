@@ -0,0 +1,167 @@
+"""
+Per-API-key rate limits and daily transfer quotas.
+
+Every ``/api/vendor/`` request made with a key takes one token from that
+key's bucket (``VendorAPIRateLimitMiddleware``). A bucket holds up to
+``burst`` tokens and refills at ``rate_limit_per_minute / 60`` per second;
+an empty bucket means 429 with ``Retry-After``. Limits come from the key,
+falling back to ``UPBT_API_RATE_LIMIT_PER_MINUTE`` / ``_BURST``.
+
+Buckets live in process memory by default. With ``UPBT_API_RATE_LIMIT_CACHE_ALIAS``
+set they are kept in that (shared) Django cache instead, as per-minute
+counters updated with the cache's atomic ``incr``, which is what
+memcached/Redis can do without a lock; that allows ``rate + burst`` calls
+in a minute window.
+
+Daily transfer quotas are checked by the transfer views against the
+``TokenTransfer`` rows of the key, after the sender's account row is locked,
+so concurrent transfers can't overshoot them. Per-key counters are kept in
+``api_usage`` for monitoring.
+"""
+import math
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import TokenTransfer
+
+
+class TokenBucketStore:
+    """In-process token buckets, one per key id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key_id, rate_per_minute, burst):
+        """Return ``(allowed, remaining, retry_after_seconds)``."""
+        refill_per_second = rate_per_minute / 60.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key_id, (float(burst), now))
+            tokens = min(float(burst), tokens + (now - updated_at) * refill_per_second)
+            if tokens >= 1:
+                self._buckets[key_id] = (tokens - 1, now)
+                return True, int(tokens - 1), 0
+            self._buckets[key_id] = (tokens, now)
+        if not refill_per_second:
+            return False, 0, 60
+        return False, 0, math.ceil((1 - tokens) / refill_per_second)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheWindowStore:
+    """Shared per-minute counters in a Django cache."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def take(self, key_id, rate_per_minute, burst):
+        now = time.time()
+        window = int(now // 60)
+        cache_key = f"upbt:ratelimit:{key_id}:{window}"
+        self.cache.add(cache_key, 0, timeout=120)
+        try:
+            used = self.cache.incr(cache_key)
+        except ValueError:
+            # Evicted between add() and incr()
+            self.cache.set(cache_key, 1, timeout=120)
+            used = 1
+        limit = rate_per_minute + burst
+        if used <= limit:
+            return True, limit - used, 0
+        return False, 0, max(1, math.ceil((window + 1) * 60 - now))
+
+
+class ApiUsageMetrics:
+    """Thread-safe per-key request counters."""
+
+    FIELDS = ("requests", "throttled", "quota_rejected", "transferred_tokens")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._keys = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+
+    def record(self, key_id, **counts):
+        with self._lock:
+            usage = self._keys[key_id]
+            for name, value in counts.items():
+                usage[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {key_id: dict(usage) for key_id, usage in self._keys.items()}
+
+
+api_usage = ApiUsageMetrics()
+_local_store = TokenBucketStore()
+
+
+def _store():
+    alias = getattr(settings, "UPBT_API_RATE_LIMIT_CACHE_ALIAS", None)
+    return CacheWindowStore(caches[alias]) if alias else _local_store
+
+
+def key_limits(api_key):
+    """``(rate_per_minute, burst)`` for a key; ``rate`` is None when unlimited."""
+    rate = api_key.rate_limit_per_minute
+    if rate is None:
+        rate = getattr(settings, "UPBT_API_RATE_LIMIT_PER_MINUTE", None)
+    burst = api_key.rate_limit_burst
+    if burst is None:
+        burst = getattr(settings, "UPBT_API_RATE_LIMIT_BURST", None)
+    if burst is None:
+        burst = rate
+    return rate, burst
+
+
+def check_rate_limit(api_key):
+    """
+    Take one request from the key's bucket.
+    Returns ``(allowed, limit, remaining, retry_after_seconds)``.
+    """
+    rate, burst = key_limits(api_key)
+    if rate is None:
+        api_usage.record(api_key.pk, requests=1)
+        return True, None, None, 0
+    allowed, remaining, retry_after = _store().take(api_key.pk, rate, max(burst, 1))
+    if allowed:
+        api_usage.record(api_key.pk, requests=1)
+    else:
+        api_usage.record(api_key.pk, throttled=1)
+    return allowed, rate, remaining, retry_after
+
+
+def _today_start():
+    return timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def seconds_until_quota_reset():
+    return math.ceil((_today_start() + timedelta(days=1) - timezone.localtime()).total_seconds())
+
+
+def transfer_quota_remaining(api_key):
+    """
+    Tokens the key may still transfer today, or None without a quota.
+    Call with the sender's account row locked.
+    """
+    quota = api_key.daily_transfer_quota_tokens
+    if quota is None:
+        return None
+    used = TokenTransfer.objects.filter(
+        api_key=api_key, created_at__gte=_today_start()
+    ).aggregate(total=Sum("amount_tokens"))["total"] or 0
+    return max(quota - used, 0)
@@ -0,0 +1,262 @@
+"""
+Balance reconciliation.
+
+An account's ``token_balance`` plus its pending shard credits must equal
+
+    opening + top-ups - purchases + sales + transfers in - transfers out
+
+where ``opening`` is its ledger opening entry (the balance when the ledger
+was introduced; the movements recorded before that are already in it).
+
+``reconcile_chunk`` checks a range of accounts with one grouped aggregate
+query per history table and side, never one per account, and keeps the
+running sums in ``BalanceReconciliation``. Every account's sums carry the
+ids they were counted up to, so a run only aggregates the movements recorded
+since the previous one, and a run that stops half way just resumes.
+
+Like balance snapshots, a run only counts movements older than
+``snapshot_cutoff()``, since ids may commit out of order. Newer ones are
+added as a "tail" when comparing, and drifting accounts are compared again
+with their rows locked before being reported, so a movement committing
+between two queries isn't mistaken for drift.
+"""
+from django.db.models import Max, Q, Sum
+from django.utils import timezone
+
+from .locking import atomic_with_retry, lock_accounts
+from .models import (
+    BalanceReconciliation,
+    LedgerEntry,
+    Purchase,
+    TokenTopUp,
+    TokenTransfer,
+    UserTokenAccount,
+    VendorCreditShard,
+)
+
+WATERMARKS = {
+    TokenTopUp: "topup_through_id",
+    Purchase: "purchase_through_id",
+    TokenTransfer: "transfer_through_id",
+}
+
+# (BalanceReconciliation field, table, account column, amount column, sign)
+SOURCES = [
+    ("topups", TokenTopUp, "user_id", "amount_tokens", 1),
+    ("spent", Purchase, "user_id", "total_tokens", -1),
+    ("sales", Purchase, "vendor_id", "total_tokens", 1),
+    ("transfers_in", TokenTransfer, "to_user_id", "amount_tokens", 1),
+    ("transfers_out", TokenTransfer, "from_user_id", "amount_tokens", -1),
+]
+
+
+def _last_ids(**filters):
+    return {
+        field: model.objects.filter(**filters).order_by("-id").values_list("id", flat=True).first()
+        or 0
+        for model, field in WATERMARKS.items()
+    }
+
+
+def watermarks(cutoff):
+    """Last id of each history table recorded before ``cutoff``."""
+    return _last_ids(created_at__lt=cutoff)
+
+
+def baseline():
+    """
+    Watermarks of accounts reconciled for the first time: the movements
+    recorded before the ledger's opening entries are already in them.
+    """
+    started = LedgerEntry.objects.filter(kind=LedgerEntry.KIND_OPENING).aggregate(
+        at=Max("created_at")
+    )["at"]
+    if started is None:
+        return {field: 0 for field in WATERMARKS.values()}
+    return _last_ids(created_at__lte=started)
+
+
+def account_chunks(chunk_size):
+    """Yield ``(first, last)`` user id ranges of up to ``chunk_size`` accounts."""
+    first = last = None
+    count = 0
+    user_ids = UserTokenAccount.objects.order_by("user_id").values_list("user_id", flat=True)
+    for user_id in user_ids.iterator(chunk_size=max(chunk_size, 2000)):
+        if first is None:
+            first = user_id
+        last = user_id
+        count += 1
+        if count == chunk_size:
+            yield first, last
+            first, count = None, 0
+    if first is not None:
+        yield first, last
+
+
+def _movements(first, last, after, through, user_ids=None):
+    """
+    ``{user_id: {field: [counted, tail]}}`` for the accounts with user ids
+    in ``[first, last]`` (and in ``user_ids``, if given): the sums of their
+    movements with ids in ``(after, through]`` and past ``through``.
+    """
+    result = {}
+    for field, model, column, amount, _ in SOURCES:
+        mark = WATERMARKS[model]
+        accounts = {column + "__gte": first, column + "__lte": last}
+        if user_ids is not None:
+            accounts[column + "__in"] = user_ids
+        totals = (
+            model.objects.filter(id__gt=after[mark], **accounts)
+            .values(column)
+            .annotate(
+                counted=Sum(amount, filter=Q(id__lte=through[mark])),
+                tail=Sum(amount, filter=Q(id__gt=through[mark])),
+            )
+            .order_by()
+        )
+        for row in totals:
+            result.setdefault(row[column], {})[field] = [row["counted"] or 0, row["tail"] or 0]
+    return result
+
+
+def _tail(sums):
+    return sum(sign * sums.get(field, [0, 0])[1] for field, _, _, _, sign in SOURCES)
+
+
+def _pending(shards):
+    pending = {}
+    for user_id, tokens in shards:
+        pending[user_id] = pending.get(user_id, 0) + tokens
+    return pending
+
+
+def _marks(row):
+    return tuple(getattr(row, field) for field in WATERMARKS.values())
+
+
+def _drift_report(row, balance, pending, tail):
+    actual = balance + pending
+    expected = row.expected_balance + tail
+    row.drift = actual - expected
+    return {"user_id": row.user_id, "expected": expected, "actual": actual, "drift": row.drift}
+
+
+def reconcile_chunk(first, last, marks, start):
+    """
+    Count the movements up to ``marks`` (see ``watermarks``) of the accounts
+    with user ids in ``[first, last]`` and compare with their balances.
+    Accounts seen for the first time start from ``start`` (``baseline()``).
+    Returns ``(accounts checked, [drift report per drifting account])``.
+    """
+    checked, drifting = _count_chunk(first, last, marks, start)
+    return checked, _recheck(drifting) if drifting else []
+
+
+# Retried: on SQLite, parallel workers' write transactions collide
+@atomic_with_retry
+def _count_chunk(first, last, marks, start):
+    now = timezone.now()
+    balances = dict(
+        UserTokenAccount.objects.filter(user_id__gte=first, user_id__lte=last).values_list(
+            "user_id", "token_balance"
+        )
+    )
+    pending = _pending(
+        VendorCreditShard.objects.filter(user_id__gte=first, user_id__lte=last).values_list(
+            "user_id", "pending_tokens"
+        )
+    )
+    rows = {
+        row.user_id: row
+        for row in BalanceReconciliation.objects.select_for_update().filter(
+            user_id__gte=first, user_id__lte=last
+        )
+    }
+    created = [user_id for user_id in balances if user_id not in rows]
+    if created:
+        openings = dict(
+            LedgerEntry.objects.filter(
+                user_id__gte=first, user_id__lte=last, kind=LedgerEntry.KIND_OPENING
+            )
+            .values("user_id")
+            .annotate(total=Sum("amount_tokens"))
+            .values_list("user_id", "total")
+        )
+        for user_id in created:
+            rows[user_id] = BalanceReconciliation(
+                user_id=user_id, opening=openings.get(user_id, 0), **start
+            )
+
+    # Normally every account is at the same watermarks: one group
+    groups = {}
+    for user_id, row in rows.items():
+        if user_id in balances:
+            groups.setdefault(_marks(row), []).append(row)
+
+    for key, group in groups.items():
+        after = dict(zip(WATERMARKS.values(), key))
+        through = {field: max(after[field], marks[field]) for field in after}
+        movements = _movements(first, last, after, through)
+        for row in group:
+            sums = movements.get(row.user_id, {})
+            for field, _, _, _, _ in SOURCES:
+                setattr(row, field, getattr(row, field) + sums.get(field, [0, 0])[0])
+            for field, value in through.items():
+                setattr(row, field, value)
+            row.checked_at = now
+            _drift_report(row, balances[row.user_id], pending.get(row.user_id, 0), _tail(sums))
+
+    checked = [row for group in groups.values() for row in group]
+    BalanceReconciliation.objects.bulk_update(
+        [row for row in checked if row.pk],
+        [field for field, _, _, _, _ in SOURCES]
+        + list(WATERMARKS.values())
+        + ["drift", "checked_at"],
+    )
+    BalanceReconciliation.objects.bulk_create([row for row in checked if not row.pk])
+    return len(checked), [row for row in checked if row.drift]
+
+
+@atomic_with_retry
+def _recheck(rows):
+    """
+    Compare drifting accounts again with their account and shard rows
+    locked: any movement touching them is then either committed (and in the
+    tail) or not applied yet. Returns the reports of those still drifting.
+    """
+    user_ids = [row.user_id for row in rows]
+    accounts = lock_accounts(user_ids, nowait=False, skip_locked=False)
+    pending = _pending(
+        VendorCreditShard.objects.select_for_update()
+        .filter(user_id__in=user_ids)
+        .order_by("user_id", "shard")
+        .values_list("user_id", "pending_tokens")
+    )
+    groups = {}
+    for row in rows:
+        if row.user_id in accounts:
+            groups.setdefault(_marks(row), []).append(row)
+
+    reports = []
+    for key, group in groups.items():
+        through = dict(zip(WATERMARKS.values(), key))
+        group_ids = [row.user_id for row in group]
+        movements = _movements(min(group_ids), max(group_ids), through, through, group_ids)
+        for row in group:
+            report = _drift_report(
+                row,
+                accounts[row.user_id].token_balance,
+                pending.get(row.user_id, 0),
+                _tail(movements.get(row.user_id, {})),
+            )
+            if row.drift:
+                reports.append(report)
+    BalanceReconciliation.objects.bulk_update(
+        [row for group in groups.values() for row in group], ["drift"]
+    )
+    return reports
+
+
+def reset_reconciliations():
+    """Forget every account's sums, so the next run recounts all history."""
+    return BalanceReconciliation.objects.all().delete()[0]
@@ -0,0 +1,234 @@
+"""
+Vendor sales rollups.
+
+``record_sales`` adds new purchases to ``VendorSalesRollup`` (one row per
+vendor, product, hour or day, and shard) in the purchase's transaction, with
+a single ``INSERT ... ON CONFLICT DO UPDATE`` for all the rows a purchase or
+checkout touches. Whether a buyer is new to a bucket is decided from their
+latest earlier purchase of the product (one query on the buyer's purchases);
+purchases of one buyer are serialized by the lock on their account row, so
+the count stays exact.
+
+``rebuild_rollups`` (the ``rebuild_sales_rollups`` command) recomputes the
+table from the purchases, e.g. after a backfill or a bug fix.
+"""
+import random
+from datetime import timezone as dt_timezone
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Max, Sum
+from django.db.models.functions import TruncDay, TruncHour
+
+from .models import Purchase, VendorSalesRollup
+
+PERIODS = {
+    VendorSalesRollup.PERIOD_HOUR: TruncHour,
+    VendorSalesRollup.PERIOD_DAY: TruncDay,
+}
+
+
+def bucket_start(when, period):
+    when = when.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if period == VendorSalesRollup.PERIOD_DAY:
+        when = when.replace(hour=0)
+    return when
+
+
+def _can_upsert():
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        return connection.Database.sqlite_version_info >= (3, 24, 0)
+    return False
+
+
+def _upsert(rows):
+    """Add ``{(vendor, product, period, start, shard): [units, tokens, buyers]}``."""
+    if _can_upsert():
+        qn = connection.ops.quote_name
+        table = qn(VendorSalesRollup._meta.db_table)
+        key = ", ".join(qn(c) for c in ("vendor_id", "product_id", "period", "bucket_start", "shard"))
+        values, params = [], []
+        for (vendor_id, product_id, period, start, shard), (units, tokens, buyers) in rows.items():
+            values.append("(%s, %s, %s, %s, %s, %s, %s, %s)")
+            params += [
+                vendor_id,
+                product_id,
+                period,
+                connection.ops.adapt_datetimefield_value(start),
+                shard,
+                units,
+                tokens,
+                buyers,
+            ]
+        sets = ", ".join(
+            f"{qn(c)} = {table}.{qn(c)} + EXCLUDED.{qn(c)}" for c in ("units", "tokens", "buyers")
+        )
+        sql = (
+            f"INSERT INTO {table} ({key}, {qn('units')}, {qn('tokens')}, {qn('buyers')}) "
+            f"VALUES {', '.join(values)} ON CONFLICT ({key}) DO UPDATE SET {sets}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        return
+
+    for (vendor_id, product_id, period, start, shard), (units, tokens, buyers) in rows.items():
+        lookup = dict(
+            vendor_id=vendor_id,
+            product_id=product_id,
+            period=period,
+            bucket_start=start,
+            shard=shard,
+        )
+        changes = dict(
+            units=F("units") + units,
+            tokens=F("tokens") + tokens,
+            buyers=F("buyers") + buyers,
+        )
+        if VendorSalesRollup.objects.filter(**lookup).update(**changes):
+            continue
+        try:
+            with transaction.atomic():
+                VendorSalesRollup.objects.create(
+                    **lookup, units=units, tokens=tokens, buyers=buyers
+                )
+        except IntegrityError:
+            # Created concurrently
+            VendorSalesRollup.objects.filter(**lookup).update(**changes)
+
+
+def record_sales(purchases, shards=None):
+    """
+    Add saved ``purchases`` to the rollups; call in the transaction that
+    created them. ``shards`` maps vendor ids to their ``credit_shards``.
+    """
+    purchases = [p for p in purchases if p.vendor_id]
+    if not purchases:
+        return
+    shards = shards or {}
+
+    # Latest earlier purchase of each (buyer, product) today or later
+    earliest_day = min(bucket_start(p.created_at, VendorSalesRollup.PERIOD_DAY) for p in purchases)
+    previous = {
+        (row["user_id"], row["product_id"]): row["last"]
+        for row in Purchase.objects.filter(
+            user_id__in={p.user_id for p in purchases},
+            product_id__in={p.product_id for p in purchases},
+            created_at__gte=earliest_day,
+        )
+        .exclude(pk__in=[p.pk for p in purchases])
+        .values("user_id", "product_id")
+        .annotate(last=Max("created_at"))
+    }
+
+    rows = {}
+    for purchase in sorted(purchases, key=lambda p: p.created_at):
+        pair = (purchase.user_id, purchase.product_id)
+        last = previous.get(pair)
+        shard = random.randrange(shards[purchase.vendor_id]) if shards.get(purchase.vendor_id) else 0
+        for period in PERIODS:
+            start = bucket_start(purchase.created_at, period)
+            key = (purchase.vendor_id, purchase.product_id, period, start, shard)
+            totals = rows.setdefault(key, [0, 0, 0])
+            totals[0] += purchase.quantity
+            totals[1] += purchase.total_tokens
+            if last is None or last < start:
+                totals[2] += 1
+        previous[pair] = purchase.created_at
+    _upsert(rows)
+
+
+def rebuild_rollups(vendor_id=None, batch_size=1000):
+    """
+    Recompute the rollups (of one vendor, or all) from the purchase table.
+    Returns the number of rows written. Run it while no purchases are being
+    made for those vendors, or they may be counted twice.
+    """
+    written = 0
+    with transaction.atomic():
+        rollups = VendorSalesRollup.objects.all()
+        purchases = Purchase.objects.filter(vendor__isnull=False)
+        if vendor_id is not None:
+            rollups = rollups.filter(vendor_id=vendor_id)
+            purchases = purchases.filter(vendor_id=vendor_id)
+        rollups.delete()
+
+        for period, trunc in PERIODS.items():
+            groups = (
+                purchases.annotate(start=trunc("created_at", tzinfo=dt_timezone.utc))
+                .values("vendor_id", "product_id", "start")
+                .annotate(
+                    units=Sum("quantity"),
+                    tokens=Sum("total_tokens"),
+                    buyers=Count("user_id", distinct=True),
+                )
+                .order_by()
+            )
+            batch = []
+            for group in groups.iterator(chunk_size=batch_size):
+                batch.append(
+                    VendorSalesRollup(
+                        vendor_id=group["vendor_id"],
+                        product_id=group["product_id"],
+                        period=period,
+                        bucket_start=group["start"],
+                        units=group["units"],
+                        tokens=group["tokens"],
+                        buyers=group["buyers"],
+                    )
+                )
+                if len(batch) >= batch_size:
+                    VendorSalesRollup.objects.bulk_create(batch)
+                    written += len(batch)
+                    batch = []
+            VendorSalesRollup.objects.bulk_create(batch)
+            written += len(batch)
+    return written
+
+
+def _figures():
+    return dict(units=Sum("units"), tokens=Sum("tokens"), buyers=Sum("buyers"))
+
+
+def product_sales(vendor, since=None):
+    """``{product_id: {"units", "tokens", "buyers"}}`` from the daily rollups."""
+    rollups = VendorSalesRollup.objects.filter(
+        vendor=vendor, period=VendorSalesRollup.PERIOD_DAY
+    )
+    if since is not None:
+        rollups = rollups.filter(
+            bucket_start__gte=bucket_start(since, VendorSalesRollup.PERIOD_DAY)
+        )
+    return {
+        row.pop("product_id"): row
+        for row in rollups.values("product_id").annotate(**_figures()).order_by()
+    }
+
+
+def sales_summary(vendor, period, since=None, until=None, product_id=None):
+    """
+    Totals, per-bucket and per-product figures of ``vendor``'s sales from
+    the rollups. ``buyers`` is summed over products and buckets, so a buyer
+    of several products (or in several buckets) counts more than once.
+    """
+    rollups = VendorSalesRollup.objects.filter(vendor=vendor, period=period)
+    if since is not None:
+        rollups = rollups.filter(bucket_start__gte=bucket_start(since, period))
+    if until is not None:
+        rollups = rollups.filter(bucket_start__lt=until)
+    if product_id is not None:
+        rollups = rollups.filter(product_id=product_id)
+
+    figures = _figures()
+    totals = rollups.aggregate(**figures)
+    buckets = rollups.values("bucket_start").annotate(**figures).order_by("bucket_start")
+    products = (
+        rollups.values("product_id", "product__name")
+        .annotate(**figures)
+        .order_by("-tokens", "product_id")
+    )
+    return {
+        "totals": {name: totals[name] or 0 for name in figures},
+        "buckets": list(buckets),
+        "products": list(products),
+    }
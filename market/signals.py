@@ -0,0 +1,44 @@
+"""
+Cache invalidation hooks. Connected from MarketConfig.ready().
+"""
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .apikeys import invalidate_api_key
+from .catalogue import bump_catalogue_version
+from .models import Product, UserTokenAccount, VendorAPIKey
+from .usercontext import invalidate_user_context
+
+
+@receiver(post_save, sender=VendorAPIKey)
+@receiver(post_delete, sender=VendorAPIKey)
+def invalidate_cached_api_key(sender, instance, **kwargs):
+    invalidate_api_key(instance.key_hash)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_context_on_group_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == "pre_clear":
+        # group.user_set.clear(): the members are gone by post_clear. The
+        # invalidation still only happens once the transaction commits.
+        invalidate_user_context(*instance.user_set.values_list("pk", flat=True))
+        return
+    if not action.startswith("post_") or (reverse and action == "post_clear"):
+        return
+    if not reverse:
+        invalidate_user_context(instance.pk)
+    else:
+        # group.user_set.add(...): instance is the Group
+        invalidate_user_context(*pk_set)
+
+
+@receiver(post_save, sender=UserTokenAccount)
+def invalidate_context_on_account_save(sender, instance, **kwargs):
+    invalidate_user_context(instance.user_id)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_catalogue(sender, **kwargs):
+    bump_catalogue_version()
@@ -1,11 +1,11 @@
 # market/templatetags/market_tags.py
 from django import template
 
+from market.usercontext import user_is_vendor
+
 register = template.Library()
 
 @register.filter
 def is_vendor(user):
     """Return True if the user is staff or in the Vendors group."""
-    if not user.is_authenticated:
-        return False
-    return user.is_staff or user.groups.filter(name="Vendors").exists()
+    return user_is_vendor(user)
@@ -1,3 +1,429 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import catalogue
+from .checkout import CheckoutError, checkout_cart
+from .imports import FORMAT_CSV, import_products, iter_rows
+from .inventory import available_stock, reserve_stock, set_stock
+from .ledger import balance_at, snapshot_account
+from .locking import InsufficientFunds, move_tokens
+from .models import (
+    CartItem,
+    LedgerEntry,
+    Product,
+    Purchase,
+    StockReservation,
+    TokenTransfer,
+    UserTokenAccount,
+    UserTokenAccountManager,
+    VendorAPIKey,
+    VendorCreditShard,
+    VendorSalesRollup,
+    VendorWebhook,
+    WebhookDelivery,
+)
+from .usercontext import VENDOR_GROUP, get_user_context
+from .webhooks import DeliveryResult, claim_due_deliveries, record_results
+
+
+def make_user(username, balance=0):
+    user = User.objects.create_user(username)
+    UserTokenAccount.objects.filter(user=user).update(token_balance=balance)
+    return user
+
+
+def balance_of(user):
+    return UserTokenAccount.objects.get(user=user).token_balance
+
+
+class BatchTransferPayloadTests(TestCase):
+    def setUp(self):
+        self.vendor = make_user("vendor", 100)
+        self.key = VendorAPIKey.objects.create(vendor=self.vendor, name="test")
+
+    def post(self, body):
+        return self.client.post(
+            reverse("api_transfer_tokens_batch"),
+            json.dumps(body),
+            content_type="application/json",
+            HTTP_X_API_KEY=self.key.raw_key,
+        )
+
+    def test_body_must_be_an_object(self):
+        User.objects.create_user("alice")
+        for body in ([{"recipient_username": "alice", "amount_tokens": 5}], 42, "transfers"):
+            with self.subTest(body=body):
+                response = self.post(body)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("error", response.json())
+        self.assertFalse(TokenTransfer.objects.exists())
+        self.assertEqual(balance_of(self.vendor), 100)
+
+    def test_null_description_is_empty_and_non_strings_are_rejected(self):
+        User.objects.create_user("alice")
+        response = self.post(
+            {
+                "mode": "best_effort",
+                "transfers": [
+                    {"recipient_username": "alice", "amount_tokens": 5, "description": None},
+                    {"recipient_username": "alice", "amount_tokens": 5, "description": 5},
+                ],
+            }
+        )
+        self.assertEqual(response.status_code, 201)
+        results = response.json()["results"]
+        self.assertEqual(results[0]["status"], "ok")
+        self.assertEqual(results[1]["status"], "error")
+        self.assertEqual(results[1]["error"], "description must be a string")
+        self.assertEqual(TokenTransfer.objects.get().description, "")
+        self.assertEqual(balance_of(self.vendor), 95)
+
+
+class BalanceUpdateTests(TestCase):
+    """``UserTokenAccountManager`` on both the RETURNING and the fallback path."""
+
+    def run_both_paths(self, check):
+        for returning in (True, False):
+            with self.subTest(returning=returning), mock.patch(
+                "market.models._can_update_returning", return_value=returning
+            ):
+                with transaction.atomic():
+                    check()
+                    transaction.set_rollback(True)
+
+    def test_debit_and_credit(self):
+        user = make_user("alice", 100)
+
+        def check():
+            self.assertEqual(UserTokenAccount.objects.debit(user.pk, 30), 70)
+            self.assertEqual(UserTokenAccount.objects.credit(user.pk, 5), 75)
+            self.assertEqual(balance_of(user), 75)
+
+        self.run_both_paths(check)
+
+    def test_overdraw_fails_and_changes_nothing(self):
+        user = make_user("alice", 10)
+
+        def check():
+            self.assertIsNone(UserTokenAccount.objects.debit(user.pk, 11, purchase=True))
+            account = UserTokenAccount.objects.get(user=user)
+            self.assertEqual(account.token_balance, 10)
+            self.assertEqual(account.total_spent, 0)
+            self.assertEqual(account.purchase_count, 0)
+
+        self.run_both_paths(check)
+
+    def test_purchase_bumps_running_totals(self):
+        user = make_user("alice", 100)
+
+        def check():
+            UserTokenAccount.objects.debit(user.pk, 30, purchase=True)
+            UserTokenAccount.objects.debit(user.pk, 20, purchase=True)
+            UserTokenAccount.objects.debit(user.pk, 5)
+            account = UserTokenAccount.objects.get(user=user)
+            self.assertEqual(account.token_balance, 45)
+            self.assertEqual(account.total_spent, 50)
+            self.assertEqual(account.purchase_count, 2)
+
+        self.run_both_paths(check)
+
+    def test_missing_account(self):
+        def check():
+            self.assertIsNone(UserTokenAccount.objects.credit(10**9, 5))
+            self.assertIsNone(UserTokenAccount.objects.debit(10**9, 5))
+
+        self.run_both_paths(check)
+
+
+class MoveTokensTests(TestCase):
+    def setUp(self):
+        self.low = make_user("low", 50)
+        self.high = make_user("high", 50)
+
+    def applied_order(self, from_user, to_user, amount):
+        calls = []
+        original = UserTokenAccountManager._apply
+
+        def record(manager, user_id, *args, **kwargs):
+            calls.append(user_id)
+            return original(manager, user_id, *args, **kwargs)
+
+        with mock.patch.object(UserTokenAccountManager, "_apply", autospec=True, side_effect=record):
+            result = move_tokens(from_user.pk, to_user.pk, amount)
+        return calls, result
+
+    def test_updates_accounts_in_user_id_order(self):
+        for from_user, to_user in ((self.low, self.high), (self.high, self.low)):
+            with self.subTest(from_user=from_user.username):
+                calls, _ = self.applied_order(from_user, to_user, 1)
+                self.assertEqual(calls, [self.low.pk, self.high.pk])
+
+    def test_returns_both_balances(self):
+        _, balances = self.applied_order(self.high, self.low, 20)
+        self.assertEqual(balances, (30, 70))
+        self.assertEqual((balance_of(self.low), balance_of(self.high)), (70, 30))
+
+    def test_insufficient_funds_undoes_the_credit(self):
+        # The credit to the lower id is applied first and must be rolled back
+        with self.assertRaises(InsufficientFunds):
+            move_tokens(self.high.pk, self.low.pk, 51)
+        self.assertEqual((balance_of(self.low), balance_of(self.high)), (50, 50))
+
+    def test_purchase_flag_bumps_buyer_totals(self):
+        move_tokens(self.high.pk, self.low.pk, 20, purchase=True)
+        buyer = UserTokenAccount.objects.get(user=self.high)
+        self.assertEqual((buyer.total_spent, buyer.purchase_count), (20, 1))
+        vendor = UserTokenAccount.objects.get(user=self.low)
+        self.assertEqual((vendor.total_spent, vendor.purchase_count), (0, 0))
+
+
+class SnapshotTests(TestCase):
+    def test_entries_committed_out_of_order_are_not_lost(self):
+        user = make_user("alice")
+        now = timezone.now()
+        cutoff = now - timedelta(minutes=5)
+
+        def entry(amount, created_at):
+            LedgerEntry.objects.create(
+                user=user, kind=LedgerEntry.KIND_TOPUP, amount_tokens=amount, created_at=created_at
+            )
+
+        # The second id is newer than the cutoff, the third (committed
+        # later with an older timestamp) isn't
+        entry(1, cutoff - timedelta(minutes=2))
+        entry(10, cutoff + timedelta(minutes=1))
+        entry(100, cutoff - timedelta(minutes=1))
+
+        first = snapshot_account(user.pk, cutoff)
+        self.assertEqual(first.balance, 1)
+        second = snapshot_account(user.pk, now + timedelta(minutes=1))
+        self.assertEqual(second.balance, 111)
+        self.assertEqual(balance_at(user), 111)
+        self.assertIsNone(snapshot_account(user.pk, now + timedelta(minutes=1)))
+
+
+class UserContextInvalidationTests(TestCase):
+    def is_vendor(self, user):
+        # A fresh instance, so only the cache can remember the old answer
+        return get_user_context(User.objects.get(pk=user.pk))["is_vendor"]
+
+    def test_clearing_a_group_from_its_side(self):
+        group = Group.objects.create(name=VENDOR_GROUP)
+        users = [make_user("alice"), make_user("bob")]
+        with self.captureOnCommitCallbacks(execute=True):
+            group.user_set.add(*users)
+        self.assertEqual([self.is_vendor(user) for user in users], [True, True])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            group.user_set.clear()
+        self.assertEqual([self.is_vendor(user) for user in users], [False, False])
+
+
+class CataloguePageCacheTests(TestCase):
+    @override_settings(UPBT_CATALOGUE_CACHE_TTL=300, UPBT_CATALOGUE_LOCAL_CACHE_TTL=7)
+    def test_per_process_cache_keeps_pages_briefly(self):
+        # The test settings use the default LocMem cache
+        with mock.patch.object(catalogue.LocMemCache, "set") as cache_set:
+            catalogue.catalogue_page(catalogue.normalize_params({}))
+        self.assertEqual(cache_set.call_args.args[2], 7)
+
+
+class CircuitBreakerProbeTests(TestCase):
+    def setUp(self):
+        vendor = make_user("vendor")
+        self.webhook = VendorWebhook.objects.create(
+            vendor=vendor,
+            url="https://example.com/hook",
+            consecutive_failures=10,
+            circuit_open_until=timezone.now() - timedelta(seconds=1),
+        )
+        for index in range(3):
+            WebhookDelivery.objects.create(
+                webhook=self.webhook, event="test", payload=json.dumps({"n": index})
+            )
+
+    def test_one_probe_while_half_open(self):
+        probe = claim_due_deliveries(10)
+        self.assertEqual(len(probe), 1)
+        self.webhook.refresh_from_db()
+        self.assertGreater(self.webhook.circuit_open_until, timezone.now())
+        # The probe is still out: later rounds send nothing
+        self.assertEqual(claim_due_deliveries(10), [])
+
+    def test_probe_result_closes_or_reopens_the_circuit(self):
+        for error, closed in (("", True), ("HTTP 500", False)):
+            with self.subTest(error=error):
+                VendorWebhook.objects.filter(pk=self.webhook.pk).update(
+                    consecutive_failures=10,
+                    circuit_open_until=timezone.now() - timedelta(seconds=1),
+                )
+                probe = claim_due_deliveries(10)
+                self.assertEqual(len(probe), 1)
+                record_results(probe, [DeliveryResult(error, 200 if closed else 500, 5)])
+                self.webhook.refresh_from_db()
+                if closed:
+                    self.assertIsNone(self.webhook.circuit_open_until)
+                else:
+                    self.assertGreater(
+                        self.webhook.circuit_open_until, timezone.now() + timedelta(seconds=60)
+                    )
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        self.buyer = make_user("buyer", 100)
+        self.direct = make_user("direct")
+        self.sharded = make_user("sharded")
+        UserTokenAccount.objects.filter(user=self.sharded).update(credit_shards=4)
+        self.plain = Product.objects.create(
+            name="plain", price_tokens=5, owner=self.direct, stock=10
+        )
+        self.unlimited = Product.objects.create(name="unlimited", price_tokens=3, owner=self.direct)
+        self.bucketed = Product.objects.create(
+            name="bucketed", price_tokens=7, owner=self.sharded, stock_buckets=3
+        )
+        set_stock(self.bucketed, 9)
+        self.bucketed.refresh_from_db()
+
+    def fill_cart(self, plain=2, unlimited=1, bucketed=3):
+        CartItem.objects.create(user=self.buyer, product=self.plain, quantity=plain)
+        CartItem.objects.create(user=self.buyer, product=self.unlimited, quantity=unlimited)
+        CartItem.objects.create(user=self.buyer, product=self.bucketed, quantity=bucketed)
+        reserve_stock(self.buyer, self.bucketed, bucketed)
+
+    def tokens_in_play(self):
+        spendable = sum(balance_of(user) for user in (self.buyer, self.direct, self.sharded))
+        pending = sum(VendorCreditShard.objects.values_list("pending_tokens", flat=True))
+        return spendable + pending
+
+    def assert_nothing_changed(self):
+        self.assertEqual(balance_of(self.buyer), 100)
+        self.assertEqual(self.tokens_in_play(), 100)
+        self.assertEqual(CartItem.objects.filter(user=self.buyer).count(), 3)
+        self.assertFalse(Purchase.objects.exists())
+        self.assertFalse(LedgerEntry.objects.exists())
+        self.assertFalse(VendorSalesRollup.objects.exists())
+
+    def test_multi_vendor_checkout_conserves_tokens(self):
+        self.fill_cart()
+        purchases = checkout_cart(self.buyer)
+
+        self.assertEqual(len(purchases), 3)
+        self.assertEqual(balance_of(self.buyer), 100 - (10 + 3 + 21))
+        self.assertEqual(balance_of(self.direct), 13)
+        # Sharded vendor: credited through its shards, not its balance
+        self.assertEqual(balance_of(self.sharded), 0)
+        pending = VendorCreditShard.objects.filter(user=self.sharded)
+        self.assertEqual(sum(pending.values_list("pending_tokens", flat=True)), 21)
+        self.assertEqual(self.tokens_in_play(), 100)
+        buyer_account = UserTokenAccount.objects.get(user=self.buyer)
+        self.assertEqual((buyer_account.total_spent, buyer_account.purchase_count), (34, 3))
+
+        self.assertEqual(available_stock(self.plain), 8)
+        self.assertEqual(available_stock(self.bucketed), 6)
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertFalse(CartItem.objects.filter(user=self.buyer).exists())
+
+    def test_ledger_and_rollups_match_purchases(self):
+        self.fill_cart()
+        purchases = checkout_cart(self.buyer)
+
+        for purchase in purchases:
+            entries = dict(
+                LedgerEntry.objects.filter(purchase=purchase).values_list("kind", "amount_tokens")
+            )
+            self.assertEqual(
+                entries,
+                {
+                    LedgerEntry.KIND_PURCHASE: -purchase.total_tokens,
+                    LedgerEntry.KIND_SALE: purchase.total_tokens,
+                },
+            )
+            self.assertEqual(
+                LedgerEntry.objects.get(purchase=purchase, kind=LedgerEntry.KIND_SALE).user_id,
+                purchase.vendor_id,
+            )
+
+        for period in (VendorSalesRollup.PERIOD_HOUR, VendorSalesRollup.PERIOD_DAY):
+            for purchase in purchases:
+                rollups = VendorSalesRollup.objects.filter(
+                    period=period, vendor=purchase.vendor, product=purchase.product
+                )
+                totals = [
+                    sum(rollups.values_list(field, flat=True))
+                    for field in ("units", "tokens", "buyers")
+                ]
+                self.assertEqual(totals, [purchase.quantity, purchase.total_tokens, 1])
+
+    def test_insufficient_funds_rolls_everything_back(self):
+        UserTokenAccount.objects.filter(user=self.buyer).update(token_balance=30)
+        self.fill_cart()
+        with self.assertRaises(InsufficientFunds):
+            checkout_cart(self.buyer)
+
+        self.assertEqual(balance_of(self.buyer), 30)
+        self.assertEqual(CartItem.objects.filter(user=self.buyer).count(), 3)
+        self.assertFalse(Purchase.objects.exists())
+        self.assertEqual(available_stock(self.plain), 10)
+        # The reservation (and the units it holds) survives
+        self.assertEqual(StockReservation.objects.get(user=self.buyer).quantity, 3)
+        self.assertEqual(available_stock(self.bucketed), 6)
+
+    def test_out_of_stock_line_rolls_back_the_order(self):
+        self.fill_cart(plain=11)
+        with self.assertRaises(CheckoutError):
+            checkout_cart(self.buyer)
+
+        self.assert_nothing_changed()
+        self.assertEqual(available_stock(self.plain), 10)
+        self.assertEqual(StockReservation.objects.get(user=self.buyer).quantity, 3)
+        self.assertEqual(available_stock(self.bucketed), 6)
+
+    def test_empty_cart(self):
+        with self.assertRaises(CheckoutError):
+            checkout_cart(self.buyer)
+
+
+class ProductImportTests(TestCase):
+    def setUp(self):
+        self.vendor = make_user("vendor")
+        self.product = Product.objects.create(
+            owner=self.vendor, sku="A-1", name="Old name", description="Kept", price_tokens=5
+        )
+
+    def run_import(self, text):
+        return import_products(self.vendor, iter_rows(text.splitlines(True), FORMAT_CSV))
+
+    def test_creates_and_updates_by_sku(self):
+        result = self.run_import("sku,name,price_tokens\nA-1,New name,5\nB-2,Other,9\n")
+        self.assertEqual((result["created"], result["updated"], result["failed"]), (1, 1, 0))
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.name, self.product.description), ("New name", "Kept"))
+        self.assertEqual(Product.objects.get(owner=self.vendor, sku="B-2").price_tokens, 9)
+
+    def test_only_changed_fields_are_written(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.run_import("sku,price_tokens\nA-1,7\n")
+        updates = [q["sql"] for q in queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"price_tokens"', updates[0])
+        for field in ("name", "description", "active"):
+            self.assertNotIn(f'"{field}" =', updates[0])
+
+    def test_repeated_conflicts_report_rows_as_failed(self):
+        with mock.patch("market.imports._write_chunk", side_effect=IntegrityError), mock.patch(
+            "market.imports.time.sleep"
+        ):
+            result = self.run_import("sku,name,price_tokens\nA-1,X,1\nB-2,Y,2\n")
+        self.assertEqual(result["failed"], 2)
+        self.assertEqual([error["sku"] for error in result["errors"]], ["A-1", "B-2"])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.name, "Old name")
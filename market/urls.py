@@ -7,12 +7,16 @@ urlpatterns = [
     path("products/", views.product_list, name="product_list"),
     path("products/<int:pk>/", views.product_detail, name="product_detail"),
     path("products/<int:pk>/buy/", views.buy_product, name="buy_product"),
+    path("cart/", views.cart_view, name="cart"),
+    path("cart/add/<int:pk>/", views.cart_add, name="cart_add"),
+    path("cart/checkout/", views.cart_checkout, name="cart_checkout"),
     path("dashboard/", views.dashboard, name="dashboard"),
 
     
     # Vendor
     path("vendor/products/", views.my_products, name="my_products"),
     path("vendor/products/new/", views.product_create, name="product_create"),
+    path("vendor/products/import/", views.product_import, name="product_import"),
     path("vendor/products/<int:pk>/edit/", views.product_edit, name="product_edit"),
     path("vendor/api-keys/", views.vendor_api_keys, name="vendor_api_keys"),
 
@@ -20,9 +24,19 @@ urlpatterns = [
     path("tokens/buy/", views.buy_tokens, name="buy_tokens"),
 
     # API endpoints for vendors
+    path("api/vendor/purchases/", views.api_vendor_purchases, name="api_vendor_purchases"),
     path("api/vendor/purchases/<int:pk>/", views.api_purchase_detail, name="api_purchase_detail"),
+    path("api/vendor/products/import/", views.api_vendor_products_import, name="api_vendor_products_import"),
+    path("api/vendor/stats/", views.api_vendor_stats, name="api_vendor_stats"),
+    path("api/vendor/export/<str:kind>/", views.api_vendor_export, name="api_vendor_export"),
     path("api/vendor/transfer/", views.api_transfer_tokens, name="api_transfer_tokens"),
+    path("api/vendor/transfer/batch/", views.api_transfer_tokens_batch, name="api_transfer_tokens_batch"),
     path("vendor/webhooks/", views.vendor_webhooks, name="vendor_webhooks"),
 
+    # Monitoring (staff only)
+    path("ops/lock-metrics/", views.lock_metrics_view, name="lock_metrics"),
+    path("ops/api-usage/", views.api_usage_view, name="api_usage"),
+    path("metrics/", views.metrics_view, name="metrics"),
+
 ]
 
@@ -0,0 +1,62 @@
+"""
+Per-request (and briefly per-user) cache of what every page needs to know
+about the logged-in user: whether they are a vendor and their balance.
+
+Resolved at most once per request (memoized on the user object) and kept in
+the Django cache for ``UPBT_USER_CONTEXT_TTL`` seconds. Entries are dropped
+when group membership changes (see signals.py) and after every committed
+balance update (see UserTokenAccountManager).
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+VENDOR_GROUP = "Vendors"
+
+
+def _cache():
+    return caches[getattr(settings, "UPBT_USER_CONTEXT_CACHE_ALIAS", "default")]
+
+
+def _cache_key(user_id):
+    return f"upbt:userctx:{user_id}"
+
+
+def _load(user):
+    from .models import UserTokenAccount
+
+    account = UserTokenAccount.objects.filter(user_id=user.pk).first()
+    return {
+        "is_vendor": user.groups.filter(name=VENDOR_GROUP).exists(),
+        "balance": account.total_balance if account else 0,
+    }
+
+
+def get_user_context(user):
+    """Return ``{"is_vendor": bool, "balance": int}`` for an authenticated user."""
+    context = getattr(user, "_market_context", None)
+    if context is None:
+        cache = _cache()
+        context = cache.get(_cache_key(user.pk))
+        if context is None:
+            context = _load(user)
+            cache.set(
+                _cache_key(user.pk),
+                context,
+                getattr(settings, "UPBT_USER_CONTEXT_TTL", 30),
+            )
+        user._market_context = context
+    return context
+
+
+def user_is_vendor(user):
+    """Staff users or members of the Vendors group."""
+    if not user.is_authenticated:
+        return False
+    return user.is_staff or get_user_context(user)["is_vendor"]
+
+
+def invalidate_user_context(*user_ids, using=None):
+    """Drop cached context once the current transaction (if any) commits."""
+    keys = [_cache_key(user_id) for user_id in user_ids]
+    transaction.on_commit(lambda: _cache().delete_many(keys), using=using)
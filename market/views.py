@@ -1,20 +1,28 @@
+from asgiref.sync import sync_to_async
 from django.contrib import messages
 from django.contrib.auth import login
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import User
 from django.shortcuts import render, redirect, get_object_or_404
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.conf import settings
 from django.db import transaction
-from django.db.models import F
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_datetime
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
+from datetime import timedelta
+import codecs
 import json
-import hmac
-import hashlib
-import requests
 
+from . import catalogue, exports, imports, ledger
 from .forms import SignUpForm, ProductForm, BuyTokensForm
 from .models import (
+    CartItem,
     Product,
     Purchase,
     UserTokenAccount,
@@ -22,7 +30,37 @@ from .models import (
     VendorAPIKey,
     TokenTransfer,
     VendorWebhook,
+    LedgerEntry,
+    StockReservation,
+    VendorSalesRollup,
 )
+from .apikeys import get_api_key_from_request
+from .checkout import CheckoutError, checkout_cart
+from .conditional import make_etag, not_modified, set_validators
+from .credits import credit_sale
+from .inventory import (
+    OutOfStock,
+    available_stock,
+    release_stock,
+    reserve_stock,
+    respread_stock,
+    set_stock,
+    take_stock,
+)
+from .idempotency import idempotent, user_scope
+from .instrumentation import render_metrics
+from .pagination import keyset_page
+from .rollups import product_sales, record_sales, sales_summary
+from .ratelimit import api_usage, seconds_until_quota_reset, transfer_quota_remaining
+from .locking import (
+    InsufficientFunds,
+    atomic_with_retry,
+    lock_accounts,
+    lock_metrics,
+    move_tokens,
+)
+from .usercontext import get_user_context, invalidate_user_context, user_is_vendor
+from .webhooks import enqueue_purchase_webhooks
 
 
 def home(request):
@@ -44,13 +82,55 @@ def signup_view(request):
 
 
 def product_list(request):
-    products = Product.objects.filter(active=True)
-    return render(request, "product_list.html", {"products": products})
+    params = catalogue.normalize_params(request.GET)
+    page = catalogue.catalogue_page(params)
+    # Query string without "page", for the pagination links
+    query = request.GET.copy()
+    query.pop("page", None)
+    return render(
+        request,
+        "product_list.html",
+        {
+            "products": page["products"],
+            "page": page,
+            "params": params,
+            "query": query.urlencode(),
+        },
+    )
 
 
 def product_detail(request, pk):
     product = get_object_or_404(Product, pk=pk, active=True)
-    return render(request, "product_detail.html", {"product": product})
+
+    # A cached copy wouldn't show pending flash messages, so always render then
+    if len(messages.get_messages(request)):
+        return render(request, "product_detail.html", {"product": product})
+
+    # The page embeds the navbar, so the validator covers the viewer too
+    user = request.user
+    viewer = ("anonymous",)
+    if user.is_authenticated:
+        context = get_user_context(user)
+        viewer = (user.pk, user.is_staff, context["is_vendor"], context["balance"])
+    # Sales change the stock without touching updated_at
+    etag = make_etag(
+        "product", product.pk, product.updated_at.isoformat(), product.stock, *viewer
+    )
+
+    response = not_modified(request, etag, product.updated_at) or render(
+        request, "product_detail.html", {"product": product}
+    )
+    if user.is_authenticated:
+        return set_validators(
+            response, etag, product.updated_at, private=True, no_cache=True
+        )
+    return set_validators(
+        response,
+        etag,
+        product.updated_at,
+        public=True,
+        max_age=getattr(settings, "UPBT_PRODUCT_PAGE_MAX_AGE", 60),
+    )
 
 
 # @login_required
@@ -96,9 +176,12 @@ def product_detail(request, pk):
 #     return redirect("dashboard")
 
 @login_required
-@transaction.atomic
+@atomic_with_retry
+@idempotent(user_scope, replay_message="This purchase was already processed.")
 def buy_product(request, pk):
-    product = get_object_or_404(Product, pk=pk, active=True)
+    product = get_object_or_404(
+        Product.objects.select_related("owner__token_account"), pk=pk, active=True
+    )
 
     if request.method != "POST":
         return redirect("product_detail", pk=product.pk)
@@ -108,35 +191,51 @@ def buy_product(request, pk):
         messages.error(request, "Quantity must be at least 1.")
         return redirect("product_detail", pk=product.pk)
 
-    # Buyer account (locked)
-    buyer_account = UserTokenAccount.objects.select_for_update().get(user=request.user)
     total_cost = product.price_tokens * quantity
+    vendor = product.owner
+    vendor_account = getattr(vendor, "token_account", None) if vendor else None
 
-    if buyer_account.token_balance < total_cost:
+    # Take the stock (if limited), then debit buyer and credit vendor with
+    # one conditional UPDATE each; the savepoint undoes the stock on failure
+    try:
+        with transaction.atomic():
+            take_stock({product: quantity})
+            if vendor_account and not vendor_account.credit_shards:
+                move_tokens(request.user.pk, vendor.pk, total_cost, purchase=True)
+            else:
+                if UserTokenAccount.objects.debit(
+                    request.user.pk, total_cost, purchase=True
+                ) is None:
+                    raise InsufficientFunds()
+                if vendor_account:
+                    # Hot vendor: credit a random shard instead of the account row
+                    credit_sale(vendor.pk, total_cost, vendor_account.credit_shards)
+                else:
+                    # Vendor without a token account: the buyer still pays
+                    vendor = None
+    except OutOfStock:
+        messages.error(request, f"Sorry, there isn't enough stock of {product.name} left.")
+        return redirect("product_detail", pk=product.pk)
+    except InsufficientFunds:
         messages.error(request, "Not enough UPBolis to buy this product.")
         return redirect("product_detail", pk=product.pk)
 
-    # 1) Deduct from buyer
-    buyer_account.token_balance = F("token_balance") - total_cost
-    buyer_account.save()
-
-    # 2) Credit vendor (if product has an owner with a token account)
-    vendor = product.owner
-    if vendor and hasattr(vendor, "token_account"):
-        vendor_account = UserTokenAccount.objects.select_for_update().get(user=vendor)
-        vendor_account.token_balance = F("token_balance") + total_cost
-        vendor_account.save()
-
-    # 3) Register purchase
+    # Register purchase
     purchase = Purchase.objects.create(
         user=request.user,
         product=product,
+        vendor=product.owner,
         quantity=quantity,
         total_tokens=total_cost,
     )
+    ledger.record_purchase(purchase, vendor)
+    record_sales(
+        [purchase],
+        {vendor.pk: vendor_account.credit_shards} if vendor_account else None,
+    )
 
-    # 🔔 Send webhooks (non-blocking-ish, but inside same request)
-    send_purchase_webhooks(purchase)
+    # 🔔 Queue webhooks in this transaction; `deliver_webhooks` sends them
+    enqueue_purchase_webhooks(purchase)
 
     messages.success(
         request,
@@ -146,37 +245,188 @@ def buy_product(request, pk):
 
 
 
+@login_required
+def cart_view(request):
+    """Show the cart; a POST updates quantities (0 removes a line)."""
+    items = CartItem.objects.filter(user=request.user).select_related("product")
+
+    if request.method == "POST":
+        changes = []
+        for item in items:
+            value = request.POST.get(f"quantity_{item.pk}")
+            if value is None:
+                continue
+            try:
+                changes.append((item, max(int(value), 0)))
+            except ValueError:
+                messages.error(request, "Quantities must be whole numbers.")
+                return redirect("cart")
+        try:
+            with transaction.atomic():
+                for item, quantity in changes:
+                    # Reserved units of limited drops follow the cart
+                    if quantity > item.quantity:
+                        reserve_stock(request.user, item.product, quantity - item.quantity)
+                    elif quantity < item.quantity:
+                        release_stock(request.user, item.product, item.quantity - quantity)
+                    if not quantity:
+                        item.delete()
+                    elif quantity != item.quantity:
+                        item.quantity = quantity
+                        item.save(update_fields=["quantity"])
+        except OutOfStock as exc:
+            messages.error(request, f"{exc} left; your cart was not changed.")
+            return redirect("cart")
+        messages.success(request, "Your cart was updated.")
+        return redirect("cart")
+
+    held_until = dict(
+        StockReservation.objects.filter(user=request.user).values_list("product_id", "expires_at")
+    )
+    lines = [
+        (item, item.product.price_tokens * item.quantity, held_until.get(item.product_id))
+        for item in items
+    ]
+    return render(
+        request,
+        "cart.html",
+        {"lines": lines, "total": sum(subtotal for _, subtotal, _ in lines)},
+    )
+
+
+@login_required
+@atomic_with_retry
+def cart_add(request, pk):
+    product = get_object_or_404(Product, pk=pk, active=True)
+    if request.method != "POST":
+        return redirect("product_detail", pk=product.pk)
+
+    try:
+        quantity = int(request.POST.get("quantity", 1))
+    except ValueError:
+        quantity = 0
+    if quantity < 1:
+        messages.error(request, "Quantity must be at least 1.")
+        return redirect("product_detail", pk=product.pk)
+
+    line = CartItem.objects.filter(user=request.user, product=product)
+    max_lines = getattr(settings, "UPBT_CART_MAX_LINES", 100)
+    if not line.exists() and CartItem.objects.filter(user=request.user).count() >= max_lines:
+        messages.error(request, f"A cart can hold at most {max_lines} different products.")
+        return redirect("cart")
+
+    try:
+        # Limited drops: hold the units while they sit in the cart
+        reserve_stock(request.user, product, quantity)
+    except OutOfStock:
+        messages.error(request, f"Sorry, there isn't enough stock of {product.name} left.")
+        return redirect("product_detail", pk=product.pk)
+
+    if not line.update(quantity=F("quantity") + quantity):
+        _, created = CartItem.objects.get_or_create(
+            user=request.user, product=product, defaults={"quantity": quantity}
+        )
+        if not created:
+            # Added concurrently from another tab
+            line.update(quantity=F("quantity") + quantity)
+
+    messages.success(request, f"Added {quantity} x {product.name} to your cart.")
+    return redirect("cart")
+
+
+@login_required
+@atomic_with_retry
+@idempotent(user_scope, replay_message="This order was already processed.")
+def cart_checkout(request):
+    """Buy the whole cart in one transaction (see market/checkout.py)."""
+    if request.method != "POST":
+        return redirect("cart")
+
+    try:
+        purchases = checkout_cart(request.user)
+    except CheckoutError as exc:
+        messages.error(request, str(exc))
+        return redirect("cart")
+    except InsufficientFunds:
+        messages.error(request, "Not enough UPBolis to buy everything in your cart.")
+        return redirect("cart")
+
+    messages.success(
+        request,
+        f"You bought {len(purchases)} products for "
+        f"{sum(p.total_tokens for p in purchases)} UPBolis."
+    )
+    return redirect("dashboard")
+
+
 @login_required
 def dashboard(request):
+    """
+    Account summary plus one timeline of purchases, sales, top-ups and
+    transfers, read from the ledger newest first with keyset pagination.
+    """
     account = request.user.token_account
-    purchases = request.user.purchases.select_related("product").order_by("-created_at")
+    entries = LedgerEntry.objects.filter(user=request.user).select_related(
+        "transfer__from_user",
+        "transfer__to_user",
+    )
+    try:
+        entries, next_cursor = keyset_page(
+            entries,
+            cursor=request.GET.get("cursor"),
+            limit=getattr(settings, "UPBT_DASHBOARD_PAGE_SIZE", 25),
+            descending=True,
+        )
+    except ValueError:
+        return redirect("dashboard")
     return render(
         request,
         "dashboard.html",
-        {"account": account, "purchases": purchases},
+        {
+            "account": account,
+            "entries": entries,
+            "next_cursor": next_cursor,
+            "is_first_page": not request.GET.get("cursor"),
+        },
     )
 
 
 def is_vendor(user):
-    # staff users OR users in Vendors group
-    return user.is_staff or user.groups.filter(name="Vendors").exists()
+    # staff users OR users in Vendors group (cached per request/user)
+    return user_is_vendor(user)
 
 
 @login_required
 @user_passes_test(is_vendor)
 def my_products(request):
-    products = Product.objects.filter(owner=request.user).order_by("name")
-    return render(request, "my_products.html", {"products": products})
+    products = list(Product.objects.filter(owner=request.user).order_by("name"))
+    # Sales figures come from the daily rollups, not the purchase table
+    all_time = product_sales(request.user)
+    last_week = product_sales(request.user, since=timezone.now() - timedelta(days=6))
+    for product in products:
+        product.sales = all_time.get(product.pk)
+        product.sales_last_week = last_week.get(product.pk)
+    return render(
+        request,
+        "my_products.html",
+        {
+            "products": products,
+            "week_tokens": sum(row["tokens"] for row in last_week.values()),
+            "week_units": sum(row["units"] for row in last_week.values()),
+            "all_time_tokens": sum(row["tokens"] for row in all_time.values()),
+        },
+    )
 
 @login_required
 @user_passes_test(is_vendor)
 def product_create(request):
     if request.method == "POST":
-        form = ProductForm(request.POST)
+        form = ProductForm(request.POST, instance=Product(owner=request.user))
         if form.is_valid():
-            product = form.save(commit=False)
-            product.owner = request.user
-            product.save()
+            with transaction.atomic():
+                product = form.save()
+                if product.stock_buckets:
+                    set_stock(product, product.stock)
             messages.success(request, "Product created successfully.")
             return redirect("my_products")
     else:
@@ -188,18 +438,60 @@ def product_create(request):
     )
 
 
+@login_required
+@user_passes_test(is_vendor)
+def product_import(request):
+    """Create/update many products from an uploaded CSV, JSON or NDJSON file."""
+    result = None
+    if request.method == "POST":
+        upload = request.FILES.get("file")
+        fmt = request.POST.get("format") or (
+            imports.guess_format(upload.name, upload.content_type) if upload else None
+        )
+        if upload is None:
+            messages.error(request, "Choose a file to import.")
+        elif fmt not in imports.FORMATS:
+            messages.error(request, "Unknown file format; pick CSV, JSON or NDJSON.")
+        else:
+            result = imports.import_products(
+                request.user,
+                imports.iter_rows(codecs.iterdecode(upload, "utf-8-sig"), fmt),
+            )
+    return render(
+        request,
+        "product_import.html",
+        {
+            "result": result,
+            "errors": result["errors"][:200] if result else [],
+            "formats": imports.FORMATS,
+        },
+    )
+
+
 @login_required
 @user_passes_test(is_vendor)
 def product_edit(request, pk):
     product = get_object_or_404(Product, pk=pk, owner=request.user)
+    # Bucketed stock is spread over StockBucket rows; show the total
+    initial = {"stock": available_stock(product)}
     if request.method == "POST":
-        form = ProductForm(request.POST, instance=product)
+        form = ProductForm(request.POST, instance=product, initial=initial)
         if form.is_valid():
-            form.save()
+            with transaction.atomic():
+                product = form.save(commit=False)
+                # Sales since the form was shown changed the stock; only
+                # write it if the vendor did
+                product.save(
+                    update_fields=[f for f in form.fields if f != "stock"] + ["updated_at"]
+                )
+                if "stock" in form.changed_data:
+                    set_stock(product, form.cleaned_data["stock"])
+                elif "stock_buckets" in form.changed_data:
+                    respread_stock(product)
             messages.success(request, "Product updated successfully.")
             return redirect("my_products")
     else:
-        form = ProductForm(instance=product)
+        form = ProductForm(instance=product, initial=initial)
     return render(
         request,
         "product_form.html",
@@ -207,7 +499,8 @@ def product_edit(request, pk):
     )
 
 @login_required
-@transaction.atomic
+@atomic_with_retry
+@idempotent(user_scope, replay_message="This top-up was already processed.")
 def buy_tokens(request):
     """
     Very simple 'buy tokens' flow:
@@ -222,15 +515,14 @@ def buy_tokens(request):
         if form.is_valid():
             amount = form.cleaned_data["amount_tokens"]
 
-            account = UserTokenAccount.objects.select_for_update().get(user=request.user)
-            account.token_balance = F("token_balance") + amount
-            account.save()
+            UserTokenAccount.objects.credit(request.user.pk, amount)
 
-            TokenTopUp.objects.create(
+            topup = TokenTopUp.objects.create(
                 user=request.user,
                 amount_tokens=amount,
                 description="Manual top-up (no real payment yet)",
             )
+            ledger.record_topup(topup)
 
             messages.success(
                 request,
@@ -242,41 +534,48 @@ def buy_tokens(request):
 
     return render(request, "buy_tokens.html", {"form": form})
 
-def get_api_key_from_request(request):
+def api_key_scope(request):
+    api_key = get_api_key_from_request(request)
+    return f"apikey:{api_key.pk}" if api_key else None
+
+def parse_api_payload(request):
     """
-    Try to read API key from:
-    - X-API-Key header
-    - ?api_key=
-    - POST body field 'api_key'
+    Parse an API request body: try JSON, then fall back to form data.
+    Returns ``(payload, error_response)``; exactly one of them is None.
     """
-    key = (
-        request.headers.get("X-API-Key")
-        or request.GET.get("api_key")
-        or request.POST.get("api_key")
-    )
-    if not key:
-        return None
-    try:
-        return VendorAPIKey.objects.select_related("vendor").get(
-            key=key,
-            is_active=True,
-        )
-    except VendorAPIKey.DoesNotExist:
-        return None
+    if request.body:
+        raw_text = request.body.decode("utf-8", errors="replace")
+        try:
+            # Try JSON first
+            return json.loads(raw_text), None
+        except json.JSONDecodeError:
+            # Fall back to form data (curl -d "a=1&b=2")
+            if request.POST:
+                return request.POST, None
+            # De ultima - tiramos error y mostramos el cuerpo para debuggear si algo sale mal
+            return None, JsonResponse(
+                {
+                    "error": "Invalid body; expected JSON or form data",
+                    "raw_body": raw_text,
+                },
+                status=400,
+            )
+    # No raw body, maybe standard form POST
+    return request.POST or {}, None
 
 @csrf_exempt
 @require_http_methods(["GET"])
-def api_purchase_detail(request, pk):
-    api_key = get_api_key_from_request(request)
+async def api_purchase_detail(request, pk):
+    api_key = await sync_to_async(get_api_key_from_request)(request)
     if not api_key:
         return JsonResponse({"error": "Invalid or missing API key"}, status=401)
 
     try:
-        purchase = Purchase.objects.select_related(
+        purchase = await Purchase.objects.select_related(
             "user",
             "product",
             "product__owner",
-        ).get(pk=pk)
+        ).aget(pk=pk)
     except Purchase.DoesNotExist:
         return JsonResponse({"error": "Purchase not found"}, status=404)
 
@@ -284,7 +583,31 @@ def api_purchase_detail(request, pk):
     if purchase.product.owner != api_key.vendor:
         return JsonResponse({"error": "Not authorized for this purchase"}, status=403)
 
-    data = {
+    # Purchases never change; only the embedded product name can
+    last_modified = max(purchase.created_at, purchase.product.updated_at)
+    etag = make_etag(
+        "purchase", purchase.pk, purchase.product.updated_at.isoformat(), api_key.vendor.pk
+    )
+    response = not_modified(request, etag, last_modified)
+    if response is None:
+        data = serialize_purchase(purchase)
+        data["vendor"] = {
+            "id": api_key.vendor.pk,
+            "username": api_key.vendor.username,
+        }
+        response = JsonResponse(data, status=200)
+    patch_vary_headers(response, ["X-API-Key"])
+    return set_validators(
+        response,
+        etag,
+        last_modified,
+        private=True,
+        max_age=getattr(settings, "UPBT_PURCHASE_MAX_AGE", 24 * 60 * 60),
+    )
+
+
+def serialize_purchase(purchase):
+    return {
         "id": purchase.pk,
         "buyer": {
             "id": purchase.user.pk,
@@ -297,45 +620,207 @@ def api_purchase_detail(request, pk):
         "quantity": purchase.quantity,
         "total_tokens": purchase.total_tokens,
         "created_at": purchase.created_at.isoformat(),
-        "vendor": {
-            "id": api_key.vendor.pk,
-            "username": api_key.vendor.username,
-        },
     }
-    return JsonResponse(data, status=200)
+
+
+def _parse_time_filter(request, name):
+    """Parse an ISO 8601 query parameter; returns ``(value, error_response)``."""
+    raw = request.GET.get(name)
+    if not raw:
+        return None, None
+    value = parse_datetime(raw)
+    if value is None:
+        return None, JsonResponse(
+            {"error": f"{name} must be an ISO 8601 datetime"}, status=400
+        )
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value, None
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def api_vendor_purchases(request):
+    """
+    List the sales of the calling vendor, oldest first, with keyset
+    pagination. Query params: ``cursor``, ``limit``, ``product``, ``since``
+    and ``until`` (ISO 8601, ``since`` inclusive, ``until`` exclusive),
+    ``order`` (``asc`` or ``desc``).
+    """
+    api_key = get_api_key_from_request(request)
+    if not api_key:
+        return JsonResponse({"error": "Invalid or missing API key"}, status=401)
+
+    max_limit = getattr(settings, "UPBT_API_PAGE_MAX_LIMIT", 1000)
+    try:
+        limit = int(request.GET.get("limit", 100))
+    except ValueError:
+        return JsonResponse({"error": "limit must be an integer"}, status=400)
+    if not 1 <= limit <= max_limit:
+        return JsonResponse(
+            {"error": f"limit must be between 1 and {max_limit}"}, status=400
+        )
+
+    order = request.GET.get("order", "asc")
+    if order not in ("asc", "desc"):
+        return JsonResponse({"error": "order must be 'asc' or 'desc'"}, status=400)
+
+    purchases = Purchase.objects.filter(vendor=api_key.vendor).select_related(
+        "user", "product"
+    )
+
+    product_id = request.GET.get("product")
+    if product_id:
+        try:
+            purchases = purchases.filter(product_id=int(product_id))
+        except ValueError:
+            return JsonResponse({"error": "product must be an integer"}, status=400)
+
+    since, error = _parse_time_filter(request, "since")
+    if error:
+        return error
+    until, error = _parse_time_filter(request, "until")
+    if error:
+        return error
+    if since:
+        purchases = purchases.filter(created_at__gte=since)
+    if until:
+        purchases = purchases.filter(created_at__lt=until)
+
+    try:
+        rows, next_cursor = keyset_page(
+            purchases,
+            cursor=request.GET.get("cursor"),
+            limit=limit,
+            descending=order == "desc",
+        )
+    except ValueError:
+        return JsonResponse({"error": "Invalid cursor"}, status=400)
+
+    return JsonResponse(
+        {
+            "results": [serialize_purchase(purchase) for purchase in rows],
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
+        }
+    )
 
 @csrf_exempt
 @require_http_methods(["POST"])
-@transaction.atomic
-def api_transfer_tokens(request):
+def api_vendor_products_import(request):
+    """
+    Bulk upsert of the calling vendor's products, matched by SKU. The body
+    is CSV, a JSON list or NDJSON, chosen by ``?format=`` or the
+    Content-Type; CSV and NDJSON are read as a stream. Invalid rows are
+    listed in ``errors`` and skipped.
+    """
     api_key = get_api_key_from_request(request)
     if not api_key:
         return JsonResponse({"error": "Invalid or missing API key"}, status=401)
 
-    # Parse body try JSON, then if we fail form-encoded 
-    payload = {}
+    fmt = request.GET.get("format") or imports.guess_format(content_type=request.content_type)
+    if fmt not in imports.FORMATS:
+        return JsonResponse(
+            {"error": "Send text/csv, application/json or application/x-ndjson (or ?format=)"},
+            status=415,
+        )
 
-    if request.body:
-        raw_text = request.body.decode("utf-8", errors="replace")
+    result = imports.import_products(
+        api_key.vendor,
+        imports.iter_rows(codecs.iterdecode(request, "utf-8-sig"), fmt),
+    )
+    return JsonResponse(result)
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def api_vendor_stats(request):
+    """
+    Sales summary of the calling vendor from the hourly/daily rollups.
+    Query params: ``period`` (``day`` or ``hour``, default ``day``),
+    ``since`` and ``until`` (ISO 8601; default: the last 30 days or 48
+    hours), ``product``.
+    """
+    api_key = get_api_key_from_request(request)
+    if not api_key:
+        return JsonResponse({"error": "Invalid or missing API key"}, status=401)
+
+    period = request.GET.get("period", VendorSalesRollup.PERIOD_DAY)
+    if period not in (VendorSalesRollup.PERIOD_DAY, VendorSalesRollup.PERIOD_HOUR):
+        return JsonResponse({"error": "period must be 'day' or 'hour'"}, status=400)
+
+    product_id = request.GET.get("product")
+    if product_id:
         try:
-            # Try JSON first
-            payload = json.loads(raw_text)
-        except json.JSONDecodeError:
-            # Fall back to form data (curl -d "a=1&b=2")
-            if request.POST:
-                payload = request.POST
-            else:
-                # De ultima - tiramos error y mostramos el cuerpo para debuggear si algo sale mal
-                return JsonResponse(
-                    {
-                        "error": "Invalid body; expected JSON or form data",
-                        "raw_body": raw_text,
-                    },
-                    status=400,
-                )
+            product_id = int(product_id)
+        except ValueError:
+            return JsonResponse({"error": "product must be an integer"}, status=400)
     else:
-        # No raw body, maybe standard form POST
-        payload = request.POST or {}
+        product_id = None
+
+    since, error = _parse_time_filter(request, "since")
+    if error:
+        return error
+    until, error = _parse_time_filter(request, "until")
+    if error:
+        return error
+    if since is None:
+        window = (
+            timedelta(days=30)
+            if period == VendorSalesRollup.PERIOD_DAY
+            else timedelta(hours=48)
+        )
+        since = (until or timezone.now()) - window
+    max_buckets = getattr(settings, "UPBT_STATS_MAX_BUCKETS", 1000)
+    step = timedelta(days=1) if period == VendorSalesRollup.PERIOD_DAY else timedelta(hours=1)
+    if ((until or timezone.now()) - since) / step > max_buckets:
+        return JsonResponse(
+            {"error": f"At most {max_buckets} {period}s per request"}, status=400
+        )
+
+    summary = sales_summary(api_key.vendor, period, since, until, product_id)
+    return JsonResponse(
+        {
+            "period": period,
+            "since": since.isoformat(),
+            "until": until.isoformat() if until else None,
+            "totals": summary["totals"],
+            "buckets": [
+                {
+                    "start": row["bucket_start"].isoformat(),
+                    "units": row["units"],
+                    "tokens": row["tokens"],
+                    "buyers": row["buyers"],
+                }
+                for row in summary["buckets"]
+            ],
+            "products": [
+                {
+                    "id": row["product_id"],
+                    "name": row["product__name"],
+                    "units": row["units"],
+                    "tokens": row["tokens"],
+                    "buyers": row["buyers"],
+                }
+                for row in summary["products"]
+            ],
+        }
+    )
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def api_transfer_tokens(request):
+    """
+    Validate on the event loop; only the locked transaction runs in a
+    worker thread (the ORM has no async transactions).
+    """
+    api_key = await sync_to_async(get_api_key_from_request)(request)
+    if not api_key:
+        return JsonResponse({"error": "Invalid or missing API key"}, status=401)
+
+    payload, error = parse_api_payload(request)
+    if error:
+        return error
 
     recipient_username = payload.get("recipient_username")
     amount = payload.get("amount_tokens")
@@ -356,25 +841,32 @@ def api_transfer_tokens(request):
 
     from_user = api_key.vendor
 
-    from django.contrib.auth.models import User
     try:
-        to_user = User.objects.get(username=recipient_username)
+        to_user = await User.objects.aget(username=recipient_username)
     except User.DoesNotExist:
         return JsonResponse({"error": "Recipient user not found"}, status=404)
 
     if from_user == to_user:
         return JsonResponse({"error": "Cannot transfer tokens to self"}, status=400)
 
-    from_account = UserTokenAccount.objects.select_for_update().get(user=from_user)
-    to_account = UserTokenAccount.objects.select_for_update().get(user=to_user)
+    return await sync_to_async(_apply_transfer)(
+        request, api_key, from_user, to_user, amount, description
+    )
 
-    if from_account.token_balance < amount:
+
+@atomic_with_retry
+@idempotent(api_key_scope)
+def _apply_transfer(request, api_key, from_user, to_user, amount, description):
+    try:
+        from_balance, to_balance = move_tokens(from_user.pk, to_user.pk, amount)
+    except InsufficientFunds:
         return JsonResponse({"error": "Insufficient balance"}, status=400)
 
-    from_account.token_balance = F("token_balance") - amount
-    to_account.token_balance = F("token_balance") + amount
-    from_account.save()
-    to_account.save()
+    # Checked with the sender's row locked, so parallel calls can't overshoot
+    remaining = transfer_quota_remaining(api_key)
+    if remaining is not None and amount > remaining:
+        transaction.set_rollback(True)
+        return _quota_exceeded(api_key, remaining)
 
     transfer = TokenTransfer.objects.create(
         from_user=from_user,
@@ -383,20 +875,19 @@ def api_transfer_tokens(request):
         description=description,
         api_key=api_key,
     )
-
-    from_account.refresh_from_db()
-    to_account.refresh_from_db()
+    ledger.record_transfers([transfer])
+    api_usage.record(api_key.pk, transferred_tokens=amount)
 
     data = {
         "status": "ok",
         "transfer_id": transfer.pk,
         "from_user": {
             "username": from_user.username,
-            "new_balance": from_account.token_balance,
+            "new_balance": from_balance,
         },
         "to_user": {
             "username": to_user.username,
-            "new_balance": to_account.token_balance,
+            "new_balance": to_balance,
         },
         "amount_tokens": amount,
         "description": description,
@@ -404,76 +895,251 @@ def api_transfer_tokens(request):
     }
     return JsonResponse(data, status=201)
 
-@login_required
-@user_passes_test(is_vendor)
-def vendor_api_keys(request):
-    keys = VendorAPIKey.objects.filter(vendor=request.user).order_by("-created_at")
-
-    if request.method == "POST":
-        name = request.POST.get("name") or "Default API key"
-        VendorAPIKey.objects.create(vendor=request.user, name=name)
-        messages.success(request, "New API key created.")
-        return redirect("vendor_api_keys")
+def _quota_exceeded(api_key, remaining):
+    api_usage.record(api_key.pk, quota_rejected=1)
+    response = JsonResponse(
+        {
+            "error": "Daily transfer quota exceeded",
+            "quota_remaining_tokens": remaining,
+        },
+        status=429,
+    )
+    response["Retry-After"] = str(seconds_until_quota_reset())
+    return response
+
+BATCH_MODE_ATOMIC = "atomic"
+QUOTA_EXCEEDED = "Daily transfer quota exceeded"
+BATCH_MODE_BEST_EFFORT = "best_effort"
+
+
+def _validate_batch_item(item):
+    """Return ``(recipient_username, amount, description, error)`` for one entry."""
+    if not isinstance(item, dict):
+        return None, None, "", "entry must be an object"
+    recipient_username = item.get("recipient_username")
+    amount = item.get("amount_tokens")
+    description = item.get("description")
+    if description is None:
+        description = ""
+    if not isinstance(description, str):
+        return recipient_username, None, "", "description must be a string"
+    description = description[:255]
+    if not recipient_username:
+        return None, None, description, "recipient_username is required"
+    if amount is None:
+        return recipient_username, None, description, "amount_tokens is required"
+    try:
+        amount = int(amount)
+    except (TypeError, ValueError):
+        return recipient_username, None, description, "amount_tokens must be an integer"
+    if amount <= 0:
+        return recipient_username, None, description, "amount_tokens must be > 0"
+    return recipient_username, amount, description, None
 
-    return render(request, "vendor_api_keys.html", {"keys": keys})
 
-def send_purchase_webhooks(purchase: Purchase):
+@csrf_exempt
+@require_http_methods(["POST"])
+@atomic_with_retry
+@idempotent(api_key_scope)
+def api_transfer_tokens_batch(request):
     """
-    Notify all active webhooks for the vendor that owns the product
-    for this purchase.
+    Pay out to many recipients in one call.
+
+    Body: ``{"mode": "atomic" | "best_effort", "transfers": [{"recipient_username",
+    "amount_tokens", "description"}, ...]}``.
+
+    In ``atomic`` mode (default) any invalid entry or insufficient balance
+    rejects the whole batch. In ``best_effort`` mode valid entries are applied
+    in order while the balance lasts and the rest are reported as errors.
     """
-    vendor = purchase.product.owner
-    if not vendor:
-        return
-
-    webhooks = VendorWebhook.objects.filter(vendor=vendor, is_active=True)
-    if not webhooks.exists():
-        return
-
-    payload = {
-        "event": "purchase.created",
-        "purchase": {
-            "id": purchase.pk,
-            "buyer": {
-                "id": purchase.user.pk,
-                "username": purchase.user.username,
-            },
-            "product": {
-                "id": purchase.product.pk,
-                "name": purchase.product.name,
-            },
-            "quantity": purchase.quantity,
-            "total_tokens": purchase.total_tokens,
-            "created_at": purchase.created_at.isoformat(),
-        },
-        "vendor": {
-            "id": vendor.pk,
-            "username": vendor.username,
-        },
+    api_key = get_api_key_from_request(request)
+    if not api_key:
+        return JsonResponse({"error": "Invalid or missing API key"}, status=401)
+
+    payload, error = parse_api_payload(request)
+    if error:
+        return error
+    if not isinstance(payload, dict):
+        return JsonResponse({"error": "Body must be a JSON object"}, status=400)
+
+    mode = payload.get("mode") or BATCH_MODE_ATOMIC
+    if mode not in (BATCH_MODE_ATOMIC, BATCH_MODE_BEST_EFFORT):
+        return JsonResponse(
+            {"error": "mode must be 'atomic' or 'best_effort'"}, status=400
+        )
+
+    items = payload.get("transfers")
+    if not isinstance(items, list) or not items:
+        return JsonResponse({"error": "transfers must be a non-empty list"}, status=400)
+    max_items = getattr(settings, "UPBT_BATCH_TRANSFER_MAX_ITEMS", 1000)
+    if len(items) > max_items:
+        return JsonResponse(
+            {"error": f"At most {max_items} transfers per batch"}, status=400
+        )
+
+    from_user = api_key.vendor
+    entries = [_validate_batch_item(item) for item in items]
+
+    # 1) Resolve every recipient with a single query
+    usernames = {username for username, _, _, err in entries if username}
+    recipients = {
+        user.username: user
+        for user in User.objects.filter(username__in=usernames).only("id", "username")
     }
 
-    body = json.dumps(payload)
+    results = []
+    for index, (username, amount, description, err) in enumerate(entries):
+        to_user = recipients.get(username) if username else None
+        if not err and to_user is None:
+            err = "Recipient user not found"
+        if not err and to_user.pk == from_user.pk:
+            err = "Cannot transfer tokens to self"
+        results.append(
+            {
+                "index": index,
+                "recipient_username": username,
+                "amount_tokens": amount,
+                "description": description,
+                "to_user": to_user,
+                "error": err,
+            }
+        )
+
+    if mode == BATCH_MODE_ATOMIC and any(r["error"] for r in results):
+        return _batch_response(results, applied=False, status=400)
+
+    # 2) Lock sender + recipients in one query, in user id order
+    user_ids = {from_user.pk} | {r["to_user"].pk for r in results if not r["error"]}
+    accounts = lock_accounts(user_ids)
+
+    # 3) Decide which entries fit in the sender's balance and the key's quota
+    balance = accounts[from_user.pk].token_balance
+    quota = transfer_quota_remaining(api_key)
+    for r in results:
+        if r["error"]:
+            continue
+        if r["amount_tokens"] > balance:
+            r["error"] = "Insufficient balance"
+            continue
+        if quota is not None and r["amount_tokens"] > quota:
+            r["error"] = QUOTA_EXCEEDED
+            continue
+        balance -= r["amount_tokens"]
+        if quota is not None:
+            quota -= r["amount_tokens"]
+
+    ok = [r for r in results if not r["error"]]
+    if not ok or (mode == BATCH_MODE_ATOMIC and len(ok) != len(results)):
+        if any(r["error"] == QUOTA_EXCEEDED for r in results):
+            api_usage.record(api_key.pk, quota_rejected=1)
+            response = _batch_response(results, applied=False, status=429)
+            response["Retry-After"] = str(seconds_until_quota_reset())
+            return response
+        return _batch_response(results, applied=False, status=400)
+
+    # 4) Apply all debits/credits with a single UPDATE
+    deltas = {from_user.pk: 0}
+    for r in ok:
+        deltas[from_user.pk] -= r["amount_tokens"]
+        deltas[r["to_user"].pk] = deltas.get(r["to_user"].pk, 0) + r["amount_tokens"]
+    UserTokenAccount.objects.filter(
+        pk__in=[accounts[user_id].pk for user_id in deltas]
+    ).update(
+        token_balance=F("token_balance")
+        + Case(
+            *[
+                When(pk=accounts[user_id].pk, then=Value(delta))
+                for user_id, delta in deltas.items()
+            ],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    )
+    for user_id, delta in deltas.items():
+        accounts[user_id].token_balance += delta
+    invalidate_user_context(*deltas)
+
+    # 5) Record the transfers in bulk
+    transfers = TokenTransfer.objects.bulk_create(
+        [
+            TokenTransfer(
+                from_user=from_user,
+                to_user=r["to_user"],
+                amount_tokens=r["amount_tokens"],
+                description=r["description"],
+                api_key=api_key,
+            )
+            for r in ok
+        ]
+    )
+    for r, transfer in zip(ok, transfers):
+        r["transfer"] = transfer
+    ledger.record_transfers(transfers)
+    api_usage.record(
+        api_key.pk, transferred_tokens=sum(r["amount_tokens"] for r in ok)
+    )
 
-    for webhook in webhooks:
-        headers = {
-            "Content-Type": "application/json",
+    return _batch_response(
+        results,
+        applied=True,
+        status=201,
+        from_user=from_user,
+        accounts=accounts,
+    )
+
+
+def _batch_response(results, applied, status, from_user=None, accounts=None):
+    items = []
+    for r in results:
+        item = {
+            "index": r["index"],
+            "recipient_username": r["recipient_username"],
+            "amount_tokens": r["amount_tokens"],
         }
+        if r["error"]:
+            item["status"] = "error"
+            item["error"] = r["error"]
+        elif applied:
+            item["status"] = "ok"
+            item["transfer_id"] = r["transfer"].pk
+            item["new_balance"] = accounts[r["to_user"].pk].token_balance
+            item["created_at"] = r["transfer"].created_at.isoformat()
+        else:
+            item["status"] = "skipped"
+        items.append(item)
 
-        # Optional HMAC signature with secret
-        if webhook.secret:
-            signature = hmac.new(
-                webhook.secret.encode("utf-8"),
-                body.encode("utf-8"),
-                hashlib.sha256,
-            ).hexdigest()
-            headers["X-UPBT-Signature"] = signature
+    data = {
+        "status": "ok" if applied and all(not r["error"] for r in results)
+        else "partial" if applied
+        else "rejected",
+        "applied": sum(1 for item in items if item["status"] == "ok"),
+        "failed": sum(1 for item in items if item["status"] == "error"),
+        "results": items,
+    }
+    if applied:
+        data["from_user"] = {
+            "username": from_user.username,
+            "new_balance": accounts[from_user.pk].token_balance,
+        }
+    return JsonResponse(data, status=status)
 
-        try:
-            # Best-effort: don't crash the main request if webhook fails
-            requests.post(webhook.url, data=body, headers=headers, timeout=5)
-        except Exception as e:
-            # In real life, log this properly
-            print(f"Error sending webhook to {webhook.url}: {e}")
+@login_required
+@user_passes_test(is_vendor)
+def vendor_api_keys(request):
+    keys = VendorAPIKey.objects.filter(vendor=request.user).order_by("-created_at")
+
+    if request.method == "POST":
+        name = request.POST.get("name") or "Default API key"
+        api_key = VendorAPIKey.objects.create(vendor=request.user, name=name)
+        # Only the hash is stored, so this is the one chance to copy the key
+        messages.success(
+            request,
+            f"New API key created: {api_key.raw_key} "
+            "Copy it now, it won't be shown again.",
+        )
+        return redirect("vendor_api_keys")
+
+    return render(request, "vendor_api_keys.html", {"keys": keys})
 
 @login_required
 @user_passes_test(is_vendor)
@@ -488,14 +1154,104 @@ def vendor_webhooks(request):
         url = (request.POST.get("url") or "").strip()
         secret = (request.POST.get("secret") or "").strip()
         is_active = request.POST.get("is_active") == "on"
+        try:
+            batch_size = int(request.POST.get("batch_size") or 1)
+            batch_window = int(request.POST.get("batch_window_seconds") or 5)
+        except ValueError:
+            messages.error(request, "Batch size and window must be whole numbers.")
+            return redirect("vendor_webhooks")
+        max_batch = getattr(settings, "UPBT_WEBHOOK_BATCH_MAX_SIZE", 500)
+        if not 1 <= batch_size <= max_batch or not 0 <= batch_window <= 3600:
+            messages.error(
+                request,
+                f"Batch size must be 1-{max_batch} and the window 0-3600 seconds.",
+            )
+            return redirect("vendor_webhooks")
 
         webhook.url = url
         webhook.secret = secret
+        webhook.batch_size = batch_size
+        webhook.batch_window_seconds = batch_window
         # Only activate if we have a non-empty URL
         webhook.is_active = bool(url) and is_active
+        # A fixed endpoint deserves a fresh chance
+        webhook.consecutive_failures = 0
+        webhook.circuit_open_until = None
         webhook.save()
 
         messages.success(request, "Webhook settings updated.")
         return redirect("vendor_webhooks")
 
     return render(request, "vendor_webhooks.html", {"webhook": webhook})
+
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def api_vendor_export(request, kind):
+    """
+    Stream the calling vendor's purchases (sales), top-ups or transfers as
+    CSV or NDJSON (``?format=csv|ndjson``), optionally limited to
+    ``since``/``until`` (ISO 8601).
+    """
+    api_key = get_api_key_from_request(request)
+    if not api_key:
+        return JsonResponse({"error": "Invalid or missing API key"}, status=401)
+
+    fmt = request.GET.get("format", exports.FORMAT_CSV)
+    if fmt not in exports.FORMATS:
+        return JsonResponse({"error": "format must be 'csv' or 'ndjson'"}, status=400)
+
+    vendor = api_key.vendor
+    if kind == "purchases":
+        rows = Purchase.objects.filter(vendor=vendor)
+    elif kind == "topups":
+        rows = TokenTopUp.objects.filter(user=vendor)
+    elif kind == "transfers":
+        rows = TokenTransfer.objects.filter(Q(from_user=vendor) | Q(to_user=vendor))
+    else:
+        return JsonResponse({"error": "Unknown export"}, status=404)
+
+    since, error = _parse_time_filter(request, "since")
+    if error:
+        return error
+    until, error = _parse_time_filter(request, "until")
+    if error:
+        return error
+    if since:
+        rows = rows.filter(created_at__gte=since)
+    if until:
+        rows = rows.filter(created_at__lt=until)
+
+    return exports.streaming_export(rows, kind, fmt, f"{vendor.username}-{kind}")
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def lock_metrics_view(request):
+    """Account lock contention counters, for monitoring."""
+    return JsonResponse(lock_metrics.snapshot())
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def api_usage_view(request):
+    """Per-API-key request, throttling and transfer counters (this process)."""
+    return JsonResponse({str(key_id): usage for key_id, usage in api_usage.snapshot().items()})
+
+
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """
+    Prometheus metrics for this process. Scrapers authenticate with
+    ``Authorization: Bearer <UPBT_METRICS_TOKEN>``; staff can just log in.
+    """
+    token = getattr(settings, "UPBT_METRICS_TOKEN", None)
+    authorized = request.user.is_staff or (
+        token
+        and constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}")
+    )
+    if not authorized:
+        return HttpResponse("Forbidden", status=403, content_type="text/plain")
+    return HttpResponse(
+        render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,570 @@
+"""
+Webhook outbox: enqueue events inside the business transaction and
+deliver them later from a worker (see the ``deliver_webhooks`` command).
+
+Deliveries are sent either through a ``WebhookClient`` (a bounded thread
+pool over keep-alive ``requests.Session``s, one per host) or from one event
+loop over a pooled ``httpx`` async client (``aprocess_due_deliveries``),
+which keeps thousands of slow vendor endpoints in flight without a thread
+each.
+
+Endpoints with ``batch_size > 1`` get their events coalesced into one JSON
+array per request (``coalesce_batches``). Every request carries a
+per-endpoint ``X-UPBT-Sequence`` number so receivers can spot gaps.
+
+Each endpoint has a circuit breaker: after ``UPBT_WEBHOOK_CIRCUIT_THRESHOLD``
+consecutive failures its deliveries are left alone for
+``UPBT_WEBHOOK_CIRCUIT_COOLDOWN_SECONDS``; then a single delivery is sent as a
+probe, and its outcome closes or reopens the circuit.
+"""
+import asyncio
+import functools
+import hashlib
+import hmac
+import json
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import VendorWebhook, WebhookDelivery
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+@functools.lru_cache(maxsize=1024)
+def _hmac_for_secret(secret):
+    # Keyed HMAC state, copied per payload instead of re-deriving the key
+    return hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+
+
+def sign_payload(secret, body):
+    """HMAC-SHA256 hex digest of ``body`` using ``secret``."""
+    mac = _hmac_for_secret(secret).copy()
+    mac.update(body.encode("utf-8"))
+    return mac.hexdigest()
+
+
+def build_purchase_payload(purchase):
+    vendor = purchase.product.owner
+    return {
+        "event": "purchase.created",
+        "purchase": {
+            "id": purchase.pk,
+            "buyer": {
+                "id": purchase.user.pk,
+                "username": purchase.user.username,
+            },
+            "product": {
+                "id": purchase.product.pk,
+                "name": purchase.product.name,
+            },
+            "quantity": purchase.quantity,
+            "total_tokens": purchase.total_tokens,
+            "created_at": purchase.created_at.isoformat(),
+        },
+        "vendor": {
+            "id": vendor.pk,
+            "username": vendor.username,
+        },
+    }
+
+
+def build_order_payload(vendor, purchases):
+    buyer = purchases[0].user
+    return {
+        "event": "order.created",
+        "order": {
+            "buyer": {
+                "id": buyer.pk,
+                "username": buyer.username,
+            },
+            "purchases": [
+                {
+                    "id": purchase.pk,
+                    "product": {
+                        "id": purchase.product.pk,
+                        "name": purchase.product.name,
+                    },
+                    "quantity": purchase.quantity,
+                    "total_tokens": purchase.total_tokens,
+                }
+                for purchase in purchases
+            ],
+            "total_tokens": sum(purchase.total_tokens for purchase in purchases),
+            "created_at": purchases[0].created_at.isoformat(),
+        },
+        "vendor": {
+            "id": vendor.pk,
+            "username": vendor.username,
+        },
+    }
+
+
+def _new_delivery(webhook, event, body):
+    return WebhookDelivery(
+        webhook=webhook,
+        event=event,
+        payload=body,
+        # Batched endpoints get the event later, inside a batch
+        status=(
+            WebhookDelivery.STATUS_QUEUED
+            if webhook.batch_size > 1
+            else WebhookDelivery.STATUS_PENDING
+        ),
+    )
+
+
+def enqueue_purchase_webhooks(purchase):
+    """
+    Record a ``purchase.created`` delivery for every active webhook of the
+    vendor that owns the product. Must be called inside the transaction
+    that creates the purchase so the event is committed (or rolled back)
+    together with it.
+    """
+    vendor = purchase.product.owner
+    if not vendor:
+        return []
+
+    webhooks = list(VendorWebhook.objects.filter(vendor=vendor, is_active=True))
+    if not webhooks:
+        return []
+
+    body = json.dumps(build_purchase_payload(purchase))
+    return WebhookDelivery.objects.bulk_create(
+        [_new_delivery(webhook, "purchase.created", body) for webhook in webhooks]
+    )
+
+
+def enqueue_order_webhooks(purchases):
+    """
+    Like ``enqueue_purchase_webhooks`` for a whole cart checkout: one
+    ``order.created`` event per vendor listing that vendor's purchases,
+    with one webhook query for all vendors.
+    """
+    by_vendor = {}
+    for purchase in purchases:
+        if purchase.product.owner_id:
+            by_vendor.setdefault(purchase.product.owner_id, []).append(purchase)
+    if not by_vendor:
+        return []
+
+    deliveries = []
+    bodies = {}
+    for webhook in VendorWebhook.objects.filter(vendor_id__in=by_vendor, is_active=True):
+        vendor_purchases = by_vendor[webhook.vendor_id]
+        if webhook.vendor_id not in bodies:
+            bodies[webhook.vendor_id] = json.dumps(
+                build_order_payload(vendor_purchases[0].product.owner, vendor_purchases)
+            )
+        deliveries.append(_new_delivery(webhook, "order.created", bodies[webhook.vendor_id]))
+    return WebhookDelivery.objects.bulk_create(deliveries)
+
+
+def take_sequences(webhook_id, count):
+    """
+    Reserve ``count`` consecutive message numbers of a webhook and return the
+    first. Call inside a transaction; the webhook row stays locked until it ends.
+    """
+    first = (
+        VendorWebhook.objects.select_for_update()
+        .values_list("next_sequence", flat=True)
+        .get(pk=webhook_id)
+    )
+    VendorWebhook.objects.filter(pk=webhook_id).update(
+        next_sequence=F("next_sequence") + count
+    )
+    return first
+
+
+def coalesce_batches():
+    """
+    Turn queued events of batching webhooks into batch deliveries: one per
+    ``batch_size`` events, or fewer once the oldest has waited
+    ``batch_window_seconds``. The batch body is the JSON array of the event
+    payloads, in event order. Returns the number of batches created.
+    """
+    now = timezone.now()
+    created = 0
+    webhook_ids = (
+        WebhookDelivery.objects.filter(status=WebhookDelivery.STATUS_QUEUED)
+        .values_list("webhook_id", flat=True)
+        .distinct()
+    )
+    for webhook_id in list(webhook_ids):
+        with transaction.atomic():
+            # One worker batches a webhook at a time
+            webhook = (
+                VendorWebhook.objects.select_for_update(skip_locked=True)
+                .filter(pk=webhook_id)
+                .first()
+            )
+            if webhook is None:
+                continue
+            queued = WebhookDelivery.objects.filter(
+                webhook=webhook, status=WebhookDelivery.STATUS_QUEUED
+            )
+            if webhook.batch_size <= 1:
+                # Batching was switched off: send what is left one by one
+                queued.update(status=WebhookDelivery.STATUS_PENDING, next_attempt_at=now)
+                continue
+            window = timedelta(seconds=webhook.batch_window_seconds)
+            while True:
+                events = list(
+                    queued.order_by("pk").only("pk", "payload", "created_at")[: webhook.batch_size]
+                )
+                if not events:
+                    break
+                if len(events) < webhook.batch_size and events[0].created_at > now - window:
+                    break
+                batch = WebhookDelivery.objects.create(
+                    webhook=webhook,
+                    event=WebhookDelivery.EVENT_BATCH,
+                    payload="[" + ",".join(event.payload for event in events) + "]",
+                    sequence=take_sequences(webhook.pk, 1),
+                )
+                WebhookDelivery.objects.filter(pk__in=[e.pk for e in events]).update(
+                    status=WebhookDelivery.STATUS_BATCHED, batch=batch
+                )
+                created += 1
+    return created
+
+
+def backoff_delay(attempts):
+    """Exponential backoff: base * 2^(attempts - 1), capped."""
+    base = _setting("UPBT_WEBHOOK_BACKOFF_SECONDS", 30)
+    cap = _setting("UPBT_WEBHOOK_BACKOFF_MAX_SECONDS", 6 * 60 * 60)
+    return timedelta(seconds=min(cap, base * (2 ** max(attempts - 1, 0))))
+
+
+def claim_due_deliveries(limit):
+    """
+    Lock a batch of due deliveries and push their ``next_attempt_at`` forward
+    by a lease, so concurrent workers don't pick the same rows. If a worker
+    dies mid-batch the rows simply become due again after the lease.
+
+    Endpoints with an open circuit are skipped; for endpoints whose cooldown
+    just ended only one delivery is taken, as a probe, and the circuit stays
+    open for the lease so no other round sends a second one. ``record_results``
+    then closes or reopens it.
+    """
+    now = timezone.now()
+    lease = timedelta(seconds=_setting("UPBT_WEBHOOK_LEASE_SECONDS", 60))
+    with transaction.atomic():
+        candidates = list(
+            WebhookDelivery.objects.select_for_update(skip_locked=True, of=("self",))
+            .select_related("webhook")
+            .filter(
+                status=WebhookDelivery.STATUS_PENDING,
+                next_attempt_at__lte=now,
+            )
+            .filter(
+                Q(webhook__circuit_open_until__isnull=True)
+                | Q(webhook__circuit_open_until__lte=now)
+            )
+            .order_by("next_attempt_at", "pk")[:limit]
+        )
+        deliveries = []
+        probing = set()
+        for delivery in candidates:
+            open_until = delivery.webhook.circuit_open_until
+            if open_until is not None:
+                if delivery.webhook_id in probing:
+                    continue
+                probing.add(delivery.webhook_id)
+                # Only the worker that moves the cooldown forward gets to probe
+                if not VendorWebhook.objects.filter(
+                    pk=delivery.webhook_id, circuit_open_until=open_until
+                ).update(circuit_open_until=now + lease):
+                    continue
+                delivery.webhook.circuit_open_until = now + lease
+            deliveries.append(delivery)
+        if deliveries:
+            WebhookDelivery.objects.filter(
+                pk__in=[d.pk for d in deliveries]
+            ).update(next_attempt_at=now + lease)
+            _assign_sequences([d for d in deliveries if d.sequence is None])
+    return deliveries
+
+
+def _assign_sequences(deliveries):
+    by_webhook = {}
+    for delivery in deliveries:
+        by_webhook.setdefault(delivery.webhook_id, []).append(delivery)
+    for webhook_id, webhook_deliveries in sorted(by_webhook.items()):
+        first = take_sequences(webhook_id, len(webhook_deliveries))
+        for offset, delivery in enumerate(webhook_deliveries):
+            delivery.sequence = first + offset
+    if deliveries:
+        WebhookDelivery.objects.bulk_update(deliveries, ["sequence"])
+
+
+# Outcome of one HTTP attempt; ``error`` is "" on success
+DeliveryResult = namedtuple("DeliveryResult", ["error", "status_code", "latency_ms"])
+
+
+def delivery_headers(delivery, signatures=None):
+    """
+    Request headers for a delivery. ``signatures`` is an optional dict used
+    to sign each (secret, payload) pair only once per round.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "X-UPBT-Event": delivery.event,
+        "X-UPBT-Delivery": str(delivery.pk),
+    }
+    if delivery.sequence is not None:
+        headers["X-UPBT-Sequence"] = str(delivery.sequence)
+    secret = delivery.webhook.secret
+    if secret:
+        cache_key = (secret, delivery.payload)
+        signature = signatures.get(cache_key) if signatures is not None else None
+        if signature is None:
+            signature = sign_payload(secret, delivery.payload)
+            if signatures is not None:
+                signatures[cache_key] = signature
+        headers["X-UPBT-Signature"] = signature
+    return headers
+
+
+def delivery_timeout(webhook):
+    if webhook.timeout_seconds:
+        return webhook.timeout_seconds
+    return _setting("UPBT_WEBHOOK_TIMEOUT_SECONDS", 5)
+
+
+def _result(status_code, started):
+    latency_ms = int((time.perf_counter() - started) * 1000)
+    error = f"HTTP {status_code}" if status_code >= 300 else ""
+    return DeliveryResult(error, status_code, latency_ms)
+
+
+def _failure(exc, started):
+    latency_ms = int((time.perf_counter() - started) * 1000)
+    return DeliveryResult(str(exc) or exc.__class__.__name__, None, latency_ms)
+
+
+class WebhookClient:
+    """
+    Sends deliveries from a bounded thread pool, reusing one keep-alive
+    ``requests.Session`` per vendor host across batches. Meant to live as
+    long as the worker; use it as a context manager or call ``close()``.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session_for(self, url):
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.max_workers
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+            return session
+
+    def post(self, delivery, signatures=None):
+        """Send one delivery. Runs in pool threads, so it must not touch the database."""
+        webhook = delivery.webhook
+        started = time.perf_counter()
+        try:
+            response = self.session_for(webhook.url).post(
+                webhook.url,
+                data=delivery.payload,
+                headers=delivery_headers(delivery, signatures),
+                timeout=delivery_timeout(webhook),
+            )
+        except requests.RequestException as e:
+            return _failure(e, started)
+        return _result(response.status_code, started)
+
+    def send_all(self, deliveries):
+        """Send deliveries concurrently; results come back in the same order."""
+        signatures = {}
+        return list(self._pool.map(lambda d: self.post(d, signatures), deliveries))
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def record_result(delivery, result):
+    now = timezone.now()
+    delivery.attempts += 1
+    delivery.response_status = result.status_code
+    delivery.latency_ms = result.latency_ms
+    if not result.error:
+        delivery.status = WebhookDelivery.STATUS_DELIVERED
+        delivery.delivered_at = now
+        delivery.last_error = ""
+    elif not delivery.webhook.is_active or (
+        delivery.attempts >= _setting("UPBT_WEBHOOK_MAX_ATTEMPTS", 8)
+    ):
+        delivery.status = WebhookDelivery.STATUS_DEAD
+        delivery.last_error = result.error
+    else:
+        delivery.next_attempt_at = now + backoff_delay(delivery.attempts)
+        delivery.last_error = result.error
+    delivery.save(
+        update_fields=[
+            "attempts",
+            "status",
+            "delivered_at",
+            "next_attempt_at",
+            "last_error",
+            "response_status",
+            "latency_ms",
+        ]
+    )
+
+
+def update_webhook_stats(deliveries, results):
+    """
+    Fold a batch's outcomes into each ``VendorWebhook``: counters, last
+    status/latency, and the circuit breaker.
+    """
+    now = timezone.now()
+    threshold = _setting("UPBT_WEBHOOK_CIRCUIT_THRESHOLD", 5)
+    cooldown = timedelta(seconds=_setting("UPBT_WEBHOOK_CIRCUIT_COOLDOWN_SECONDS", 300))
+
+    by_webhook = {}
+    for delivery, result in zip(deliveries, results):
+        by_webhook.setdefault(delivery.webhook_id, []).append(result)
+
+    for webhook_id, webhook_results in by_webhook.items():
+        failed = sum(1 for r in webhook_results if r.error)
+        # Failures after the last success in this batch
+        trailing = 0
+        for r in reversed(webhook_results):
+            if not r.error:
+                break
+            trailing += 1
+        last = webhook_results[-1]
+        changes = {
+            "deliveries_succeeded": F("deliveries_succeeded") + len(webhook_results) - failed,
+            "deliveries_failed": F("deliveries_failed") + failed,
+            "last_attempt_at": now,
+            "last_status_code": last.status_code,
+            "last_latency_ms": last.latency_ms,
+        }
+        if trailing == len(webhook_results):
+            changes["consecutive_failures"] = F("consecutive_failures") + trailing
+        else:
+            changes["consecutive_failures"] = trailing
+            if not trailing:
+                changes["circuit_open_until"] = None
+        webhooks = VendorWebhook.objects.filter(pk=webhook_id)
+        webhooks.update(**changes)
+        if trailing:
+            webhooks.filter(consecutive_failures__gte=threshold).update(
+                circuit_open_until=now + cooldown
+            )
+
+
+def record_results(deliveries, results):
+    """Store the outcome of a batch; returns ``(delivered, failed)``."""
+    failed = 0
+    for delivery, result in zip(deliveries, results):
+        record_result(delivery, result)
+        if result.error:
+            failed += 1
+    update_webhook_stats(deliveries, results)
+    return len(deliveries) - failed, failed
+
+
+def process_due_deliveries(batch_size=100, max_workers=8, client=None):
+    """
+    Claim one batch of due deliveries and send them concurrently, through
+    ``client`` if given (so connections are reused across batches).
+    Returns ``(delivered, failed)`` counts.
+    """
+    coalesce_batches()
+    deliveries = claim_due_deliveries(batch_size)
+    if not deliveries:
+        return 0, 0
+
+    if client is not None:
+        results = client.send_all(deliveries)
+    else:
+        with WebhookClient(max_workers=max_workers) as client:
+            results = client.send_all(deliveries)
+    return record_results(deliveries, results)
+
+
+def async_client(max_connections=100):
+    """Pooled ``httpx.AsyncClient`` for ``aprocess_due_deliveries``."""
+    return httpx.AsyncClient(
+        timeout=_setting("UPBT_WEBHOOK_TIMEOUT_SECONDS", 5),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+    )
+
+
+async def apost_delivery(client, delivery, signatures=None):
+    """Async ``WebhookClient.post`` over a shared client."""
+    started = time.perf_counter()
+    try:
+        response = await client.post(
+            delivery.webhook.url,
+            content=delivery.payload,
+            headers=delivery_headers(delivery, signatures),
+            timeout=delivery_timeout(delivery.webhook),
+        )
+    except httpx.HTTPError as e:
+        return _failure(e, started)
+    return _result(response.status_code, started)
+
+
+async def aprocess_due_deliveries(client, batch_size=100, concurrency=100):
+    """
+    Async ``process_due_deliveries``: claim one batch and send it with at most
+    ``concurrency`` requests in flight. Claiming and recording the results
+    happen in a worker thread; the HTTP I/O stays on the event loop.
+    """
+    await sync_to_async(coalesce_batches)()
+    deliveries = await sync_to_async(claim_due_deliveries)(batch_size)
+    if not deliveries:
+        return 0, 0
+
+    semaphore = asyncio.Semaphore(concurrency)
+    signatures = {}
+
+    async def send(delivery):
+        async with semaphore:
+            return await apost_delivery(client, delivery, signatures)
+
+    results = await asyncio.gather(*(send(delivery) for delivery in deliveries))
+    return await sync_to_async(record_results)(deliveries, results)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -41,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'market.instrumentation.RequestInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -48,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'market.middleware.VendorAPIRateLimitMiddleware',
 ]
 
 ROOT_URLCONF = 'upbtoken.urls'
@@ -63,6 +66,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                "market.context_processors.market",
             ],
         },
     },
@@ -81,6 +85,18 @@ DATABASES = {
     }
 }
 
+# Set UPBT_POSTGRES_DB (and optionally _USER/_PASSWORD/_HOST/_PORT) to use
+# PostgreSQL instead, e.g. for `manage.py benchmark`
+if os.environ.get('UPBT_POSTGRES_DB'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ['UPBT_POSTGRES_DB'],
+        'USER': os.environ.get('UPBT_POSTGRES_USER', ''),
+        'PASSWORD': os.environ.get('UPBT_POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('UPBT_POSTGRES_HOST', ''),
+        'PORT': os.environ.get('UPBT_POSTGRES_PORT', ''),
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -128,4 +144,71 @@ STATICFILES_DIRS = [
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGIN_REDIRECT_URL = "dashboard"      # or "/dashboard/"
-LOGOUT_REDIRECT_URL = "product_list"  # where to go after logout
\ No newline at end of file
+LOGOUT_REDIRECT_URL = "product_list"  # where to go after logout
+
+# Cart and stock (see market/checkout.py, market/inventory.py)
+UPBT_CART_MAX_LINES = 100              # distinct products per cart / checkout
+UPBT_STOCK_RESERVATION_SECONDS = 15 * 60  # how long cart lines hold bucketed stock
+
+# Webhook outbox (see market/webhooks.py and `manage.py deliver_webhooks`)
+UPBT_WEBHOOK_TIMEOUT_SECONDS = 5
+UPBT_WEBHOOK_MAX_ATTEMPTS = 8          # after this, deliveries are dead-lettered
+UPBT_WEBHOOK_BACKOFF_SECONDS = 30      # first retry delay, doubled on each attempt
+UPBT_WEBHOOK_BACKOFF_MAX_SECONDS = 6 * 60 * 60
+UPBT_WEBHOOK_LEASE_SECONDS = 60        # how long a worker owns a claimed delivery
+UPBT_WEBHOOK_CIRCUIT_THRESHOLD = 5     # consecutive failures before an endpoint is paused
+UPBT_WEBHOOK_CIRCUIT_COOLDOWN_SECONDS = 300  # pause before a single probe delivery
+UPBT_WEBHOOK_BATCH_MAX_SIZE = 500      # largest batch_size a vendor may choose
+
+# Vendor API
+UPBT_BATCH_TRANSFER_MAX_ITEMS = 1000
+UPBT_API_PAGE_MAX_LIMIT = 1000         # largest page size for list endpoints
+UPBT_EXPORT_CHUNK_SIZE = 2000          # rows fetched per round trip by streaming exports
+UPBT_PRODUCT_IMPORT_CHUNK_SIZE = 500   # rows per bulk_create/bulk_update
+UPBT_PRODUCT_IMPORT_MAX_ROWS = 50000   # rows read from one import file
+UPBT_STATS_MAX_BUCKETS = 1000         # hours/days per /api/vendor/stats/ request
+UPBT_PURCHASE_MAX_AGE = 24 * 60 * 60   # Cache-Control max-age for purchase records
+
+# Vendor API rate limits (see market/ratelimit.py); per-key fields override these
+UPBT_API_RATE_LIMIT_PER_MINUTE = 600   # None disables throttling for keys without a limit
+UPBT_API_RATE_LIMIT_BURST = 60
+UPBT_API_RATE_LIMIT_CACHE_ALIAS = None  # e.g. "default" to share buckets across processes
+
+# Web UI
+UPBT_DASHBOARD_PAGE_SIZE = 25
+UPBT_PRODUCT_PAGE_MAX_AGE = 60         # Cache-Control max-age for anonymous product pages
+UPBT_CATALOGUE_PAGE_SIZE = 24
+UPBT_CATALOGUE_CACHE_TTL = 300         # product list pages; any Product change invalidates them
+UPBT_CATALOGUE_LOCAL_CACHE_TTL = 5     # used instead when the cache is per-process (LocMem)
+UPBT_CATALOGUE_CACHE_ALIAS = "default"  # use a shared cache when running several processes
+UPBT_USER_CONTEXT_TTL = 30             # seconds the navbar's vendor flag/balance may be cached
+UPBT_USER_CONTEXT_CACHE_ALIAS = "default"  # use a shared cache when running several processes
+
+# Ledger snapshots (see market/ledger.py and `manage.py snapshot_balances`)
+UPBT_LEDGER_SNAPSHOT_EVERY = 500       # new entries per account before re-snapshotting
+UPBT_LEDGER_SNAPSHOT_LAG_SECONDS = 300  # leave recent entries out of snapshots
+
+# Balance reconciliation (see market/reconcile.py and `manage.py reconcile_balances`)
+UPBT_RECONCILE_WORKERS = 4             # processes checking account chunks in parallel
+UPBT_RECONCILE_CHUNK_SIZE = 1000       # accounts per chunk
+
+# Vendor API key cache (see market/apikeys.py)
+UPBT_API_KEY_CACHE_TTL = 60            # seconds a resolved key is trusted per process
+UPBT_API_KEY_CACHE_NEGATIVE_TTL = 5    # seconds an unknown key is remembered
+UPBT_API_KEY_CACHE_SIZE = 1024
+UPBT_API_KEY_CACHE_ALIAS = None        # e.g. "default" to share resolved keys across processes
+
+# Account locking (see market/locking.py)
+UPBT_ACCOUNT_LOCK_NOWAIT = False       # fail fast instead of waiting for row locks
+UPBT_ACCOUNT_LOCK_SKIP_LOCKED = False  # treat locked rows as busy instead of waiting
+UPBT_ACCOUNT_LOCK_RETRIES = 3          # attempts per transaction on deadlock/serialization failure
+UPBT_ACCOUNT_LOCK_RETRY_BACKOFF = 0.05  # seconds, doubled (with jitter) per retry
+
+# Idempotency keys (see market/idempotency.py and `manage.py purge_idempotency_keys`)
+UPBT_IDEMPOTENCY_KEY_TTL_HOURS = 24    # stored responses older than this may be purged
+
+# Request instrumentation (see market/instrumentation.py, served at /metrics/)
+UPBT_INSTRUMENTATION = True
+UPBT_METRICS_TOKEN = None              # bearer token for Prometheus; staff sessions always work
+UPBT_SLOW_REQUEST_SECONDS = 1.0        # log slower requests with their queries; None disables
+UPBT_SLOW_REQUEST_MAX_QUERIES = 100    # queries kept per request for that log
@@ -1,6 +1,38 @@
-# Simply run me with py webhook_server.py
+# Simply run me with py webhook_server.py [--port 80] [--secret s3cr3t]
+#
+# Local stand-in for a vendor endpoint. Accepts single events and batches
+# (a JSON array, X-UPBT-Event: batch), verifies X-UPBT-Signature when a
+# secret is given, and uses X-UPBT-Sequence to report gaps and duplicates.
 from http.server import HTTPServer, BaseHTTPRequestHandler
+import argparse
+import hashlib
+import hmac
 import json
+import threading
+
+SECRET = ""
+
+# Sequence numbers seen so far (retries can arrive late or twice)
+seen_sequences = set()
+highest_sequence = 0
+sequence_lock = threading.Lock()
+
+
+def check_sequence(sequence):
+    """Return a short note about this sequence number (gap/duplicate/ok)."""
+    global highest_sequence
+    with sequence_lock:
+        if sequence in seen_sequences:
+            return f"duplicate of #{sequence} (a retry); ignore it"
+        seen_sequences.add(sequence)
+        note = "in order"
+        if sequence > highest_sequence + 1:
+            note = f"GAP: missing #{highest_sequence + 1}..#{sequence - 1}"
+        elif sequence < highest_sequence:
+            note = f"late arrival, fills the gap at #{sequence}"
+        highest_sequence = max(highest_sequence, sequence)
+        return note
+
 
 class WebhookHandler(BaseHTTPRequestHandler):
     def do_POST(self):
@@ -13,20 +45,45 @@ class WebhookHandler(BaseHTTPRequestHandler):
         print("Headers:")
         for k, v in self.headers.items():
             print(f"  {k}: {v}")
-        print("Raw body:", body.decode("utf-8", errors="replace"))
+
+        if SECRET:
+            expected = hmac.new(SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+            signature = self.headers.get("X-UPBT-Signature", "")
+            if not hmac.compare_digest(expected, signature):
+                print("Signature: INVALID, rejecting")
+                self.respond(401, {"status": "invalid signature"})
+                return
+            print("Signature: valid")
+
+        sequence = self.headers.get("X-UPBT-Sequence")
+        if sequence and sequence.isdigit():
+            print(f"Sequence #{sequence}:", check_sequence(int(sequence)))
 
         # Try to parse JSON just to show it nicely
         try:
             data = json.loads(body)
-            print("Parsed JSON:", json.dumps(data, indent=2))
         except json.JSONDecodeError:
             print("Body is not valid JSON")
+            print("Raw body:", body.decode("utf-8", errors="replace"))
+            self.respond(400, {"status": "invalid json"})
+            return
+
+        events = data if isinstance(data, list) else [data]
+        if isinstance(data, list):
+            print(f"Batch of {len(events)} events")
+        for event in events:
+            print("Event:", json.dumps(event, indent=2))
 
         # Respond 200 OK
-        self.send_response(200)
+        self.respond(200, {"status": "received", "events": len(events)})
+
+    def respond(self, status, data):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
         self.end_headers()
-        self.wfile.write(b'{"status": "received"}')
+        self.wfile.write(payload)
 
     # optional: avoid logs for GET favicon etc.
     def log_message(self, format, *args):
@@ -34,8 +91,14 @@ class WebhookHandler(BaseHTTPRequestHandler):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print (and verify) UPBT webhooks.")
     # Use a non-privileged port like 8001 so you don't need admin
-    server_address = ("", 80)
-    print("Listening for webhooks on http://127.0.0.1:80/ ...")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--secret", default="", help="Webhook secret to verify signatures with.")
+    args = parser.parse_args()
+    SECRET = args.secret
+
+    server_address = ("", args.port)
+    print(f"Listening for webhooks on http://127.0.0.1:{args.port}/ ...")
     httpd = HTTPServer(server_address, WebhookHandler)
     httpd.serve_forever()